@@ -0,0 +1,147 @@
+# Read and write the persistent cache of media image annotations, so a
+# media image reopened with another scan file or hash database does not
+# run mmls and fsstat again.
+#
+# Each media image has one JSON file in the cache directory, named by a
+# digest of its key.  The key is the media image path, size, and mtime,
+# the sector size, and an MD5 of the first sector, and the file holds the
+# key, the annotation types, the annotations, and the offsets of volumes
+# whose fsstat probe failed, which are probed again.  File mtimes record last
+# use, and the least recently used files are removed when the cache
+# grows past its size limit.
+
+import os
+import json
+import hashlib
+from media_reader import MediaReader
+
+ANNOTATION_CACHE_DIR = os.path.join(os.path.expanduser("~"), ".sectorscope",
+                                    "annotation_cache")
+ANNOTATION_CACHE_MAX_SIZE = 32 * 1024 * 1024
+# version 2 drops caches that may hold annotations read while an fsstat
+# probe failed, version 3 records the volumes whose fsstat probe failed
+ANNOTATION_CACHE_VERSION = 3
+
+def _header_md5(media_filename, sector_size):
+    # MD5 of the first sector, else "" if it cannot be read
+    media_reader = MediaReader(media_filename)
+    try:
+        error_message, buf = media_reader.read(0, sector_size)
+    finally:
+        media_reader.close()
+    if error_message:
+        return ""
+    return hashlib.md5(bytes(buf)).hexdigest()
+
+def _cache_key(media_filename, sector_size):
+    st = os.stat(media_filename)
+    return {"version": ANNOTATION_CACHE_VERSION,
+            "media_filename": os.path.abspath(media_filename),
+            "media_file_size": st.st_size,
+            "media_file_mtime": st.st_mtime,
+            "sector_size": sector_size,
+            "header_md5": _header_md5(media_filename, sector_size)}
+
+def _cache_filename(key):
+    digest = hashlib.sha1(json.dumps(key, sort_keys=True)
+                          .encode('utf-8')).hexdigest()
+    return os.path.join(ANNOTATION_CACHE_DIR, digest + ".json")
+
+def read_annotation_cache(media_filename, sector_size):
+    """Read the cached annotations of media_filename if they are valid.
+
+    Returns:
+      None if there are no valid cached annotations, else a tuple of
+      annotation_types, annotations, and the byte offsets of volumes whose
+      fsstat probe failed.
+    """
+    try:
+        key = _cache_key(media_filename, sector_size)
+        cache_file = _cache_filename(key)
+        with open(cache_file, 'r') as f:
+            cached = json.load(f)
+    except (IOError, OSError, ValueError):
+        # no cache
+        return None
+
+    try:
+        if cached["key"] != key:
+            return None
+        annotation_types = [tuple(t) for t in cached["annotation_types"]]
+        annotations = [tuple(a) for a in cached["annotations"]]
+        failed_offsets = list(cached["failed_offsets"])
+    except Exception as e:
+        print("annotation cache: ignoring unreadable cache %s: %s" %
+                                                      (cache_file, e))
+        return None
+
+    # mark as recently used
+    try:
+        os.utime(cache_file, None)
+    except OSError:
+        pass
+
+    return (annotation_types, annotations, failed_offsets)
+
+def write_annotation_cache(media_filename, sector_size, annotation_types,
+                           annotations, failed_offsets=()):
+    """Write the annotations of media_filename to the cache, removing the
+    least recently used cache files past the cache size limit.  The
+    volumes at failed_offsets are probed with fsstat again next time.
+    Failure to write is not an error, the annotations are just read again
+    next time."""
+    temp_file = None
+    try:
+        key = _cache_key(media_filename, sector_size)
+        cache_file = _cache_filename(key)
+        if not os.path.isdir(ANNOTATION_CACHE_DIR):
+            os.makedirs(ANNOTATION_CACHE_DIR)
+        temp_file = cache_file + ".tmp"
+        with open(temp_file, 'w') as f:
+            json.dump({"key": key,
+                       "annotation_types": annotation_types,
+                       "annotations": annotations,
+                       "failed_offsets": list(failed_offsets)}, f)
+
+        # replace any previous cache
+        if os.path.exists(cache_file):
+            os.remove(cache_file)
+        os.rename(temp_file, cache_file)
+        temp_file = None
+
+        _evict(cache_file)
+
+    except Exception as e:
+        print("annotation cache: unable to write cache for %s: %s" %
+                                                   (media_filename, e))
+        if temp_file is not None:
+            try:
+                os.remove(temp_file)
+            except OSError:
+                pass
+
+def _evict(keep_file):
+    # remove least recently used cache files until the cache fits
+    entries = list()
+    total_size = 0
+    for name in os.listdir(ANNOTATION_CACHE_DIR):
+        if not name.endswith(".json"):
+            continue
+        path = os.path.join(ANNOTATION_CACHE_DIR, name)
+        try:
+            st = os.stat(path)
+        except OSError:
+            continue
+        entries.append((st.st_mtime, path, st.st_size))
+        total_size += st.st_size
+
+    for _, path, size in sorted(entries):
+        if total_size <= ANNOTATION_CACHE_MAX_SIZE:
+            break
+        if path == keep_file:
+            continue
+        try:
+            os.remove(path)
+            total_size -= size
+        except OSError:
+            pass
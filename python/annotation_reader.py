@@ -1,12 +1,54 @@
 #!/usr/bin/env python3
 import os
+import re
 import subprocess
-def _run_cmd(cmd):
+from media_reader import MediaReader
+from annotation_cache import read_annotation_cache, write_annotation_cache
+from partition_reader import read_partitions, PartitionTableError
+from scan_file_parser import num_workers
+try:
+    from concurrent.futures import ThreadPoolExecutor
+except ImportError:
+    # Python 2.7 without the futures backport
+    ThreadPoolExecutor = None
+
+# seconds allowed for one fsstat probe
+FSSTAT_TIMEOUT = 120
+
+# mmls volume descriptions of partition table metadata, unallocated space,
+# extended partitions, and partitions that hold no file system, such as
+# swap, LVM and RAID members, and reserved or boot partitions, which fsstat
+# is not run on
+_NO_FILE_SYSTEM = re.compile(r"Unallocated|Primary Table|Extended Table|"
+                             r"Table #|Safety Table|GPT Header|"
+                             r"Partition Table|Extended \(0x|Swap|"
+                             r"Logical Volume Manager|LVM|Linux RAID|"
+                             r"Dynamic Disk|LDM (metadata|data)|"
+                             r"Microsoft reserved|BIOS boot",
+                             re.IGNORECASE)
+
+# fsstat errors for volumes that hold no file system fsstat can read, which
+# are skipped like the volumes above rather than reported as failures
+_NOT_A_FILE_SYSTEM = re.compile(r"Cannot determine file system type|"
+                                r"Encryption detected", re.IGNORECASE)
+
+def _run_cmd(cmd, timeout=None):
     # run cmd, return lines, raise if unable to produce lines
     try:
         print("annotation reader running command: ", cmd)
-        p = subprocess.Popen(cmd, stdout=subprocess.PIPE)
-        lines = p.communicate()[0].decode('utf-8').split("\n")
+        p = subprocess.Popen(cmd, stdout=subprocess.PIPE,
+                             stderr=subprocess.PIPE)
+        if timeout is None:
+            stdout, stderr = p.communicate()
+        else:
+            try:
+                stdout, stderr = p.communicate(timeout=timeout)
+            except subprocess.TimeoutExpired:
+                p.kill()
+                p.wait()
+                raise RuntimeError("timed out after %d seconds" % timeout)
+        lines = stdout.decode('utf-8').split("\n")
+        error_text = stderr.decode('utf-8', 'replace').strip()
     except Exception as e:
         raise RuntimeError("Annoation failure running cmd: %s: %s\n"
                            "Please check that TSK is installed and that "
@@ -14,13 +56,48 @@ def _run_cmd(cmd):
                            (cmd, e))
     if p.returncode != 0:
         raise RuntimeError("Annoation failure running cmd: "
-                           "%s\nResponse: %s\nAborting." % (cmd, lines))
+                           "%s\nResponse: %s\nError: %s\nAborting." %
+                           (cmd, lines, error_text))
     return lines
 
+def _read_partition_table(media_filename, sector_size):
+    # return the (offset, length, text) volumes mmls would list, read
+    # in-process, else None if the media image size is not known without
+    # hashdb or there is no partition table that can be read here
+    media_reader = MediaReader(media_filename)
+    try:
+        media_size = media_reader.media_size()
+        if media_size is None:
+            return None
+
+        def read(offset, count):
+            error_message, buf = media_reader.read(offset, count)
+            if error_message:
+                raise PartitionTableError(error_message)
+            return buf
+
+        return read_partitions(read, media_size, sector_size)
+
+    except PartitionTableError as e:
+        print("annotation_reader using mmls: %s" % e)
+        return None
+
+    finally:
+        media_reader.close()
+
 def _read_mmls_annotations(media_filename, sector_size,
                                               annotation_types, annotations):
     # mmls for volume allocation table
     annotation_types.append(("mmls", "Disk partitions (from TSK mmls)", True))
+
+    # read the partition table directly when possible
+    volumes = _read_partition_table(media_filename, sector_size)
+    if volumes is not None:
+        for offset, length, text in volumes:
+            annotations.append(("mmls", offset, length, text))
+        return
+
+    # else run mmls
     cmd = ["mmls", "-b", "%d"%sector_size, media_filename]
     lines = _run_cmd(cmd)
 
@@ -36,65 +113,129 @@ def _read_mmls_annotations(media_filename, sector_size,
             # don't use this line
             pass
 
+def _read_fsstat_volume(media_filename, sector_size, offset):
+    # return the fsstat annotations of the file system at offset and ""
+    # else the text of why the fsstat probe failed.  A volume without a
+    # file system fsstat can read has no annotations and did not fail.
+    sector_offset = offset // sector_size
+    cmd = ["fsstat", "-b", "%d"%sector_size,
+           "-o", "%d"%sector_offset, media_filename]
+    try:
+        lines = _run_cmd(cmd, FSSTAT_TIMEOUT)
+    except RuntimeError as e:
+        print("annotation_reader skipping fsstat byte offset %s" %
+                 offset)
+        if _NOT_A_FILE_SYSTEM.search("%s" % e):
+            return (list(), "")
+        return (list(), "fsstat failed at byte offset %d: %s" % (offset, e))
+
+    annotations = list()
+    for line in lines:
+        try:
+#            print("line.a:", line)
+            p1 = line.index('-')
+            p2 = line.index(' (')
+            p3 = line.index(')')
+#            print("line:", line, p1, p2, p3)
+#            print("o:'%s', l:'%s'" % (line[0:p1], line[p2+2:p3]))
+
+            # create dictionary entry for this line
+            line_offset = (int(line[0:p1]) + sector_offset) * sector_size
+            length = int(line[p2+2:p3]) * sector_size
+            text = line
+            annotations.append(("fsstat", line_offset, length, text))
+
+        except Exception as e:
+            # don't use this line
+            pass
+    return (annotations, "")
+
+def _read_fsstat_volumes(media_filename, sector_size, offsets, annotations):
+    # add the fsstat annotations of the volumes at offsets, returning the
+    # offsets of volumes whose fsstat probe failed and the failure texts
+
+    # run fsstat on the volumes in parallel, adding their annotations in
+    # offset order
+    offsets = sorted(offsets)
+    def read_volume(offset):
+        return _read_fsstat_volume(media_filename, sector_size, offset)
+    workers = min(len(offsets), num_workers())
+    if workers > 1 and ThreadPoolExecutor is not None:
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            volume_annotations = list(executor.map(read_volume, offsets))
+    else:
+        volume_annotations = [read_volume(offset) for offset in offsets]
+    failed_offsets = list()
+    failures = list()
+    for offset, (fsstat_annotations, failure) in zip(offsets,
+                                                     volume_annotations):
+        annotations.extend(fsstat_annotations)
+        if failure:
+            failed_offsets.append(offset)
+            failures.append(failure)
+    return (failed_offsets, failures)
+
 def _read_fsstat_annotations(media_filename, sector_size,
                                               annotation_types, annotations):
+    # add the fsstat annotations of each volume, returning the offsets of
+    # volumes whose fsstat probe failed and the failure texts
 
     annotation_types.append(("fsstat", "File system sectors (from TSK fsstat)",
                                                                         True))
 
-    # tries every offset in mmls, so run _read_mmls_annotations first.
-
-    for annotation_type, offset, _, _ in annotations:
+    # tries every offset in mmls that may hold a file system, so run
+    # _read_mmls_annotations first.
+    offsets = set()
+    for annotation_type, offset, _, text in annotations:
 
-        if annotation_type == "mmls":
+        if annotation_type == "mmls" and not _NO_FILE_SYSTEM.search(text):
             # make sure sector size is valid
             if offset % sector_size != 0:
                 raise RuntimeError("annotation failure in fsstat: "
                          "sector size %s is not compatible with offset %s" %
                          (sector_size, offset))
+            offsets.add(offset)
 
-            # calculate sector offset from offset
-            sector_offset = offset // sector_size
+    return _read_fsstat_volumes(media_filename, sector_size, offsets,
+                                annotations)
 
-            cmd = ["fsstat", "-b", "%d"%sector_size,
-                   "-o", "%d"%sector_offset, media_filename]
-            try:
-                lines = _run_cmd(cmd)
-            except RuntimeError as e:
-                print("annotation_reader skipping fsstat byte offset %s" %
-                         offset)
-                lines = ""
-
-            for line in lines:
-                try:
-#                    print("line.a:", line)
-                    p1 = line.index('-')
-                    p2 = line.index(' (')
-                    p3 = line.index(')')
-#                    print("line:", line, p1, p2, p3)
-#                    print("o:'%s', l:'%s'" % (line[0:p1], line[p2+2:p3]))
-
-                    # create dictionary entry for this line
-                    offset= (int(line[0:p1]) + sector_offset) * sector_size
-                    length = int(line[p2+2:p3]) * sector_size
-                    text = line
-                    annotations.append(("fsstat", offset, length, text))
-
-                except Exception as e:
-                    # don't use this line
-                    pass
+def _failure_status(failures):
+    # the annotation load status for fsstat probe failures
+    if not failures:
+        return ""
+    return "Some file systems were not annotated:\n%s" % "\n".join(failures)
 
 def read_annotations(media_filename, sector_size):
     """Read media annotations.  Throws on failure.
 
+    Annotations are cached along with the volumes whose fsstat probe
+    failed or timed out, so only those volumes are probed again next time.
+
     Returns:
-      annotation_load_status(str): "" else text if something went wrong.
+      annotation_load_status(str): "" else text if something went wrong,
+        including any fsstat probes that failed.
       annotation_types(list<(type, description, is_active)>): Tuple of
         annotation types and whether they are active by default.
       annotations(list<(type, offset, length, text)>): List of annotations
         defined by annotation type, media offset, length, and text.
     """
 
+    # use the cached annotations of this media image if they are valid
+    cached = read_annotation_cache(media_filename, sector_size)
+    if cached is not None:
+        annotation_types, annotations, failed_offsets = cached
+        print("annotation reader using cached annotations for %s" %
+                                                           media_filename)
+        if not failed_offsets:
+            return ("", annotation_types, annotations)
+
+        # probe the volumes whose fsstat probe failed again
+        failed_offsets, failures = _read_fsstat_volumes(media_filename,
+                                 sector_size, failed_offsets, annotations)
+        write_annotation_cache(media_filename, sector_size,
+                               annotation_types, annotations, failed_offsets)
+        return (_failure_status(failures), annotation_types, annotations)
+
     # the annotation types and the annotations to return
     annotation_load_status = ""
     annotation_types = list()
@@ -107,11 +248,16 @@ def read_annotations(media_filename, sector_size):
                                                annotation_types, annotations)
 
         # fsstat
-        _read_fsstat_annotations(media_filename, sector_size,
-                                               annotation_types, annotations)
+        failed_offsets, failures = _read_fsstat_annotations(media_filename,
+                               sector_size, annotation_types, annotations)
+        annotation_load_status = _failure_status(failures)
+
+        # cache the annotations, with the volumes to probe again
+        write_annotation_cache(media_filename, sector_size,
+                               annotation_types, annotations, failed_offsets)
 
     except RuntimeError as e:
-        annotation_load_status = e
+        annotation_load_status = "%s" % e
 
     # return
     return (annotation_load_status, annotation_types, annotations)
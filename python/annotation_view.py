@@ -1,13 +1,34 @@
 import colors
 import histogram_constants
+from math import floor
+from interval_index import IntervalIndex
 try:
     import tkinter
 except ImportError:
     import Tkinter as tkinter
 
+# text lines that annotations are staggered across
+ANNOTATION_LINES = 6
+
+# summary glyph color and text for annotations merged into one pixel column
+SUMMARY_COLOR = "#777777"
+SUMMARY_TEXT = "[%d]"
+
+def _same_coords(coords1, coords2):
+    # canvas coordinates compare equal within a hundredth of a pixel
+    return len(coords1) == len(coords2) and all(abs(a - b) < 0.01
+                                      for a, b in zip(coords1, coords2))
+
 class AnnotationView():
     """Renders histogram annotation text in the histogram canvas based on
     registered events.
+
+    Annotations are drawn with a pool of reused canvas text and line item
+    pairs.  Every annotation at least a pixel wide is drawn.  Annotations
+    narrower than a pixel that start in the same pixel column are merged
+    into one summary glyph showing their count, so the number of canvas
+    items for them is bounded by the screen width rather than by their
+    number.
     """
 
     def __init__(self, canvas, x0, y0, w, h, histogram_control,
@@ -22,6 +43,21 @@ class AnnotationView():
         self._data_manager = data_manager
         self._annotation_filter = annotation_filter
 
+        # loaded annotations by offset range, to place only those visible
+        self._annotation_index = IntervalIndex(())
+
+        # the pool of (text_id, line_id) canvas item pairs, the
+        # (text, text coords, line coords, color) drawn by each pair else
+        # None if hidden, and the pair drawing each annotation or summary
+        # glyph, so placing only sends the changes
+        self._item_pairs = list()
+        self._item_pair_specs = list()
+        self._item_pair_keys = dict()
+
+        # the (start_offset, bytes_per_bucket, num_buckets) plot region
+        # placed
+        self._placed_viewport = None
+
         # register to receive data_manager change events
         data_manager.set_callback(self._handle_data_manager_change)
 
@@ -33,71 +69,160 @@ class AnnotationView():
                                     self._handle_histogram_control_change)
 
     def _load(self):
-        # clear existing annotations from the canvas
-        self._canvas.delete("annotations")
-
-        # load annotations into the canvas
-        c = self._canvas
+        # index the annotations that are not filtered out by offset range,
+        # keeping the canvas items for reuse
         annotations = self._data_manager.annotations
         ignored_types = self._annotation_filter.ignored_types
+        intervals = list()
         i=0
         for annotation_type, offset, length, text in annotations:
             # skip filtered out annotations
             if annotation_type in ignored_types:
                 continue
-            # load text
-            c.create_text(0,0, anchor="sw", tags=("annotations",
-                                                       "t%d" % i), text=text)
-
-            # load line
-            c.create_line(0,0,0,0, tags=("annotations", "l%d" % i))
+            intervals.append((offset, offset + length,
+                              (i, offset, length, text)))
 
             # next
             i+=1
 
-    def _place(self):
-        # skip if not initialized
-        if self._histogram_control.bytes_per_bucket == 0:
-            return
+        self._annotation_index = IntervalIndex(intervals)
+        self._item_pair_keys = dict()
+        self._placed_viewport = None
 
-        # place annotations
-        c = self._canvas
+    def _visible_specs(self, start_offset, stop_offset, scale):
+        # return the (text, text coords, line coords, color) to draw keyed
+        # by annotation number, or by pixel column for summary glyphs
         annotation_x0 = self._x0
-        annotation_y0 = self._y0
-        annotations = self._data_manager.annotations
-        ignored_types = self._annotation_filter.ignored_types
-        start_offset = self._histogram_control.start_offset
-        scale = float(histogram_constants.BUCKET_WIDTH) / \
-                                  self._histogram_control.bytes_per_bucket
-        i=0
-        for annotation_type, offset, length, text in annotations:
-            # skip filtered out annotations
-            if annotation_type in ignored_types:
-                continue
 
+        # group by the pixel column of the annotation start, whose number
+        # does not change when panning
+        columns = dict()
+        for i, offset, length, text in self._annotation_index.overlapping(
+                                                start_offset, stop_offset):
             # x0 = annotation origin + (offset - start offset) * zoom scale
             x0 = annotation_x0 + (offset - start_offset) * scale
             x1 = annotation_x0 + (offset + length - start_offset) * scale
-            # y = annotation top + space + (line * text height)
-            y0 = annotation_y0 + 16 + 7 + ((i%6) * 16)
-            y1 = y0 - 14
-            # annotation color
-            if x1 - x0 < 0.1:
-                color = "#aaaaaa"
-            elif x1 - x0 < 1:
-                color = "#777777"
-            else:
-                color = "black"
-            # place text
-            c.coords("t%d"%i, x0, y0)
-            c.itemconfigure("t%d"%i, fill=color)
-
-            # place line
-            c.coords("l%d"%i, x0,y1, x0,y0, x1,y0, x1,y1)
-            c.itemconfigure("l%d"%i, fill=color)
+            columns.setdefault(int(floor(offset * scale)), list()).append(
+                                                          (i, x0, x1, text))
+
+        # draw each annotation at least a pixel wide, and merge the
+        # narrower annotations of a column into a summary glyph
+        specs = dict()
+        for column, group in columns.items():
+            shown = [member for member in group
+                     if member[2] - member[1] >= 1]
+            narrow = [member for member in group
+                      if member[2] - member[1] < 1]
+            if len(narrow) == 1:
+                shown.extend(narrow)
+            elif narrow:
+                i, x0, _, _ = narrow[0]
+                specs[("g", column)] = self._spec(i, x0, x0,
+                                    SUMMARY_TEXT % len(narrow), SUMMARY_COLOR)
+
+            for i, x0, x1, text in shown:
+                # annotation color
+                if x1 - x0 < 0.1:
+                    color = "#aaaaaa"
+                elif x1 - x0 < 1:
+                    color = "#777777"
+                else:
+                    color = "black"
+                specs[("a", i)] = self._spec(i, x0, x1, text, color)
+        return specs
+
+    def _spec(self, i, x0, x1, text, color):
+        # y = annotation top + space + (line * text height)
+        y0 = self._y0 + 16 + 7 + ((i%ANNOTATION_LINES) * 16)
+        y1 = y0 - 14
+        return (text, (x0, y0), (x0,y1, x0,y0, x1,y0, x1,y1), color)
+
+    def _new_item_pair(self):
+        # add a hidden text and line item pair to the pool
+        c = self._canvas
+        self._item_pairs.append((
+                 c.create_text(0,0, anchor="sw", tags=("annotations",),
+                               state=tkinter.HIDDEN),
+                 c.create_line(0,0,0,0, tags=("annotations",),
+                               state=tkinter.HIDDEN)))
+        self._item_pair_specs.append(None)
+        return len(self._item_pairs) - 1
+
+    def _draw_item_pair(self, pair, spec):
+        # send only the changes from what the item pair draws now
+        c = self._canvas
+        text_id, line_id = self._item_pairs[pair]
+        old_spec = self._item_pair_specs[pair]
+        text, text_coords, line_coords, color = spec
+        if old_spec is None or not _same_coords(old_spec[1], text_coords):
+            c.coords(text_id, *text_coords)
+        if old_spec is None or not _same_coords(old_spec[2], line_coords):
+            c.coords(line_id, *line_coords)
+        if old_spec is None or old_spec[0] != text or old_spec[3] != color:
+            c.itemconfigure(text_id, text=text, fill=color,
+                            state=tkinter.NORMAL)
+        if old_spec is None or old_spec[3] != color:
+            c.itemconfigure(line_id, fill=color, state=tkinter.NORMAL)
+        self._item_pair_specs[pair] = spec
 
-            # next
-            i+=1
+    def _place(self):
+        # skip if not initialized
+        if self._histogram_control.bytes_per_bucket == 0:
+            return
+
+        # skip if the plot region is already placed
+        start_offset = self._histogram_control.start_offset
+        bytes_per_bucket = self._histogram_control.bytes_per_bucket
+        num_buckets = self._histogram_control.num_buckets
+        viewport = (start_offset, bytes_per_bucket, num_buckets)
+        if viewport == self._placed_viewport:
+            return
+
+        # place annotations
+        c = self._canvas
+        stop_offset = start_offset + bytes_per_bucket * num_buckets
+        scale = float(histogram_constants.BUCKET_WIDTH) / bytes_per_bucket
+
+        # a pan keeps the scale, so move all items in one call so that
+        # items already shown need no changes
+        if self._placed_viewport is not None and \
+                             self._placed_viewport[1:] == viewport[1:]:
+            dx = (self._placed_viewport[0] - start_offset) * scale
+            c.move("annotations", dx, 0)
+            for pair, spec in enumerate(self._item_pair_specs):
+                if spec is not None:
+                    text, text_coords, line_coords, color = spec
+                    self._item_pair_specs[pair] = (text,
+                          (text_coords[0] + dx, text_coords[1]),
+                          tuple(v + dx if j % 2 == 0 else v
+                                for j, v in enumerate(line_coords)), color)
+
+        # keep the item pairs of annotations and glyphs still shown
+        specs = self._visible_specs(start_offset, stop_offset, scale)
+        item_pair_keys = dict()
+        for key in specs:
+            if key in self._item_pair_keys:
+                item_pair_keys[key] = self._item_pair_keys[key]
+        free_pairs = sorted(set(range(len(self._item_pairs))) -
+                            set(item_pair_keys.values()), reverse=True)
+
+        # draw each annotation and glyph with its item pair else a free one
+        for key, spec in specs.items():
+            if key not in item_pair_keys:
+                item_pair_keys[key] = free_pairs.pop() if free_pairs \
+                                                   else self._new_item_pair()
+            self._draw_item_pair(item_pair_keys[key], spec)
+
+        # hide unused item pairs
+        for pair in free_pairs:
+            if self._item_pair_specs[pair] is not None:
+                text_id, line_id = self._item_pairs[pair]
+                c.itemconfigure(text_id, state=tkinter.HIDDEN)
+                c.itemconfigure(line_id, state=tkinter.HIDDEN)
+                self._item_pair_specs[pair] = None
+
+        self._placed_viewport = viewport
+        self._item_pair_keys = item_pair_keys
 
     # this function is registered to and called by DataManager
     def _handle_data_manager_change(self, *args):
@@ -112,5 +237,8 @@ class AnnotationView():
 
     # this function is registered to and called by HistogramControl
     def _handle_histogram_control_change(self, *args):
+        # cursor and range changes do not move annotations
+        if self._histogram_control.change_type in ("cursor_moved",
+                                                   "range_changed"):
+            return
         self._place()
-
@@ -45,6 +45,10 @@ class AnnotationWindow():
     # this function is registered to and called by IdentifiedData
     def _handle_data_manager_change(self, *args):
 
+        # annotations do not change while scan data is appended
+        if self._data_manager.change_type == "data_appended":
+            return
+
         # clear existing checkbuttons
         for checkbutton, _, _ in self._checkbuttons:
             checkbutton.destroy()
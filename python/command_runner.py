@@ -1,4 +1,9 @@
 # Use this to execute a command.  stdout and stderr are sent to queue.
+#
+# One pump thread reads both pipes in large chunks using selectors and
+# splits the chunks into lines in bulk.  Where selectors cannot wait on
+# pipes, as on Windows, one reader thread per pipe reads the chunks
+# instead.
 import os
 import subprocess
 import sys
@@ -6,82 +11,205 @@ import threading
 try:
     import queue
 except ImportError:
-    import Queue
+    import Queue as queue
+try:
+    import selectors
+except ImportError:
+    # Python 2.7
+    selectors = None
+
+# bytes read from a pipe at a time
+CHUNK_SIZE = 256 * 1024
+
+# batches of lines the queue of a batch consumer should be bounded to, so
+# at most QUEUE_BATCHES * CHUNK_SIZE bytes of output wait for the consumer
+QUEUE_BATCHES = 16
+
+# seconds between checks for an abandoned consumer while the queue is full
+PUT_TIMEOUT = 0.1
+
+def _encoding():
+    # the encoding to decode command output with
+    return getattr(sys.stderr, "encoding", None) or "utf-8"
+
+def _put(item_queue, item, abandoned):
+    # put item, waiting while the queue is full unless the consumer
+    # abandons the queue, then drop item
+    while not abandoned.is_set():
+        try:
+            item_queue.put(item, timeout=PUT_TIMEOUT)
+            return
+        except queue.Full:
+            pass
+
+# splits chunks of pipe output into lines for the queue
+class _LineSplitter():
+    def __init__(self, name, queue, batch_lines, abandoned):
+        self._name = name
+        self._queue = queue
+        self._batch_lines = batch_lines
+        self._abandoned = abandoned
+        self._encoding = _encoding()
+        self._partial = b""
+
+    def feed(self, data):
+        # queue the complete lines in data, keeping any partial last line
+        data = self._partial + data
+        end = data.rfind(b"\n") + 1
+        self._partial = data[end:]
+        if end:
+            self._put(data[:end])
+
+    def close(self):
+        # queue any partial last line
+        if self._partial:
+            self._put(self._partial)
+            self._partial = b""
+
+    def _put(self, data):
+        text = data.decode(self._encoding, 'replace')
+        lines = text.split("\n")
+        last = lines.pop()
+        lines = [line + "\n" for line in lines]
+        if last:
+            lines.append(last)
+        if self._batch_lines:
+            _put(self._queue, (self._name, lines), self._abandoned)
+        else:
+            for line in lines:
+                _put(self._queue, (self._name, line), self._abandoned)
 
 # the private command thread run method
 class _RunnerThread(threading.Thread):
-    def __init__(self, cmd, queue):
+    def __init__(self, cmd, queue, batch_lines):
         threading.Thread.__init__(self)
         self._cmd = cmd
         self._queue = queue
+        self._batch_lines = batch_lines
+
+        # set when the consumer stops consuming the queue
+        self.abandoned = threading.Event()
 
     def run(self):
         # start by showing the command issued
-        self._queue.put(("Command", "%s\n"%(self._cmd)))
+        command_text = "%s\n"%(self._cmd)
+        _put(self._queue, ("Command", [command_text] if self._batch_lines
+                                      else command_text), self.abandoned)
 
         # run the command
         try:
             self.cmd_p = subprocess.Popen(self._cmd, stdout=subprocess.PIPE,
                                            stderr=subprocess.PIPE)
 
+        # python 3 uses FileNotFoundError, python 2.7 uses superclass IOError
+        except (IOError, OSError):
+            error_text = "%s not found.  Please check that it " \
+                         "is installed.\n" % self._cmd[0]
+            _put(self._queue, ("Error", [error_text] if self._batch_lines
+                                        else error_text), self.abandoned)
+            return 1
+
+        # the consumer may have abandoned the queue before the command
+        # started
+        if self.abandoned.is_set():
+            self.cmd_p.kill()
+
+        pipes = (("stdout", self.cmd_p.stdout),
+                 ("stderr", self.cmd_p.stderr))
+        if selectors is not None and os.name != "nt":
+            # pump both pipes from this thread
+            self._pump(pipes)
+        else:
             # start readers
-            stdout_reader = _ReaderThread("stdout", self.cmd_p.stdout, self._queue)
-            stdout_reader.start()
-            stderr_reader = _ReaderThread("stderr", self.cmd_p.stderr, self._queue)
-            stderr_reader.start()
+            readers = [_ReaderThread(_LineSplitter(name, self._queue,
+                                     self._batch_lines, self.abandoned),
+                                     pipe)
+                       for name, pipe in pipes]
+            for reader in readers:
+                reader.start()
+            for reader in readers:
+                reader.join()
 
-            # wait for threads to finish
-            self.cmd_p.wait()
-            stdout_reader.join()
-            stderr_reader.join()
+        # wait for the command to finish
+        self.cmd_p.wait()
 
-        # python 3 uses FileNotFoundError, python 2.7 uses superclass IOError
-        except IOError:
-            self._queue.put(("Error", "%s not found.  Please check that it "
-                      "is installed.\n" % self._cmd[0]))
-            return 1
+    def _pump(self, pipes):
+        # read whichever pipe has output until both pipes close or the
+        # consumer abandons the queue
+        selector = selectors.DefaultSelector()
+        for name, pipe in pipes:
+            selector.register(pipe, selectors.EVENT_READ,
+                              _LineSplitter(name, self._queue,
+                                            self._batch_lines,
+                                            self.abandoned))
+        while selector.get_map() and not self.abandoned.is_set():
+            for key, _ in selector.select(PUT_TIMEOUT):
+                data = os.read(key.fileobj.fileno(), CHUNK_SIZE)
+                if data:
+                    key.data.feed(data)
+                else:
+                    # pipe closed
+                    key.data.close()
+                    selector.unregister(key.fileobj)
+        selector.close()
+        for _, pipe in pipes:
+            pipe.close()
 
 # private reader helper
 class _ReaderThread(threading.Thread):
-    def __init__(self, name, pipe, queue):
+    def __init__(self, line_splitter, pipe):
         threading.Thread.__init__(self)
-        self._name = name
+        self._line_splitter = line_splitter
         self._pipe = pipe
-        self._queue = queue
 
     def run(self):
         # read pipe until pipe closes
-        for line in self._pipe:
-            line_string = line.decode(
-                             encoding=sys.stderr.encoding, errors='replace')
-            # write stderr line to queue
-            self._queue.put((self._name, line_string))
+        while True:
+            data = os.read(self._pipe.fileno(), CHUNK_SIZE)
+            if not data:
+                break
+            self._line_splitter.feed(data)
+        self._line_splitter.close()
 
 # the command runner
 class CommandRunner():
     """Run cmd and place labeled stderr and stdout text into queue.
        Places the error code of the command thread in return_code
-       when done."""
+       when done.
 
-    def __init__(self, cmd, queue):
+       Queue items are (label, line) tuples, or (label, list of lines)
+       tuples in batches as output arrives when batch_lines is True.  A
+       batch consumer should bound its queue to QUEUE_BATCHES so output
+       waits in the command's pipes rather than in memory when the
+       consumer falls behind.
+    """
+
+    def __init__(self, cmd, queue, batch_lines=False):
         """Args:
           cmd(list): the command to execute using subprocess.Popen.
           queue(queue): the queue this producer will feed.
+          batch_lines(bool): queue lists of lines rather than lines.
         """
-        self._runner_thread = _RunnerThread(cmd, queue)
+        self._runner_thread = _RunnerThread(cmd, queue, batch_lines)
         self._runner_thread.start()
 
+    # kill the subprocess and stop queueing its output, for a consumer that
+    # stops consuming the queue, as when its window closes
+    def abandon(self):
+        self._runner_thread.abandoned.set()
+        self.kill()
+
     # kill the subprocess and let the reader threads finish when consumed
     def kill(self):
         # cmd_p may not exist
         try:
             self._runner_thread.cmd_p.kill()
-        except NameError:
+        except (AttributeError, OSError):
             pass
 
     # threads are done and all output is enqueued
     def is_done(self):
-        return not self._runner_thread.isAlive()
+        return not self._runner_thread.is_alive()
 
     # the return code from running the command
     def return_code(self):
@@ -92,3 +220,29 @@ class CommandRunner():
         except AttributeError:
             return -1
 
+# main
+if __name__=="__main__":
+    # informal throughput test: pump a command printing many lines
+    import time
+    num_lines = int(sys.argv[1]) if len(sys.argv) > 1 else 1000000
+    cmd = [sys.executable, "-c",
+           "import sys\n"
+           "for i in range(%d):\n"
+           "    sys.stdout.write('# %%d\\t00112233445566778899aabbccddeeff"
+           "\\t{}\\n' %% (i * 512))\n" % num_lines]
+    batch_queue = queue.Queue(QUEUE_BATCHES)
+    t0 = time.time()
+    command_runner = CommandRunner(cmd, batch_queue, batch_lines=True)
+    count = 0
+    while True:
+        try:
+            name, lines = batch_queue.get(timeout=0.1)
+        except queue.Empty:
+            if command_runner.is_done() and batch_queue.empty():
+                break
+            continue
+        if name == "stdout":
+            count += len(lines)
+    elapsed = time.time() - t0
+    print("%d lines in %.2f s, %d lines/s, return code %d" % (count, elapsed,
+          count / elapsed, command_runner.return_code()))
@@ -1,6 +1,8 @@
 from collections import defaultdict
 from math import floor
 from helpers import size_string
+from media_offsets import MediaOffsets, MediaOffsetsBuffer
+from filter_engine import FilterEngine, FilterState
 from copy import copy
 from timestamp import ts0, ts
 try:
@@ -12,9 +14,13 @@ class DataManager():
     """Contains calculated data and methods for calculating that data.
     """
 
-    # change type signaled: data_changed, filter_changed
+    # change type signaled: data_changed, data_appended, filter_changed
     change_type = ""
 
+    # incremented on each change, identifying the data and filter settings
+    # that bucket data is calculated from
+    filter_generation = 0
+
     # scan attributes
     scan_file = ""
     media_size = 0
@@ -22,7 +28,7 @@ class DataManager():
     hashdb_dir = ""
     sector_size = 0
     hash_block_size = 0
-    media_offsets = list()
+    media_offsets = MediaOffsets()
     hashes = dict()
     sources = dict()
  
@@ -48,6 +54,13 @@ class DataManager():
     def __init__(self):
         self._data_manager_changed = tkinter.BooleanVar()
 
+        # hash counts and bucket tiles, maintained across filter changes
+        self._filter_engine = FilterEngine(self.media_offsets, self.hashes,
+                                           self.sector_size, self.media_size)
+
+        # scan data appended while loading in batches
+        self._media_offsets_buffer = MediaOffsetsBuffer()
+
     def set_data(self, data_reader):
         # copy scan attributes from data reader
         self.scan_file = data_reader.scan_file
@@ -73,6 +86,11 @@ class DataManager():
         self.highlighted_sources.clear()
         self.highlighted_hashes.clear()
 
+        # start new hash counts and bucket tiles
+        self._filter_engine = FilterEngine(self.media_offsets, self.hashes,
+                                           self.sector_size, self.media_size)
+        self._media_offsets_buffer = MediaOffsetsBuffer()
+
         # annotations
         self.annotation_types = data_reader.annotation_types
         self.annotations = data_reader.annotations
@@ -81,121 +99,111 @@ class DataManager():
 
         self._fire_change("data_changed")
 
+    def append_data(self, batches):
+        """Add batches of scan data while a scan file is loading in
+        batches, firing data_appended.  Filter settings are kept.
+
+        Pairs are copied once into a buffer that the histogram worker reads
+        in place.  While they arrive in offset order they are shown as they
+        come, else they are shown once sorted by finish_appending().
+
+        Args:
+          batches(list): (media_offsets, hashes, sources) batches, where
+            media_offsets(MediaOffsets) are the batch media offsets,
+            hashes(dict) the batch hash data, with source_hashes, and
+            sources(dict) the batch source data.
+        """
+        for media_offsets, hashes, sources in batches:
+            self._media_offsets_buffer.append(media_offsets)
+
+            # take the data of the first batch as is rather than copying
+            # it, it may be read in place from the scan cache
+            if self.hashes:
+                self.hashes.update(hashes)
+            else:
+                self.hashes = hashes
+            if self.sources:
+                self.sources.update(sources)
+            else:
+                self.sources = sources
+        self.len_media_offsets = len(self._media_offsets_buffer)
+        self.len_hashes = len(self.hashes)
+        self.len_sources = len(self.sources)
+
+        if self._media_offsets_buffer.is_sorted():
+            # extend the hash counts and bucket tiles when next used
+            self.media_offsets = self._media_offsets_buffer.media_offsets()
+            self._filter_engine = self._filter_engine.extended(
+                                          self.media_offsets, self.hashes)
+
+        self._fire_change("data_appended")
+
+    def finish_appending(self):
+        """Sort the appended scan data once loading in batches stops, if
+        it did not arrive in offset order."""
+        buffer = self._media_offsets_buffer
+        self._media_offsets_buffer = MediaOffsetsBuffer()
+        if buffer.is_sorted():
+            return
+        media_offsets = buffer.media_offsets()
+        media_offsets.sort()
+        self.media_offsets = media_offsets
+
+        # recalculate hash counts and bucket tiles when next used
+        self._filter_engine = FilterEngine(self.media_offsets, self.hashes,
+                                           self.sector_size, self.media_size)
+
+    def set_annotations(self, annotation_load_status, annotation_types,
+                        annotations):
+        """Set annotations once a scan file has loaded in batches, firing
+        data_changed.  Filter settings are kept."""
+        self.annotation_types = annotation_types
+        self.annotations = annotations
+        self.annotation_load_status = annotation_load_status
+        print("annotation load status:", self.annotation_load_status)
+
+        self._fire_change("data_changed")
+
     def set_callback(self, f):
         """Register function f to be called on histogram mouse change."""
         self._data_manager_changed.trace_variable('w', f)
 
     def _fire_change(self, change_type):
         self.change_type = change_type
+        self.filter_generation += 1
         self._data_manager_changed.set(True)
 
     # ############################################################
     # scan data
     # ############################################################
-    def calculate_hash_counts(self):
-        """Calculate hash counts based on identified data and filter
-          settings.  Data in this hash counts map is used to calculate
-          bucket data plotted in the frequency histogram.
+    def calculation_snapshot(self):
+        """Return what is needed to calculate hash counts and bucket data
+          off the Tk thread.  The filter engine is then used only by that
+          calculation.
 
         Returns:
-          hash_counts(map<hash, (count, is_ignored, is_highlighted)>):
-            Count information keyed by hash.
+          filter_engine(FilterEngine): The filter engine for the current
+            data.
+          filter_state(FilterState): A snapshot of the filter settings.
+          filter_generation(int): Identifies the data and filter settings.
         """
-
-        t0 = ts0("data_manager.calculate_hash_counts start")
-
-        # optimization: make local references to filter variables
-        ignore_entropy_below = self.ignore_entropy_below
-        ignore_entropy_above = self.ignore_entropy_above
-        ignore_max_hashes = self.ignore_max_hashes
-        ignore_flagged_blocks = self.ignore_flagged_blocks
-        ignored_sources = self.ignored_sources
-        ignored_hashes = self.ignored_hashes
-        highlighted_sources = self.highlighted_sources
-        highlighted_hashes = self.highlighted_hashes
-
-        # tuple counts of hashes: map<hash, (count, is_ignored, is_highlighted)>
-        hash_counts = dict()
-
-        # calculate hash_counts based on identified data
-        for block_hash, hash_data in self.hashes.items():
-
-            count = hash_data["count"]
-            entropy = hash_data["k_entropy"] / 1000.0
-            hash_counts[block_hash] = (
-                # count
-                count,
-
-                # is_ignored
-                ignore_entropy_below != 0 and entropy < ignore_entropy_below or
-                ignore_entropy_above != 0 and entropy > ignore_entropy_above or
-                ignore_max_hashes != 0 and count > ignore_max_hashes or
-                block_hash in ignored_hashes or
-                ignore_flagged_blocks and len(hash_data["block_label"]) or
-                len(ignored_sources.intersection(hash_data["source_hashes"])),
-
-                # is_highlighted
-                block_hash in highlighted_hashes or
-                len(highlighted_sources.intersection(
-                                             hash_data["source_hashes"])))
-
-        ts("data_manager.calculate_hash_counts done", t0)
-        return hash_counts
-
-    def calculate_bucket_data(self, hash_counts, start_offset,
-                                              bytes_per_bucket, num_buckets):
-        """Buckets show number of sources that map to them.
-          Call _calculate_hash_counts first to define hash_counts.
-
-        Returns:
-          source_buckets(List): List of num_buckets sorce count values.
-          ignored_source_buckets(List): List of num_buckets sorce count
-            values.
-          highlighted_source_buckets(List): List of num_buckets sorce
-            count values.
-        """
-        t0 = ts0("data_manager.calculate_bucket_data.start")
-        # initialize empty buckets for each data type tracked
-        source_buckets = [0] * num_buckets
-        ignored_source_buckets = [0] * num_buckets
-        highlighted_source_buckets = [0] * num_buckets
-
-        if bytes_per_bucket == 0:
-            # no data
-            ts("data_manager.calculate_bucket_data none", t0)
-            return (source_buckets, ignored_source_buckets,
-                                        highlighted_source_buckets)
-
-
-        # calculate the histogram
-        for offset, block_hash in self.media_offsets:
-            bucket = int((offset - start_offset) // bytes_per_bucket)
-
-            if bucket < 0 or bucket >= num_buckets:
-                # offset is out of range of buckets
-                continue
-
-            # set values for buckets
-            count, is_ignored, is_highlighted = hash_counts[block_hash]
-
-            # hash and source buckets
-            source_buckets[bucket] += count
-
-            # ignored hash and source buckets
-            if is_ignored:
-                ignored_source_buckets[bucket] += count
-
-            # highlighted hash and source buckets
-            if is_highlighted:
-                highlighted_source_buckets[bucket] += count
-
-        ts("data_manager.calculate_bucket_data done", t0)
-        return (source_buckets, ignored_source_buckets,
-                highlighted_source_buckets)
+        return (self._filter_engine, self.filter_state(),
+                self.filter_generation)
 
     # ############################################################
     # filter actions
     # ############################################################
+    def filter_state(self):
+        """Return a snapshot of the filter settings."""
+        return FilterState(self.ignore_entropy_below,
+                           self.ignore_entropy_above,
+                           self.ignore_max_hashes,
+                           self.ignore_flagged_blocks,
+                           frozenset(self.ignored_sources),
+                           frozenset(self.ignored_hashes),
+                           frozenset(self.highlighted_sources),
+                           frozenset(self.highlighted_hashes))
+
     def fire_filter_change(self):
         """Use this when directly changing filter state."""
         self._fire_change("filter_changed")
@@ -216,20 +224,17 @@ class DataManager():
             ts("data_manager.calculate_sources_and_hashes_in_range.none", t0)
             return(sources_in_range, hashes_in_range)
 
-        # iterate through media_offsets and gather data about the range
-        hashes = self.hashes
-        for media_offset, block_hash in self.media_offsets:
-            offset = int(media_offset)
+        # bisect to the media_offsets in range
+        media_offsets = self.media_offsets
+        i0, i1 = media_offsets.index_range(start_byte, stop_byte)
 
-            # skip if not in range
-            if offset < start_byte or offset >= stop_byte:
-                continue
+        # gather data about each distinct hash in the range
+        hashes = self.hashes
+        for hash_index in set(media_offsets.hash_indexes[i0:i1]):
+            block_hash = media_offsets.block_hash(hash_index)
 
-            # append source hashes from this block hash to sources in range
-            if not hashes[block_hash]["source_hashes"].issubset(
-                                              sources_in_range):
-                sources_in_range = sources_in_range.union(
-                                     hashes[block_hash]["source_hashes"])
+            # add source hashes from this block hash to sources in range
+            sources_in_range.update(hashes[block_hash]["source_hashes"])
 
             # add block hash to hashes in range
             hashes_in_range.add(block_hash)
@@ -323,7 +328,7 @@ class DataManager():
           sources_list(list<(source_hash, percent_found, text)>): List of
             tuple of sources found.
         """
-        # similar to calculate_hash_counts()
+        # similar to FilterEngine.calculate_hash_counts()
         ignore_entropy_below = self.ignore_entropy_below
         ignore_entropy_above = self.ignore_entropy_above
         ignore_max_hashes = self.ignore_max_hashes
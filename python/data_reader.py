@@ -1,9 +1,11 @@
 import os
 import xml
-import json
 import subprocess
 from collections import defaultdict
 from annotation_reader import read_annotations
+from media_offsets import MediaOffsets
+from scan_cache import read_scan_cache, write_scan_cache
+from scan_file_parser import read_scan_file
 from timestamp import ts0, ts
 import helpers
 try:
@@ -24,8 +26,8 @@ class DataReader():
       hashdb_dir (str): Full path to the hash database directory.
       sector_size(int): The sector size to view.
       hash_block_size(int): The size of the hashed blocks.
-      media_offsets (list<media_offset int, hash hexcode str>): List
-        of int offsets and their hash hexcode.
+      media_offsets (MediaOffsets): Sorted columnar store of int offsets
+        and the hash hexcode matched at each offset.
       hashes (dict<hash hexcode str, whole json data plus source_hashes>)
         where source_hashes is the set of source hexcodes associated with
         the hash, composed from every third source_offset.
@@ -50,7 +52,7 @@ class DataReader():
         self.hashdb_dir = ""
         self.sector_size = 0
         self.hash_block_size = 0
-        self.media_offsets = list()
+        self.media_offsets = MediaOffsets()
         self.hashes = dict()
         self.sources = dict()
         self.annotation_types = list()
@@ -61,6 +63,8 @@ class DataReader():
              alternate_media_filename, alternate_hashdb_dir):
         """
         Reads and sets data else raises an exception and leaves data alone.
+        Scan data and annotations are read from the scan file's sidecar
+        cache when it is valid, and the cache is written when it is not.
         Args:
           scan_file(str): The block hash scan file containing the identified
                           blocks.
@@ -72,31 +76,38 @@ class DataReader():
         Raises read related exceptions.
         """
         # read scan file attributes
-        media_filename, media_size, hashdb_dir = \
-                                 helpers.get_scan_file_attributes(scan_file)
-
-        # use the alternate media image if it is defined
-        if alternate_media_filename:
-            media_filename = alternate_media_filename
-
-        # use the alternate hash database if it is defined
-        if alternate_hashdb_dir:
-            hashdb_dir = alternate_hashdb_dir
-
-        # read hash_block_size used for calculating block hashes
-        hash_block_size = helpers.get_hash_block_size(hashdb_dir)
+        media_filename, media_size, hashdb_dir, hash_block_size = \
+                        self._read_attributes(scan_file,
+                        alternate_media_filename, alternate_hashdb_dir)
 
         t0 = ts0("data_reader.read start")
 
-        # read scan file
-        (media_offsets, hashes, sources) = \
+        # read the sidecar cache else read the scan file
+        cached = read_scan_cache(scan_file, sector_size, media_filename)
+        if cached:
+            media_offsets, hashes, sources, cached_annotations = cached
+            t1 = ts("data_reader.read finished read scan cache", t0)
+        else:
+            (media_offsets, hashes, sources) = \
                                self._read_hash_scan_file(scan_file)
-        t1 = ts("data_reader.read finished read identified_blocks", t0)
-
-        # read any media image annotations
-        annotation_load_status, annotation_types, annotations = \
+            cached_annotations = None
+            t1 = ts("data_reader.read finished read identified_blocks", t0)
+
+        # use cached media image annotations else read them
+        if cached_annotations is not None:
+            annotation_types, annotations = cached_annotations
+            annotation_load_status = ""
+        else:
+            annotation_load_status, annotation_types, annotations = \
                          read_annotations(media_filename, sector_size)
 
+            # cache the scan data and any successfully read annotations
+            if not cached or not annotation_load_status:
+                write_scan_cache(scan_file, sector_size, media_filename,
+                                 media_offsets, hashes, sources,
+                                 None if annotation_load_status else
+                                 (annotation_types, annotations))
+
         t4 = ts("data_reader.read finished read annotations.  Done.", t1)
         # everything worked so accept the data
         self.scan_file = scan_file
@@ -112,6 +123,50 @@ class DataReader():
         self.annotations = annotations
         self.annotation_load_status = annotation_load_status
 
+    def read_attributes(self, scan_file, sector_size,
+                        alternate_media_filename, alternate_hashdb_dir):
+        """
+        Reads and sets scan attributes with empty scan data and
+        annotations, for loading scan data in batches, else raises an
+        exception and leaves data alone.  Args are as for read.
+        """
+        media_filename, media_size, hashdb_dir, hash_block_size = \
+                        self._read_attributes(scan_file,
+                        alternate_media_filename, alternate_hashdb_dir)
+
+        # everything worked so accept the attributes
+        self.scan_file = scan_file
+        self.media_size = media_size
+        self.media_filename = media_filename
+        self.hashdb_dir = hashdb_dir
+        self.sector_size = sector_size
+        self.hash_block_size = hash_block_size
+        self.media_offsets = MediaOffsets()
+        self.hashes = dict()
+        self.sources = dict()
+        self.annotation_types = list()
+        self.annotations = list()
+        self.annotation_load_status = ""
+
+    def _read_attributes(self, scan_file,
+                         alternate_media_filename, alternate_hashdb_dir):
+        # read scan file attributes
+        media_filename, media_size, hashdb_dir = \
+                                 helpers.get_scan_file_attributes(scan_file)
+
+        # use the alternate media image if it is defined
+        if alternate_media_filename:
+            media_filename = alternate_media_filename
+
+        # use the alternate hash database if it is defined
+        if alternate_hashdb_dir:
+            hashdb_dir = alternate_hashdb_dir
+
+        # read hash_block_size used for calculating block hashes
+        hash_block_size = helpers.get_hash_block_size(hashdb_dir)
+
+        return (media_filename, media_size, hashdb_dir, hash_block_size)
+
     def __repr__(self):
         return("DataReader("
               "scan_file: '%s', Media size: %d, Media filename: '%s', "
@@ -138,61 +193,60 @@ class DataReader():
 
         """Read hash scan file into media_offsets, hashes, and sources
         data structures.  Also add source_hashes set into hashes dictionary.
+        Large scan files are parsed in parallel processes.
         """
-
-        # read each line
-        media_offsets = list()
-        hashes = dict()
-        sources = dict()
-        with open(scan_file, 'r') as f:
-            i = 0
-            for line in f:
-                line = line.strip()
-                try:
-                    i+=1
-                    if len(line) == 0 or line[0]=='#':
-                        continue
-
-                    # get line parts
-                    parts = line.split("\t")
-                    (offset, block_hash, json_string) = parts
-
-                    # get media offset, stripping any recursion path
-                    if '-' in offset:
-                        # take everything before the first '-'
-                        media_offset = int(offset[:offset.find('-')])
-                    else:
-                        media_offset = int(offset)
-
-                    # store media_offset, hash pair
-                    media_offsets.append((media_offset, block_hash))
-
-                    # store hash information if present
-                    # get json data
-                    json_data = json.loads(json_string)
-
-                    if "source_sub_counts" in json_data:
-                        # take data for hash
-                        hashes[block_hash] = json_data
-
-                        # calculate source_hashes
-                        source_hashes = set()
-                        source_sub_counts = json_data["source_sub_counts"]
-                        for file_hash in source_sub_counts[0::2]:
-                            source_hashes.add(file_hash)
-
-                        # add additional source_hashes field
-                        hashes[block_hash]["source_hashes"] = source_hashes
-
-                        # sources
-                        for source in json_data["sources"]:
-                            sources[source["file_hash"]] = source
-
-                except Exception as e:
-                    raise ValueError("Error reading file '%s' "
-                             "line %d:'%s':%s\nPlease check that "
-                             "this file was made using the hashdb "
-                             "scan_media command." % (scan_file, i, line, e))
-
-        return (media_offsets, hashes, sources)
+        return read_scan_file(scan_file)
+
+# main
+if __name__=="__main__":
+    # informal memory benchmark comparing the list of (offset, hexcode)
+    # tuples with the MediaOffsets columnar store for a synthetic scan file
+    import sys
+    import hashlib
+    import tempfile
+    import tracemalloc
+
+    num_lines = int(sys.argv[1]) if len(sys.argv) > 1 else 10000000
+    num_hashes = num_lines // 10 + 1
+    scan_file = tempfile.NamedTemporaryFile(mode='w', suffix=".json",
+                                            delete=False)
+    for i in range(num_lines):
+        block_hash = hashlib.md5(str(i % num_hashes).encode()).hexdigest()
+        if i < num_hashes:
+            json_string = '{"count":1,"k_entropy":8000,"block_label":"",' \
+                          '"source_sub_counts":["%s",1],"sources":[' \
+                          '{"file_hash":"%s","filesize":4096,' \
+                          '"name_pairs":["repo","file"]}]}' % (
+                          block_hash, block_hash)
+        else:
+            json_string = "{}"
+        scan_file.write("%d\t%s\t%s\n" % (i * 512, block_hash,
+                                           json_string))
+    scan_file.close()
+
+    # previous representation
+    tracemalloc.start()
+    tuples = list()
+    with open(scan_file.name, 'r') as f:
+        for line in f:
+            offset, block_hash, _ = line.split("\t")
+            tuples.append((int(offset), block_hash))
+    tuple_bytes = tracemalloc.get_traced_memory()[0]
+    del tuples
+    tracemalloc.stop()
+
+    # columnar representation
+    tracemalloc.start()
+    media_offsets = MediaOffsets()
+    with open(scan_file.name, 'r') as f:
+        for line in f:
+            offset, block_hash, _ = line.split("\t")
+            media_offsets.append(int(offset), block_hash)
+    store_bytes = tracemalloc.get_traced_memory()[0]
+    tracemalloc.stop()
+
+    os.unlink(scan_file.name)
+    print("%d lines, %d hashes" % (num_lines, num_hashes))
+    print("list of tuples: %s" % helpers.size_string(tuple_bytes))
+    print("MediaOffsets:   %s" % helpers.size_string(store_bytes))
 
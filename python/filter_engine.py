@@ -0,0 +1,300 @@
+from collections import defaultdict, namedtuple
+import histogram_engine
+from histogram_engine import HashCounts
+from histogram_pyramid import HistogramPyramid
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+# a snapshot of DataManager filter settings
+FilterState = namedtuple("FilterState", ["ignore_entropy_below",
+                         "ignore_entropy_above", "ignore_max_hashes",
+                         "ignore_flagged_blocks", "ignored_sources",
+                         "ignored_hashes", "highlighted_sources",
+                         "highlighted_hashes"])
+
+def _hash_flags(block_hash, hash_data, filter_state):
+    # return (is_ignored, is_highlighted) for one hash
+    count = hash_data["count"]
+    entropy = hash_data["k_entropy"] / 1000.0
+    source_hashes = hash_data["source_hashes"]
+    return (bool(
+        filter_state.ignore_entropy_below != 0 and
+                       entropy < filter_state.ignore_entropy_below or
+        filter_state.ignore_entropy_above != 0 and
+                       entropy > filter_state.ignore_entropy_above or
+        filter_state.ignore_max_hashes != 0 and
+                       count > filter_state.ignore_max_hashes or
+        block_hash in filter_state.ignored_hashes or
+        filter_state.ignore_flagged_blocks and len(hash_data["block_label"])
+                                                                       or
+        not filter_state.ignored_sources.isdisjoint(source_hashes)),
+            bool(
+        block_hash in filter_state.highlighted_hashes or
+        not filter_state.highlighted_sources.isdisjoint(source_hashes)))
+
+class FilterEngine():
+    """Maintains hash counts and their histogram pyramid across filter
+    changes.
+
+    The first calculation, and any change to the entropy, max hashes, or
+    flagged block filters, evaluates every hash.  Changes to the ignored
+    and highlighted hash and source sets only re-evaluate the hashes they
+    affect, found using a reverse source to hashes index, and apply the
+    resulting count changes to the histogram pyramid.
+
+    While a scan file loads in batches, each batch gets an extended
+    engine, which takes over the hash counts and pyramid of the engine it
+    extends and only evaluates the appended hashes and tiles the appended
+    matches.
+
+    Attributes:
+      hash_counts(HashCounts): The hash counts, updated in place.
+    """
+
+    def __init__(self, media_offsets, hashes, sector_size, media_size):
+        """Args:
+          media_offsets(MediaOffsets): The matched media offsets.
+          hashes(dict): The hash data keyed by hash hexcode.
+          sector_size(int): The sector size, the finest pyramid tile size.
+          media_size(int): Size in bytes of the media image.
+        """
+        self._media_offsets = media_offsets
+        self._hashes = hashes
+        self._sector_size = sector_size
+        self._media_size = media_size
+
+        self.hash_counts = None
+        self._filter_state = None
+        self._histogram_pyramid = None
+
+        # reverse index of source hash to hash indexes, made with the
+        # first hash counts
+        self._source_hash_indexes = None
+
+        # the engine this one extends, taken over when first used
+        self._extended_engine = None
+
+    def extended(self, media_offsets, hashes):
+        """Return a FilterEngine for media_offsets and hashes, which hold
+        the data of this engine followed by appended data, in offset
+        order.
+
+        The returned engine takes over the calculations of this engine
+        when it is first used, and this engine then starts over if it is
+        used again.  Both must be used from one thread, as the histogram
+        worker does.
+        """
+        engine = FilterEngine(media_offsets, hashes, self._sector_size,
+                              self._media_size)
+        engine._extended_engine = self
+        return engine
+
+    def _take_over(self):
+        # take over the calculations of the engine this one extends,
+        # adding the appended hashes and matches
+        previous = self._extended_engine
+        self._extended_engine = None
+        if previous._extended_engine is not None:
+            previous._take_over()
+        hash_counts = previous.hash_counts
+        if hash_counts is None:
+            # nothing calculated yet
+            return
+        filter_state = previous._filter_state
+        source_hash_indexes = previous._source_hash_indexes
+        histogram_pyramid = previous._histogram_pyramid
+        start = len(previous._media_offsets)
+        previous.hash_counts = None
+        previous._filter_state = None
+        previous._source_hash_indexes = None
+        previous._histogram_pyramid = None
+
+        # evaluate the appended hashes with the same filter settings
+        counts = list()
+        is_ignored = list()
+        is_highlighted = list()
+        block_hash = self._media_offsets.block_hash
+        hashes = self._hashes
+        for hash_index in range(len(hash_counts),
+                                self._media_offsets.num_hashes()):
+            hex_hash = block_hash(hash_index)
+            hash_data = hashes[hex_hash]
+            flags = _hash_flags(hex_hash, hash_data, filter_state)
+            counts.append(hash_data["count"])
+            is_ignored.append(flags[0])
+            is_highlighted.append(flags[1])
+            for source_hash in hash_data["source_hashes"]:
+                source_hash_indexes.setdefault(source_hash,
+                                               list()).append(hash_index)
+        hash_counts.extend(counts, is_ignored, is_highlighted)
+        hash_counts.generation += 1
+        self.hash_counts = hash_counts
+        self._filter_state = filter_state
+        self._source_hash_indexes = source_hash_indexes
+
+        # tile the appended matches, else rebuild the pyramid when next
+        # used
+        if histogram_pyramid is not None and histogram_pyramid.extend(
+                                self._media_offsets, hash_counts, start):
+            self._histogram_pyramid = histogram_pyramid
+
+    def calculate_hash_counts(self, filter_state):
+        """Bring hash counts up to date with filter_state.
+
+        Returns:
+          hash_counts(HashCounts): The updated hash counts.
+        """
+        if self._extended_engine is not None:
+            self._take_over()
+        previous = self._filter_state
+        self._filter_state = filter_state
+
+        # full calculation
+        if previous is None or previous[:4] != filter_state[:4]:
+            self._calculate_all()
+            return self.hash_counts
+
+        # the block hashes and source hashes whose filter settings changed
+        changed_hashes = \
+               previous.ignored_hashes.symmetric_difference(
+                                 filter_state.ignored_hashes) | \
+               previous.highlighted_hashes.symmetric_difference(
+                                 filter_state.highlighted_hashes)
+        changed_sources = \
+               previous.ignored_sources.symmetric_difference(
+                                 filter_state.ignored_sources) | \
+               previous.highlighted_sources.symmetric_difference(
+                                 filter_state.highlighted_sources)
+        if not changed_hashes and not changed_sources:
+            return self.hash_counts
+
+        # the affected hash indexes
+        find_hash_index = self._media_offsets.find_hash_index
+        hash_indexes = set(find_hash_index(block_hash)
+                           for block_hash in changed_hashes)
+        hash_indexes.discard(-1)
+        source_hash_indexes = self._source_hash_indexes
+        for source_hash in changed_sources:
+            hash_indexes.update(source_hash_indexes.get(source_hash, ()))
+
+        # re-evaluate the affected hashes
+        hash_counts = self.hash_counts
+        block_hash = self._media_offsets.block_hash
+        hashes = self._hashes
+        changes = list()
+        for hash_index in hash_indexes:
+            hex_hash = block_hash(hash_index)
+            flags = _hash_flags(hex_hash, hashes[hex_hash], filter_state)
+            old_flags = (hash_counts.is_ignored[hash_index],
+                         hash_counts.is_highlighted[hash_index])
+            if flags != old_flags:
+                hash_counts.set_flags(hash_index, *flags)
+                changes.append((hash_index,) + old_flags + flags)
+
+        # apply bucket contribution changes
+        if changes:
+            hash_counts.generation += 1
+            self._update_pyramid(changes)
+
+        return hash_counts
+
+    def calculate_bucket_data(self, start_offset, bytes_per_bucket,
+                              num_buckets):
+        """Calculate bucket data for the current hash counts, combining
+        pyramid tiles else binning the matches directly.
+
+        Returns:
+          (source_buckets, ignored_source_buckets,
+          highlighted_source_buckets) lists of num_buckets counts.
+        """
+        if bytes_per_bucket == 0:
+            # no data
+            return ([0] * num_buckets, [0] * num_buckets, [0] * num_buckets)
+
+        bucket_data = self.histogram_pyramid().bucket_data(
+                             start_offset, bytes_per_bucket, num_buckets)
+        if bucket_data is None:
+            bucket_data = histogram_engine.calculate_bucket_data(
+                                     self._media_offsets, self.hash_counts,
+                                     start_offset, bytes_per_bucket,
+                                     num_buckets)
+        return bucket_data
+
+    def histogram_pyramid(self):
+        """Return the histogram pyramid for the current hash counts."""
+        if self._histogram_pyramid is None:
+            self._histogram_pyramid = HistogramPyramid(self._media_offsets,
+                                   self.hash_counts, self._sector_size,
+                                   self._media_size)
+        return self._histogram_pyramid
+
+    def _calculate_all(self):
+        counts = list()
+        is_ignored = list()
+        is_highlighted = list()
+        hashes = self._hashes
+        filter_state = self._filter_state
+
+        # also make the reverse source index on the first pass
+        if self._source_hash_indexes is None:
+            source_hash_indexes = defaultdict(list)
+        else:
+            source_hash_indexes = None
+
+        for hash_index, block_hash in enumerate(
+                                      self._media_offsets.block_hashes()):
+            hash_data = hashes[block_hash]
+            flags = _hash_flags(block_hash, hash_data, filter_state)
+            counts.append(hash_data["count"])
+            is_ignored.append(flags[0])
+            is_highlighted.append(flags[1])
+            if source_hash_indexes is not None:
+                for source_hash in hash_data["source_hashes"]:
+                    source_hash_indexes[source_hash].append(hash_index)
+
+        if source_hash_indexes is not None:
+            self._source_hash_indexes = dict(source_hash_indexes)
+
+        generation = self.hash_counts.generation + 1 \
+                              if self.hash_counts is not None else 0
+        self.hash_counts = HashCounts(counts, is_ignored, is_highlighted)
+        self.hash_counts.generation = generation
+
+        # rebuild the histogram pyramid when next used
+        self._histogram_pyramid = None
+
+    def _update_pyramid(self, changes):
+        # nothing to update if the pyramid has not been built
+        if self._histogram_pyramid is None:
+            return
+
+        # without NumPy, rebuild the pyramid when next used
+        if numpy is None:
+            self._histogram_pyramid = None
+            return
+
+        # per-hash changes in ignored and highlighted counts
+        counts = self.hash_counts.arrays()[0]
+        changed = numpy.zeros(len(counts), dtype=bool)
+        ignored_deltas = numpy.zeros(len(counts), dtype=numpy.int64)
+        highlighted_deltas = numpy.zeros(len(counts), dtype=numpy.int64)
+        for hash_index, old_ignored, old_highlighted, is_ignored, \
+                                         is_highlighted in changes:
+            changed[hash_index] = True
+            ignored_deltas[hash_index] = counts[hash_index] * \
+                                       (int(is_ignored) - int(old_ignored))
+            highlighted_deltas[hash_index] = counts[hash_index] * \
+                               (int(is_highlighted) - int(old_highlighted))
+
+        # the matches of the changed hashes
+        offsets = numpy.frombuffer(self._media_offsets.offsets, dtype="u%d" %
+                                   self._media_offsets.offsets.itemsize)
+        hash_indexes = numpy.frombuffer(self._media_offsets.hash_indexes,
+                   dtype="u%d" % self._media_offsets.hash_indexes.itemsize)
+        selected = changed[hash_indexes]
+        match_hash_indexes = hash_indexes[selected]
+        self._histogram_pyramid.add(offsets[selected],
+                                    ignored_deltas[match_hash_indexes],
+                                    highlighted_deltas[match_hash_indexes])
@@ -7,6 +7,9 @@ from icon_path import icon_path
 from tooltip import Tooltip
 from math import log, floor, log10, pow, ceil
 from annotation_view import AnnotationView
+import histogram_raster
+from render_scheduler import RenderScheduler
+from histogram_worker import HistogramWorker
 try:
     import tkinter
 except ImportError:
@@ -23,9 +26,15 @@ class HistogramBar():
       _photo_image(PhotoImage): The image on which the plot is rendered.
       _histogram_control(HistogramControl): The start_offset,
         bytes_per_bucket, and associated bar dimension methods.
-      _hash_counts(map<hash, (count, is_ignored, is_highlighted)>):
-        Cached from and used by data_manager.
+      _source_buckets, _ignored_source_buckets,
+        _highlighted_source_buckets(list<int>): Bucket data of the drawn
+        graph, calculated by the histogram worker.
       _valid_bucket_range(tuple(first, last)): Vaid bucket endpoints.
+      render_scheduler(RenderScheduler): Coalesces change events into one
+        draw per idle cycle, counting executed and dropped draws.
+      histogram_worker(HistogramWorker): Calculates bucket data in a
+        background thread, posting the newest result back to draw, and
+        caches and prefetches bucket data of nearby plot regions.
 
     Notes about offset alignment:
       The start and end offsets may be any value, even fractional.
@@ -126,6 +135,30 @@ class HistogramBar():
                              histogram_constants.HISTOGRAM_Y_OFFSET,
                              anchor=tkinter.NW, image=self._photo_image)
 
+        # the cursor marker, a canvas line over the photo_image so moving it
+        # does not repaint any bars
+        self._cursor_marker_id = self._c.create_line(0, 0, 0, 0,
+                                    fill="red", state=tkinter.HIDDEN)
+
+        # the range selection pixel columns drawn, else None
+        self._range_pixels = None
+
+        # bucket data, empty until the histogram worker calculates it
+        num_buckets = self._histogram_control.num_buckets
+        self._source_buckets = [0] * num_buckets
+        self._ignored_source_buckets = [0] * num_buckets
+        self._highlighted_source_buckets = [0] * num_buckets
+        self._y_scale = 1
+
+        # whether the bucket data is outdated until a requested result
+        # arrives
+        self._is_bucket_data_pending = False
+
+        # bar heights and pixel colors for rasterizing the histogram
+        self._bar_heights = None
+        self._raster_bucket_range = None
+        self._bar_colors = None
+
         # start offset
         self._start_offset_id = self._c.create_text(
                                       histogram_constants.HISTOGRAM_X_OFFSET,
@@ -178,6 +211,13 @@ class HistogramBar():
                       x0, y0, w, h, self._histogram_control,
                       self._data_manager, annotation_filter)
 
+        # draw change events once per idle cycle
+        self.render_scheduler = RenderScheduler(self._c, self._draw)
+
+        # calculate bucket data off the Tk thread
+        self.histogram_worker = HistogramWorker(self._c, self._data_manager,
+                                                self._handle_bucket_data)
+
         # register to receive data manager change events
         data_manager.set_callback(self._handle_data_manager_change)
 
@@ -194,15 +234,32 @@ class HistogramBar():
         # set to basic initial state
         self._draw("data_changed")
 
-    def _calculate_bucket_data(self):
-        (self._source_buckets, self._ignored_source_buckets,
-         self._highlighted_source_buckets) = \
-                      self._data_manager.calculate_bucket_data(
-                                    self._hash_counts,
+    def _request_bucket_data(self):
+        # calculate bucket data in the background, superseding any request
+        # still outstanding, and draw the graph when the result arrives,
+        # which may be before request returns
+        self._is_bucket_data_pending = True
+        self.histogram_worker.request(
                                     self._histogram_control.start_offset,
                                     self._histogram_control.bytes_per_bucket,
                                     self._histogram_control.num_buckets)
 
+    # this function is called by the histogram worker on the Tk thread
+    def _handle_bucket_data(self, bucket_request, bucket_data):
+        (self._source_buckets, self._ignored_source_buckets,
+         self._highlighted_source_buckets) = bucket_data
+        self._is_bucket_data_pending = False
+        self._valid_bucket_range = self._histogram_control.valid_bucket_range()
+        self._calculate_y_scale()
+        self._draw_all_text()
+        self._draw_graph()
+        self._draw_cursor_marker()
+
+        # prefetch the next likely zooms and pans while the worker is idle
+        self.histogram_worker.prefetch(
+                           self._histogram_control.predicted_plot_regions(),
+                           self._histogram_control.num_buckets)
+
     def _calculate_y_scale(self):
         if self._preferences.auto_y_scale:
             # find bar with biggest count
@@ -239,22 +296,22 @@ class HistogramBar():
     # this function is registered to and called by HistogramControl
     def _handle_histogram_control_change(self, *args):
         # cursor_moved, range_changed, plot_region_changed
-        self._draw(self._histogram_control.change_type)
+        self.render_scheduler.schedule(self._histogram_control.change_type)
 
     # this function is registered to and called by Preferences
     def _handle_preferences_change(self, *args):
         # preferences_changed
-        self._draw("preferences_changed")
+        self.render_scheduler.schedule("preferences_changed")
 
     # this function is registered to and called by FitRangeSelection
     def _handle_fit_range_selection(self, *args):
-        # fit_range
-        self._draw("fit_range")
+        # fit the plot region now, which fires plot_region_changed
+        self._histogram_control.fit_range()
 
     # this function is registered to and called by the data manager
     def _handle_data_manager_change(self, *args):
-        # data_changed or filter_changed
-        self._draw(self._data_manager.change_type)
+        # data_changed, data_appended, or filter_changed
+        self.render_scheduler.schedule(self._data_manager.change_type)
 
     def _draw(self, change_mode):
         # draw text based on change mode, then redraw the graph
@@ -264,47 +321,27 @@ class HistogramBar():
         elif change_mode == "range_changed":
             self._draw_cursor_and_range_text()
 
-        elif change_mode == "plot_region_changed":
-            self._calculate_bucket_data()
-            self._calculate_y_scale()
-            self._draw_all_text()
-            self._valid_bucket_range = \
-                             self._histogram_control.valid_bucket_range()
-
         elif change_mode == "preferences_changed":
             self._calculate_y_scale()
             self._draw_all_text()
 
-        elif change_mode == "fit_range":
-            self._histogram_control.fit_range()
-            self._calculate_bucket_data()
-            self._calculate_y_scale()
-            self._draw_all_text()
-            self._valid_bucket_range = \
-                             self._histogram_control.valid_bucket_range()
-
-        elif change_mode == "filter_changed":
-            self._hash_counts = self._data_manager.calculate_hash_counts()
-            self._calculate_bucket_data()
-            self._calculate_y_scale()
-            self._draw_all_text()
-
-        elif change_mode == "data_changed":
-            self._hash_counts = self._data_manager.calculate_hash_counts()
-            self._calculate_bucket_data()
-            self._calculate_y_scale()
-            self._draw_all_text()
-            self._valid_bucket_range = \
-                             self._histogram_control.valid_bucket_range()
+        elif change_mode in ("plot_region_changed", "filter_changed",
+                             "data_appended", "data_changed"):
+            # the text, graph, and cursor marker are drawn together when
+            # the bucket data arrives
+            self._request_bucket_data()
+            return
 
         else:
             raise RuntimeError("program error in mode '%s'" % change_mode)
 
-        # draw the histogram graph
-        self._draw_clear()
-        self._draw_range_selection()
-        self._draw_x_axis()
-        self._draw_buckets()
+        # draw the histogram graph, repainting only the columns whose
+        # range selection changed for range changes and nothing for cursor
+        # moves
+        if change_mode == "range_changed":
+            self._draw_range_selection_change()
+        elif change_mode != "cursor_moved":
+            self._draw_graph()
         self._draw_cursor_marker()
 
     def _draw_cursor_text(self):
@@ -325,7 +362,10 @@ class HistogramBar():
             self._c.itemconfigure(self._cursor_offset_id, text="")
 
         # cursor bucket count
-        if self._histogram_control.is_valid_cursor and \
+        if self._is_bucket_data_pending:
+            # the buckets are for a previous plot region or filter
+            self._bucket_count_label['text'] = "Bar matches: ..."
+        elif self._histogram_control.is_valid_cursor and \
                               self._histogram_control.offset_is_on_bucket(
                               self._histogram_control.cursor_offset):
             # bucket count at cursor
@@ -404,144 +444,111 @@ class HistogramBar():
         self._c.itemconfigure(self._marker3_id, text=int_string(
                                                            self._y_scale*100))
 
-    # clear histogram graph
-    def _draw_clear(self):
+    # the photo_image pixel columns [x1, x2) of the range selection
+    def _range_selection_pixels(self):
+        if not self._histogram_control.is_valid_range:
+            return None
+        num_buckets = self._histogram_control.num_buckets
 
-        # clear any previous content
-        self._photo_image.put("white",
-                          to=(0,0,self._histogram_control.histogram_bar_width,
-                                    histogram_constants.HISTOGRAM_BAR_HEIGHT))
+        # get bucket 1 value
+        b1 = self._histogram_control.offset_to_bucket(
+                                       self._histogram_control.range_start)
+        if b1 < 0: b1 = 0
+        if b1 > num_buckets: b1 = num_buckets
+        x1 = b1 * histogram_constants.BUCKET_WIDTH
 
-    # draw black x axis across bottom
-    def _draw_x_axis(self):
-        self._photo_image.put(colors.X_AXIS,
-                         to=(0, histogram_constants.HISTOGRAM_BAR_HEIGHT,
-                         self._histogram_control.histogram_bar_width,
-                         histogram_constants.HISTOGRAM_BAR_HEIGHT-1))
+        # get bucket b2 value
+        b2 = self._histogram_control.offset_to_bucket(
+                                       self._histogram_control.range_stop)
+        if b2 < 0: b2 = 0
+        if b2 > num_buckets: b2 = num_buckets
+        x2 = b2 * histogram_constants.BUCKET_WIDTH
 
-    # draw the range selection
-    def _draw_range_selection(self):
-        if self._histogram_control.is_valid_range:
-            num_buckets = self._histogram_control.num_buckets
-
-            # get bucket 1 value
-            b1 = self._histogram_control.offset_to_bucket(
-                                           self._histogram_control.range_start)
-            if b1 < 0: b1 = 0
-            if b1 > num_buckets: b1 = num_buckets
-            x1 = b1 * histogram_constants.BUCKET_WIDTH
-
-            # get bucket b2 value
-            b2 = self._histogram_control.offset_to_bucket(
-                                           self._histogram_control.range_stop)
-            if b2 < 0: b2 = 0
-            if b2 > num_buckets: b2 = num_buckets
-            x2 = b2 * histogram_constants.BUCKET_WIDTH
-
-            # keep range from becoming too narrow to plot
-            if x2 == x1: x2 += 1
-
-            # fill the range with the range selection color
-            self._photo_image.put(colors.RANGE,
-                    to=(x1, 0, x2, histogram_constants.HISTOGRAM_BAR_HEIGHT))
-
-    # draw all the buckets
-    def _draw_buckets(self):
-        # skip empty initial-state data
-        if self._histogram_control.bytes_per_bucket == -1:
-            return
-
-        # valid bucket boundaries map inside the photo image
-        leftmost_bucket, rightmost_bucket = self._valid_bucket_range
-
-        # draw the buckets
-        for bucket in range(self._histogram_control.num_buckets):
-
-            # bucket view depends on whether byte offset is in range
-            if bucket >= leftmost_bucket and bucket <= rightmost_bucket:
-                self._draw_bucket(bucket)
-            else:
-                self._draw_gray_bucket(bucket)
-
-    """Calculate clipped bar height in pixels, using count, Y scale,
-      and bucket height multiplier."""
-    def _bar_height(self, count):
-        h = int(count * histogram_constants.BUCKET_HEIGHT_MULTIPLIER //
-                                                self._y_scale)
-
-        # make small value visible
-        if h == 0 and count > 0:
-            h = 1
+        # keep range from becoming too narrow to plot
+        if x2 == x1: x2 += 1
 
-        # clip to keep in range
-        if h > int(histogram_constants.HISTOGRAM_BAR_HEIGHT):
-            h = int(histogram_constants.HISTOGRAM_BAR_HEIGHT)
+        return (x1, x2)
 
-        return h
+    # draw the whole histogram graph with one put
+    def _draw_graph(self):
+        num_buckets = self._histogram_control.num_buckets
+        self._range_pixels = self._range_selection_pixels()
 
-    # draw one bar for one bucket
-    def _draw_bar(self, color, count, i):
-
-        # do not plot bars when count==0
-        if not count:
+        if self._histogram_control.bytes_per_bucket == -1:
+            # empty initial-state data
+            no_bars = [0] * num_buckets
+            self._bar_heights = (no_bars, no_bars, no_bars)
+            self._raster_bucket_range = (0, num_buckets - 1)
+        else:
+            # bar heights of all sources with ignored sources removed, of
+            # all sources for the tick, and of highlighted sources
+            self._bar_heights = (
+                    histogram_raster.bar_heights([
+                             count - ignored_count for count, ignored_count
+                             in zip(self._source_buckets,
+                                    self._ignored_source_buckets)],
+                             self._y_scale),
+                    histogram_raster.bar_heights(self._source_buckets,
+                                                 self._y_scale),
+                    histogram_raster.bar_heights(
+                             self._highlighted_source_buckets,
+                             self._y_scale))
+            self._raster_bucket_range = self._valid_bucket_range
+
+        self._draw_bucket_columns(0, num_buckets)
+
+    # repaint the buckets whose columns enter or leave the range selection
+    def _draw_range_selection_change(self):
+        old_range_pixels = self._range_pixels
+        self._range_pixels = self._range_selection_pixels()
+        if old_range_pixels == self._range_pixels:
             return
 
-        # get coordinates
-        x=(i * histogram_constants.BUCKET_WIDTH)
-        y = self._bar_height(count)
-
-        # plot rectangle
-        self._photo_image.put(color, to=(
-             x,
-             histogram_constants.HISTOGRAM_BAR_HEIGHT,
-             x+histogram_constants.BUCKET_WIDTH,
-             histogram_constants.HISTOGRAM_BAR_HEIGHT - y))
-
-    # draw one tick mark for one bucket, see draw_bar
-    def _draw_tick(self, color, count, i):
-
-        # do not plot bars when count==0
-        if not count:
+        # pixel columns in one range selection but not the other
+        changed = list()
+        if old_range_pixels and self._range_pixels:
+            (a1, a2), (b1, b2) = old_range_pixels, self._range_pixels
+            if a2 <= b1 or b2 <= a1:
+                changed = [(a1, a2), (b1, b2)]
+            else:
+                changed = [(min(a1, b1), max(a1, b1)),
+                           (min(a2, b2), max(a2, b2))]
+        else:
+            changed = [old_range_pixels or self._range_pixels]
+
+        # repaint the buckets covering the changed columns
+        for x1, x2 in changed:
+            if x1 < x2:
+                self._draw_bucket_columns(
+                             x1 // histogram_constants.BUCKET_WIDTH,
+                             -(-x2 // histogram_constants.BUCKET_WIDTH))
+
+    # rasterize buckets [first_bucket, stop_bucket) and put them with one
+    # Tcl call
+    def _draw_bucket_columns(self, first_bucket, stop_bucket):
+        stop_bucket = min(stop_bucket, self._histogram_control.num_buckets)
+        if first_bucket >= stop_bucket:
             return
-
-        # get coordinates
-        x=(i * histogram_constants.BUCKET_WIDTH)
-        y = self._bar_height(count)
-
-        # plot rectangle
-        self._photo_image.put(color, to=(
-             x,
-             histogram_constants.HISTOGRAM_BAR_HEIGHT - y + 1,
-             x+histogram_constants.BUCKET_WIDTH,
-             histogram_constants.HISTOGRAM_BAR_HEIGHT - y))
-
-    # draw all bars for one bucket
-    def _draw_bucket(self, i):
-
-        # all sources with ignored sources removed: light blue bar
-        self._draw_bar(colors.ALL_LIGHTER,
-                    self._source_buckets[i] -
-                    self._ignored_source_buckets[i], i)
-
-        # all sources: light blue tick
-        self._draw_tick(colors.ALL_LIGHTER,
-                    self._source_buckets[i], i)
-
-        # highlighted matches: light green bar
-        self._draw_bar(colors.HIGHLIGHTED_LIGHTER,
-                    self._highlighted_source_buckets[i], i)
-
-    # draw one gray bucket for out-of-range data
-    def _draw_gray_bucket(self, i):
-        # x pixel coordinate
-        x=(i * histogram_constants.BUCKET_WIDTH)
-
-        # out of range so fill bucket area gray
-        self._photo_image.put("gray",
-                                to=(x, 0, x+histogram_constants.BUCKET_WIDTH,
-                                   histogram_constants.HISTOGRAM_BAR_HEIGHT))
-
-    # draw the cursor marker
+        all_heights, tick_heights, highlighted_heights = self._bar_heights
+        self._photo_image.put(histogram_raster.rasterize(
+                       first_bucket, stop_bucket, self._range_pixels,
+                       self._raster_bucket_range, all_heights, tick_heights,
+                       highlighted_heights, self._get_bar_colors()),
+                       to=(first_bucket * histogram_constants.BUCKET_WIDTH,
+                           0))
+
+    # the bar pixel colors, from Tk color names
+    def _get_bar_colors(self):
+        if self._bar_colors is None:
+            def _rgb(color):
+                return histogram_raster.rgb(self._c.winfo_rgb(color))
+            self._bar_colors = histogram_raster.BarColors(
+                       _rgb("white"), _rgb(colors.RANGE),
+                       _rgb(colors.X_AXIS), _rgb(colors.ALL_LIGHTER),
+                       _rgb(colors.HIGHLIGHTED_LIGHTER), _rgb("gray"))
+        return self._bar_colors
+
+    # place the cursor marker
     def _draw_cursor_marker(self):
         if self._histogram_control.is_valid_cursor:
             x = self._histogram_control.offset_to_bucket(
@@ -550,6 +557,19 @@ class HistogramBar():
             # zz
             if x < 0:
                 x = 0
-            self._photo_image.put("red", to=(x, 0, x+1,
-                                   histogram_constants.HISTOGRAM_BAR_HEIGHT))
 
+            # clip to the plot region as the photo_image does
+            if x >= self._histogram_control.histogram_bar_width:
+                self._c.itemconfigure(self._cursor_marker_id,
+                                      state=tkinter.HIDDEN)
+                return
+            x += histogram_constants.HISTOGRAM_X_OFFSET
+            self._c.coords(self._cursor_marker_id,
+                           x, histogram_constants.HISTOGRAM_Y_OFFSET,
+                           x, histogram_constants.HISTOGRAM_Y_OFFSET +
+                              histogram_constants.HISTOGRAM_BAR_HEIGHT)
+            self._c.itemconfigure(self._cursor_marker_id,
+                                  state=tkinter.NORMAL)
+        else:
+            self._c.itemconfigure(self._cursor_marker_id,
+                                  state=tkinter.HIDDEN)
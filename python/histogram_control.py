@@ -391,6 +391,15 @@ class HistogramControl():
     def _zoom(self, ratio):
         """Recalculate start offset and bytes per bucket."""
 
+        new_start_offset, new_bytes_per_bucket = self._zoom_region(ratio)
+
+        if self._inside_graph(new_start_offset, new_bytes_per_bucket):
+            # accept the zoom
+            self._set_plot_region(new_start_offset, new_bytes_per_bucket)
+
+    def _zoom_region(self, ratio):
+        # the (start offset, bytes per bucket) plot region of a zoom
+
         # get the zoom origin bucket
         zoom_origin_bucket = self.offset_to_bucket(self.cursor_offset)
 
@@ -413,9 +422,20 @@ class HistogramControl():
         new_start_offset = (self._round_down_to_block(self.cursor_offset -
                                    new_bytes_per_bucket * zoom_origin_bucket))
 
-        if self._inside_graph(new_start_offset, new_bytes_per_bucket):
-            # accept the zoom
-            self._set_plot_region(new_start_offset, new_bytes_per_bucket)
+        return new_start_offset, new_bytes_per_bucket
+
+    def predicted_plot_regions(self):
+        """Return the (start offset, bytes per bucket) plot regions the
+        user is likely to ask for next: zoom in and zoom out at the cursor,
+        then pan one screen left and right."""
+        if self.bytes_per_bucket <= 0:
+            return list()
+        screen = self.bytes_per_bucket * self.num_buckets
+        regions = [self._zoom_region(0.67), self._zoom_region(1.0 / 0.67),
+                   (self.start_offset - screen, self.bytes_per_bucket),
+                   (self.start_offset + screen, self.bytes_per_bucket)]
+        return [region for region in regions
+                if self._inside_graph(*region)]
 
     # ############################################################
     # cursor moved
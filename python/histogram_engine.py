@@ -0,0 +1,161 @@
+from math import ceil
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+class HashCounts():
+    """Count information for each hash, indexed by MediaOffsets hash index.
+
+    Attributes:
+      counts(list<int>): The source count for each hash.
+      is_ignored(list<bool>): Whether each hash is ignored.
+      is_highlighted(list<bool>): Whether each hash is highlighted.
+      generation(int): Incremented when the hash counts change.
+    """
+
+    def __init__(self, counts, is_ignored, is_highlighted):
+        self.counts = counts
+        self.is_ignored = is_ignored
+        self.is_highlighted = is_highlighted
+        self.generation = 0
+
+        # NumPy copies of the columns, made on first use
+        self._arrays = None
+
+    def __len__(self):
+        return len(self.counts)
+
+    def __getitem__(self, hash_index):
+        return (self.counts[hash_index], self.is_ignored[hash_index],
+                self.is_highlighted[hash_index])
+
+    def set_flags(self, hash_index, is_ignored, is_highlighted):
+        """Set the is_ignored and is_highlighted values of one hash."""
+        self.is_ignored[hash_index] = is_ignored
+        self.is_highlighted[hash_index] = is_highlighted
+        if self._arrays is not None:
+            self._arrays[1][hash_index] = is_ignored
+            self._arrays[2][hash_index] = is_highlighted
+
+    def extend(self, counts, is_ignored, is_highlighted):
+        """Append the count information of appended hashes."""
+        self.counts.extend(counts)
+        self.is_ignored.extend(is_ignored)
+        self.is_highlighted.extend(is_highlighted)
+        if self._arrays is not None:
+            self._arrays = tuple(numpy.concatenate((column, numpy.array(
+                               values, dtype=column.dtype))) for column,
+                               values in zip(self._arrays, (counts,
+                               is_ignored, is_highlighted)))
+
+    def arrays(self):
+        """Return the count, is_ignored, and is_highlighted columns as
+        NumPy arrays.  Requires NumPy."""
+        if self._arrays is None:
+            self._arrays = (numpy.array(self.counts, dtype=numpy.int64),
+                            numpy.array(self.is_ignored, dtype=bool),
+                            numpy.array(self.is_highlighted, dtype=bool))
+        return self._arrays
+
+def _offset_bounds(start_offset, bytes_per_bucket, num_buckets):
+    # the [low, high) integer media offset range that maps onto buckets
+    low = max(0, int(ceil(start_offset)))
+    high = max(0, int(ceil(start_offset + bytes_per_bucket * num_buckets)))
+    return low, high
+
+def _numpy_bucket_data(media_offsets, hash_counts, start_offset,
+                       bytes_per_bucket, num_buckets):
+    # views of the media offset columns
+    offsets = numpy.frombuffer(media_offsets.offsets, dtype="u%d" %
+                               media_offsets.offsets.itemsize)
+    hash_indexes = numpy.frombuffer(media_offsets.hash_indexes, dtype="u%d" %
+                               media_offsets.hash_indexes.itemsize)
+
+    # bisect to the offsets that map onto buckets
+    low, high = _offset_bounds(start_offset, bytes_per_bucket, num_buckets)
+    i0 = int(offsets.searchsorted(numpy.uint64(low)))
+    i1 = int(offsets.searchsorted(numpy.uint64(high)))
+
+    # bucket for each offset, using integer math when the plot region is
+    # integral to match the pure Python calculation exactly
+    if isinstance(start_offset, int) and isinstance(bytes_per_bucket, int):
+        buckets = (offsets[i0:i1].astype(numpy.int64) - start_offset) // \
+                                                       bytes_per_bucket
+    else:
+        buckets = numpy.floor_divide(offsets[i0:i1].astype(numpy.float64) -
+                                     start_offset, bytes_per_bucket)
+    buckets = buckets.astype(numpy.intp)
+    in_range = (buckets >= 0) & (buckets < num_buckets)
+    buckets = buckets[in_range]
+    match_hash_indexes = hash_indexes[i0:i1][in_range]
+
+    # weigh each match by its hash count
+    counts, is_ignored, is_highlighted = hash_counts.arrays()
+    weights = counts[match_hash_indexes]
+
+    def _bincount(bucket_weights):
+        return numpy.bincount(buckets, weights=bucket_weights,
+                              minlength=num_buckets)[:num_buckets] \
+                              .astype(numpy.int64).tolist()
+
+    return (_bincount(weights),
+            _bincount(weights * is_ignored[match_hash_indexes]),
+            _bincount(weights * is_highlighted[match_hash_indexes]))
+
+def _python_bucket_data(media_offsets, hash_counts, start_offset,
+                        bytes_per_bucket, num_buckets):
+    # initialize empty buckets for each data type tracked
+    source_buckets = [0] * num_buckets
+    ignored_source_buckets = [0] * num_buckets
+    highlighted_source_buckets = [0] * num_buckets
+
+    # bisect to the offsets that map onto buckets
+    i0, i1 = media_offsets.index_range(*_offset_bounds(
+                           start_offset, bytes_per_bucket, num_buckets))
+
+    # optimization: make local references to hash count columns
+    counts = hash_counts.counts
+    is_ignored = hash_counts.is_ignored
+    is_highlighted = hash_counts.is_highlighted
+
+    # calculate the histogram
+    for offset, hash_index in zip(media_offsets.offsets[i0:i1],
+                                  media_offsets.hash_indexes[i0:i1]):
+        bucket = int((offset - start_offset) // bytes_per_bucket)
+
+        if bucket < 0 or bucket >= num_buckets:
+            # offset is out of range of buckets
+            continue
+
+        # hash and source buckets
+        count = counts[hash_index]
+        source_buckets[bucket] += count
+
+        # ignored hash and source buckets
+        if is_ignored[hash_index]:
+            ignored_source_buckets[bucket] += count
+
+        # highlighted hash and source buckets
+        if is_highlighted[hash_index]:
+            highlighted_source_buckets[bucket] += count
+
+    return (source_buckets, ignored_source_buckets,
+            highlighted_source_buckets)
+
+def calculate_bucket_data(media_offsets, hash_counts, start_offset,
+                          bytes_per_bucket, num_buckets):
+    """Calculate bucket data using NumPy if available else pure Python.
+
+    Returns:
+      source_buckets(List): List of num_buckets source count values.
+      ignored_source_buckets(List): List of num_buckets source count values.
+      highlighted_source_buckets(List): List of num_buckets source count
+        values.
+    """
+    if numpy is not None:
+        return _numpy_bucket_data(media_offsets, hash_counts, start_offset,
+                                  bytes_per_bucket, num_buckets)
+    else:
+        return _python_bucket_data(media_offsets, hash_counts, start_offset,
+                                   bytes_per_bucket, num_buckets)
@@ -0,0 +1,309 @@
+from numbers import Integral
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+# the most tiles kept in the finest pyramid level
+MAX_TILES = 1 << 20 if numpy is not None else 1 << 16
+
+# tiles combined per bucket when a fine enough level is available
+TILES_PER_BUCKET = 32
+
+class HistogramPyramid():
+    """Precomputed total, ignored, and highlighted count tiles at
+    power-of-two multiples of the sector size.
+
+    The finest level uses the smallest sector-aligned tile size that keeps
+    the level within MAX_TILES tiles.  Each coarser level sums pairs of
+    tiles from the level below it.  A bucket request is answered from the
+    coarsest level with at least TILES_PER_BUCKET tiles per bucket, so its
+    cost depends on the number of buckets rather than the number of
+    matches.  Buckets narrower than that are answered from the finest
+    level only when they align with its tiles.
+
+    Tiles that lie within one bucket are counted whole.  Tiles split by a
+    bucket boundary are counted from their matches, so counts are exact
+    wherever the boundaries fall.  Plot regions that do not fall on whole
+    bytes are left to direct binning.
+
+    Attributes:
+      levels(list<(tile_size, totals, ignored, highlighted)>): Pyramid
+        levels from finest to coarsest.
+    """
+
+    def __init__(self, media_offsets, hash_counts, sector_size, media_size):
+        """Args:
+          media_offsets(MediaOffsets): The matched media offsets.
+          hash_counts(HashCounts): The count columns to tile.
+          sector_size(int): The finest tile size.
+          media_size(int): Size in bytes of the media image.
+        """
+        self.levels = list()
+        self._media_offsets = media_offsets
+        self._hash_counts = hash_counts
+
+        # the finest tile size
+        offsets = media_offsets.offsets
+        extent = max(media_size, offsets[-1] + 1 if len(offsets) else 0, 1)
+        tile_size = max(sector_size, 1)
+        while (extent + tile_size - 1) // tile_size > MAX_TILES:
+            tile_size *= 2
+        num_tiles = (extent + tile_size - 1) // tile_size
+
+        # the finest level
+        columns = self._tiles(media_offsets, 0, hash_counts, tile_size,
+                              num_tiles)
+        self.levels.append((tile_size,) + columns)
+
+        # coarser levels until one tile covers the media
+        while num_tiles > 1:
+            tile_size *= 2
+            num_tiles = (num_tiles + 1) // 2
+            columns = tuple(self._pair_sum(column) for column in columns)
+            self.levels.append((tile_size,) + columns)
+
+    def __repr__(self):
+        return "HistogramPyramid(levels: %d, finest tile size: %d, " \
+               "finest tiles: %d)" % (len(self.levels), self.levels[0][0],
+                                      len(self.levels[0][1]))
+
+    @staticmethod
+    def _tiles(media_offsets, start, hash_counts, tile_size, num_tiles):
+        # the total, ignored, and highlighted tiles of the matches of
+        # media_offsets from index start on
+        if numpy is not None:
+            offsets = numpy.frombuffer(media_offsets.offsets, dtype="u%d" %
+                                       media_offsets.offsets.itemsize)
+            hash_indexes = numpy.frombuffer(media_offsets.hash_indexes,
+                       dtype="u%d" % media_offsets.hash_indexes.itemsize)
+            return HistogramPyramid._numpy_tiles(offsets[start:],
+                       hash_indexes[start:], hash_counts, tile_size,
+                       num_tiles)
+        return HistogramPyramid._python_tiles(
+                       media_offsets.offsets[start:],
+                       media_offsets.hash_indexes[start:], hash_counts,
+                       tile_size, num_tiles)
+
+    @staticmethod
+    def _numpy_tiles(offsets, hash_indexes, hash_counts, tile_size,
+                     num_tiles):
+        tiles = (offsets // numpy.uint64(tile_size)).astype(numpy.intp)
+        counts, is_ignored, is_highlighted = hash_counts.arrays()
+        weights = counts[hash_indexes]
+
+        def _bincount(tile_weights):
+            return numpy.bincount(tiles, weights=tile_weights,
+                           minlength=num_tiles).astype(numpy.int64)
+
+        return (_bincount(weights),
+                _bincount(weights * is_ignored[hash_indexes]),
+                _bincount(weights * is_highlighted[hash_indexes]))
+
+    @staticmethod
+    def _python_tiles(offsets, hash_indexes, hash_counts, tile_size,
+                      num_tiles):
+        totals = [0] * num_tiles
+        ignored = [0] * num_tiles
+        highlighted = [0] * num_tiles
+        counts = hash_counts.counts
+        is_ignored = hash_counts.is_ignored
+        is_highlighted = hash_counts.is_highlighted
+        for offset, hash_index in zip(offsets, hash_indexes):
+            tile = offset // tile_size
+            count = counts[hash_index]
+            totals[tile] += count
+            if is_ignored[hash_index]:
+                ignored[tile] += count
+            if is_highlighted[hash_index]:
+                highlighted[tile] += count
+        return (totals, ignored, highlighted)
+
+    @staticmethod
+    def _pair_sum(column):
+        # sum adjacent pairs of tiles, padding an odd last tile
+        if numpy is not None:
+            if len(column) % 2:
+                column = numpy.append(column, 0)
+            return column[0::2] + column[1::2]
+        else:
+            if len(column) % 2:
+                column = column + [0]
+            return [a + b for a, b in zip(column[0::2], column[1::2])]
+
+    def extend(self, media_offsets, hash_counts, start):
+        """Add the matches of media_offsets from index start on, where
+        media_offsets holds the matches tiled so far followed by appended
+        matches, in offset order, and hash_counts also counts the appended
+        hashes.
+
+        Returns:
+          False, leaving the pyramid unchanged, if an appended match lies
+          past the tiles, else True.
+        """
+        tile_size = self.levels[0][0]
+        num_tiles = len(self.levels[0][1])
+        offsets = media_offsets.offsets
+        if len(offsets) > start and offsets[-1] // tile_size >= num_tiles:
+            return False
+        self._media_offsets = media_offsets
+        self._hash_counts = hash_counts
+
+        # add the tiles of the appended matches to each level
+        columns = self._tiles(media_offsets, start, hash_counts, tile_size,
+                              num_tiles)
+        for level in self.levels:
+            for column, added in zip(level[1:], columns):
+                if numpy is not None:
+                    column += added
+                else:
+                    for tile, count in enumerate(added):
+                        column[tile] += count
+            columns = tuple(self._pair_sum(column) for column in columns)
+        return True
+
+    def add(self, offsets, ignored_deltas, highlighted_deltas):
+        """Add count changes for matches at offsets to the ignored and
+        highlighted tiles of every level.  Requires NumPy.
+
+        Args:
+          offsets(numpy array): Media offsets of the changed matches.
+          ignored_deltas(numpy array): Ignored count change per match.
+          highlighted_deltas(numpy array): Highlighted count change per
+            match.
+        """
+        for tile_size, _, ignored, highlighted in self.levels:
+            tiles = (offsets // numpy.uint64(tile_size)).astype(numpy.intp)
+            numpy.add.at(ignored, tiles, ignored_deltas)
+            numpy.add.at(highlighted, tiles, highlighted_deltas)
+
+    def bucket_data(self, start_offset, bytes_per_bucket, num_buckets):
+        """Calculate bucket data from pyramid tiles.
+
+        Returns:
+          (source_buckets, ignored_source_buckets,
+          highlighted_source_buckets) lists else None if buckets are too
+          narrow to be calculated from the finest tiles or do not fall on
+          whole bytes.
+        """
+        if not isinstance(start_offset, Integral) or \
+                           not isinstance(bytes_per_bucket, Integral):
+            return None
+
+        # use the coarsest level with enough tiles per bucket, else the
+        # finest level if its tiles align with the buckets
+        level = None
+        for candidate in self.levels:
+            if candidate[0] * TILES_PER_BUCKET > bytes_per_bucket:
+                break
+            level = candidate
+        if level is None:
+            finest_tile_size = self.levels[0][0]
+            if start_offset % finest_tile_size or \
+                              bytes_per_bucket % finest_tile_size:
+                return None
+            level = self.levels[0]
+        tile_size = level[0]
+
+        # the tiles that overlap the buckets
+        num_tiles = len(level[1])
+        stop_offset = start_offset + bytes_per_bucket * num_buckets
+        first_tile = max(0, start_offset // tile_size)
+        stop_tile = min(num_tiles, -(-stop_offset // tile_size))
+        if first_tile >= stop_tile:
+            return ([0] * num_buckets, [0] * num_buckets, [0] * num_buckets)
+
+        if numpy is not None:
+            return self._numpy_bucket_data(level, first_tile, stop_tile,
+                             start_offset, bytes_per_bucket, num_buckets)
+        else:
+            return self._python_bucket_data(level, first_tile, stop_tile,
+                             start_offset, bytes_per_bucket, num_buckets)
+
+    def _numpy_bucket_data(self, level, first_tile, stop_tile,
+                           start_offset, bytes_per_bucket, num_buckets):
+        tile_size = level[0]
+
+        # the buckets of the first and last byte of each tile
+        tile_starts = numpy.arange(first_tile, stop_tile,
+                                   dtype=numpy.int64) * tile_size
+        first_buckets = (tile_starts - start_offset) // bytes_per_bucket
+        last_buckets = (tile_starts + (tile_size - 1) - start_offset) // \
+                                                          bytes_per_bucket
+
+        # count tiles within one bucket whole
+        whole = (first_buckets == last_buckets) & (first_buckets >= 0) & \
+                (first_buckets < num_buckets)
+        buckets = first_buckets[whole].astype(numpy.intp)
+        bucket_data = [numpy.bincount(buckets,
+                          weights=column[first_tile:stop_tile][whole],
+                          minlength=num_buckets)[:num_buckets]
+                          .astype(numpy.int64) for column in level[1:]]
+
+        # count the matches of tiles split by a bucket boundary
+        split_starts = tile_starts[first_buckets != last_buckets]
+        if len(split_starts):
+            media_offsets = self._media_offsets
+            offsets = numpy.frombuffer(media_offsets.offsets, dtype="u%d" %
+                                       media_offsets.offsets.itemsize)
+            hash_indexes = numpy.frombuffer(media_offsets.hash_indexes,
+                       dtype="u%d" % media_offsets.hash_indexes.itemsize)
+            i0s = offsets.searchsorted(split_starts.astype(numpy.uint64))
+            i1s = offsets.searchsorted((split_starts + tile_size)
+                                       .astype(numpy.uint64))
+            indexes = numpy.concatenate([numpy.arange(i0, i1, dtype=numpy.intp)
+                                   for i0, i1 in zip(i0s, i1s) if i1 > i0] or
+                                   [numpy.zeros(0, dtype=numpy.intp)])
+            buckets = (offsets[indexes].astype(numpy.int64) - start_offset) \
+                                                       // bytes_per_bucket
+            in_range = (buckets >= 0) & (buckets < num_buckets)
+            buckets = buckets[in_range].astype(numpy.intp)
+            match_hash_indexes = hash_indexes[indexes][in_range]
+            counts, is_ignored, is_highlighted = self._hash_counts.arrays()
+            weights = counts[match_hash_indexes]
+            for column, column_weights in zip(bucket_data, (weights,
+                               weights * is_ignored[match_hash_indexes],
+                               weights * is_highlighted[match_hash_indexes])):
+                column += numpy.bincount(buckets, weights=column_weights,
+                          minlength=num_buckets)[:num_buckets] \
+                          .astype(numpy.int64)
+
+        return tuple(column.tolist() for column in bucket_data)
+
+    def _python_bucket_data(self, level, first_tile, stop_tile,
+                            start_offset, bytes_per_bucket, num_buckets):
+        tile_size = level[0]
+        bucket_data = ([0] * num_buckets, [0] * num_buckets,
+                       [0] * num_buckets)
+        source_buckets, ignored_buckets, highlighted_buckets = bucket_data
+        media_offsets = self._media_offsets
+        counts = self._hash_counts.counts
+        is_ignored = self._hash_counts.is_ignored
+        is_highlighted = self._hash_counts.is_highlighted
+        for tile in range(first_tile, stop_tile):
+            tile_start = tile * tile_size
+            first_bucket = (tile_start - start_offset) // bytes_per_bucket
+            last_bucket = (tile_start + tile_size - 1 - start_offset) // \
+                                                          bytes_per_bucket
+            if first_bucket == last_bucket:
+                # count a tile within one bucket whole
+                if 0 <= first_bucket < num_buckets:
+                    for buckets, column in zip(bucket_data, level[1:]):
+                        buckets[first_bucket] += column[tile]
+                continue
+
+            # count the matches of a tile split by a bucket boundary
+            i0, i1 = media_offsets.index_range(tile_start,
+                                               tile_start + tile_size)
+            for offset, hash_index in zip(media_offsets.offsets[i0:i1],
+                                          media_offsets.hash_indexes[i0:i1]):
+                bucket = (offset - start_offset) // bytes_per_bucket
+                if bucket < 0 or bucket >= num_buckets:
+                    continue
+                count = counts[hash_index]
+                source_buckets[bucket] += count
+                if is_ignored[hash_index]:
+                    ignored_buckets[bucket] += count
+                if is_highlighted[hash_index]:
+                    highlighted_buckets[bucket] += count
+        return bucket_data
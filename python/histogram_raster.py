@@ -0,0 +1,206 @@
+# Rasterize histogram bars into one PPM image so the histogram PhotoImage
+# is updated with a single put instead of several puts per bucket.
+#
+# Rows are built by sweeping down the image, changing only the buckets
+# whose pixels change at each row, so most rows are copies of the row
+# above.  This measured faster than building per-pixel arrays with NumPy.
+
+from collections import defaultdict
+import histogram_constants
+
+def rgb(color_values):
+    """Return the 3-byte RGB pixel for (red, green, blue) 16-bit color
+    values as returned by Tk winfo_rgb."""
+    return bytes(bytearray(value >> 8 for value in color_values))
+
+def bar_heights(counts, y_scale):
+    """Return the clipped bar height in pixels for each count, using the
+    Y scale and bucket height multiplier.  Nonzero counts are at least
+    one pixel high."""
+    height = histogram_constants.HISTOGRAM_BAR_HEIGHT
+    multiplier = histogram_constants.BUCKET_HEIGHT_MULTIPLIER
+    heights = list()
+    for count in counts:
+        h = int(count * multiplier // y_scale)
+        if h == 0 and count > 0:
+            h = 1
+        heights.append(min(h, height))
+    return heights
+
+class BarColors():
+    """The RGB pixels used to rasterize histogram bars.
+
+    Attributes:
+      background, range, x_axis, all, highlighted, gray(bytes): 3-byte RGB
+        pixels for the empty background, the range selection, the x axis,
+        bars of all matches, bars of highlighted matches, and buckets out
+        of range of the media image.
+    """
+    def __init__(self, background, range_, x_axis, all_, highlighted, gray):
+        self.background = background
+        self.range = range_
+        self.x_axis = x_axis
+        self.all = all_
+        self.highlighted = highlighted
+        self.gray = gray
+
+def rasterize(first_bucket, stop_bucket, range_pixels, valid_bucket_range,
+              all_heights, tick_heights, highlighted_heights, bar_colors):
+    """Rasterize buckets [first_bucket, stop_bucket) as a binary PPM image.
+
+    Pixels are as the bars would be drawn in order: the background, the
+    range selection, the x axis along the bottom row, then for each
+    bucket in valid_bucket_range a bar of all matches less ignored
+    matches, a one-pixel tick at the height of all matches, and a bar of
+    highlighted matches, or else a gray fill.
+
+    Args:
+      first_bucket, stop_bucket(int): The buckets to rasterize.
+      range_pixels((x1, x2)): Pixel columns of the range selection, in
+        whole-histogram coordinates, else None.
+      valid_bucket_range((first, last)): The buckets within the media.
+      all_heights, tick_heights, highlighted_heights(list<int>): Bar
+        heights of each bucket of the whole histogram, from bar_heights.
+      bar_colors(BarColors): Pixel colors.
+
+    Returns:
+      bytes: PPM image data, BUCKET_WIDTH pixels per bucket wide.
+    """
+    height = histogram_constants.HISTOGRAM_BAR_HEIGHT
+    bucket_width = histogram_constants.BUCKET_WIDTH
+    width = (stop_bucket - first_bucket) * bucket_width
+    header = ("P6\n%d %d\n255\n" % (width, height)).encode('ascii')
+
+    # range selection columns relative to the first bucket
+    x0 = first_bucket * bucket_width
+    if range_pixels:
+        r1 = min(max(range_pixels[0] - x0, 0), width)
+        r2 = min(max(range_pixels[1] - x0, 0), width)
+    else:
+        r1 = r2 = 0
+
+    # the background row with the range selection, and the x axis row
+    background_row = bytearray(bar_colors.background * width)
+    background_row[r1 * 3:r2 * 3] = bar_colors.range * (r2 - r1)
+    x_axis_row = bar_colors.x_axis * width
+    all_pixels = bar_colors.all * bucket_width
+    highlighted_pixels = bar_colors.highlighted * bucket_width
+    gray_pixels = bar_colors.gray * bucket_width
+
+    def _bucket_pixels(bucket, y, start, stop):
+        # the pixels of one bucket in row y
+        h = highlighted_heights[bucket]
+        if h and y >= height - h:
+            return highlighted_pixels
+        h = tick_heights[bucket]
+        if h and y == height - h:
+            return all_pixels
+        h = all_heights[bucket]
+        if h and y >= height - h:
+            return all_pixels
+        if y == height - 1:
+            return x_axis_row[start:stop]
+        return background_row[start:stop]
+
+    # rows where each bucket's pixels may change
+    row = bytearray(background_row)
+    changes = defaultdict(list)
+    for bucket in range(first_bucket, stop_bucket):
+        start = (bucket - first_bucket) * bucket_width * 3
+        stop = start + bucket_width * 3
+        if bucket < valid_bucket_range[0] or bucket > valid_bucket_range[1]:
+            row[start:stop] = gray_pixels
+            continue
+        change_rows = set((0, height - 1))
+        for h in (all_heights[bucket], highlighted_heights[bucket]):
+            if h:
+                change_rows.add(height - h)
+        h = tick_heights[bucket]
+        if h:
+            change_rows.update((height - h, height - h + 1))
+        for y in change_rows:
+            if y < height:
+                changes[y].append((bucket, start, stop))
+
+    # sweep down the rows, updating only the buckets that change and
+    # reusing unchanged rows
+    rows = list()
+    row_bytes = None
+    for y in range(height):
+        if y in changes or row_bytes is None:
+            for bucket, start, stop in changes.get(y, ()):
+                row[start:stop] = _bucket_pixels(bucket, y, start, stop)
+            row_bytes = bytes(row)
+        rows.append(row_bytes)
+    return header + b"".join(rows)
+
+# main
+if __name__=="__main__":
+    # informal render-time benchmark comparing a PhotoImage.put per bar
+    # with one put of the rasterized image, for several histogram widths.
+    # Without a display only the rasterizing is timed.
+    import time
+    import random
+    try:
+        import tkinter
+    except ImportError:
+        import Tkinter as tkinter
+
+    try:
+        root_window = tkinter.Tk()
+    except tkinter.TclError as e:
+        print("no display, timing rasterizing only: %s" % e)
+        root_window = None
+
+    height = histogram_constants.HISTOGRAM_BAR_HEIGHT
+    bucket_width = histogram_constants.BUCKET_WIDTH
+    bar_colors = BarColors(b"\xff\xff\xff", b"\xcc\xff\xff", b"\0\0\0",
+                           b"\x33\x99\xff", b"\x88\xff\x88", b"\xbe\xbe\xbe")
+    random.seed(1)
+    for num_buckets in (320, 1000, 4000):
+        width = num_buckets * bucket_width
+        source_buckets = [random.randrange(0, 120) for _ in
+                          range(num_buckets)]
+        ignored_source_buckets = [count // 3 for count in source_buckets]
+        highlighted_source_buckets = [count // 4 for count in
+                                      source_buckets]
+
+        # previous puts: clear, x axis, then up to three puts per bucket
+        if root_window is not None:
+            photo_image = tkinter.PhotoImage(width=width, height=height)
+            t0 = time.time()
+            photo_image.put("white", to=(0, 0, width, height))
+            photo_image.put("black", to=(0, height, width, height - 1))
+            heights = bar_heights(source_buckets, 1)
+            for i in range(num_buckets):
+                x = i * bucket_width
+                for color, h in (("#3399ff", heights[i]),
+                                 ("#88ff88", heights[i] // 4)):
+                    if h:
+                        photo_image.put(color, to=(x, height,
+                                        x + bucket_width, height - h))
+                photo_image.put("#3399ff", to=(x, height - heights[i] + 1,
+                                x + bucket_width, height - heights[i]))
+            root_window.update_idletasks()
+            put_time = "%.1f ms" % ((time.time() - t0) * 1000)
+        else:
+            put_time = "not timed"
+
+        # rasterized
+        t0 = time.time()
+        data = rasterize(0, num_buckets, (30, 90), (5, num_buckets - 5),
+                         bar_heights([s - i for s, i in zip(source_buckets,
+                                     ignored_source_buckets)], 1),
+                         bar_heights(source_buckets, 1),
+                         bar_heights(highlighted_source_buckets, 1),
+                         bar_colors)
+        raster_time = time.time() - t0
+        if root_window is not None:
+            photo_image.put(data, to=(0, 0))
+            root_window.update_idletasks()
+        total_time = time.time() - t0
+
+        print("%4d buckets: per-bar puts %s, rasterized %.1f ms "
+              "(%d KiB), rasterized and put %.1f ms" % (num_buckets,
+              put_time, raster_time * 1000, len(data) // 1024,
+              total_time * 1000))
@@ -0,0 +1,269 @@
+# Calculate hash counts and histogram bucket data in a background thread so
+# the Tk thread stays responsive while a large recalculation runs.
+#
+# NumPy releases the GIL for most of the bucket binning work.  Without
+# NumPy the calculation shares the GIL with the Tk thread, which still
+# gets a turn every switch interval, so the UI stays responsive though
+# slower.
+
+import threading
+from collections import namedtuple, OrderedDict
+from timestamp import ts0, ts
+try:
+    import queue
+except ImportError:
+    import Queue as queue
+
+# milliseconds between polls for a result while a request is outstanding
+POLL_INTERVAL = 10
+
+# the number of plot regions of bucket data kept in the bucket cache
+MAX_CACHED_REGIONS = 64
+
+# a request for the bucket data of one plot region and filter generation
+BucketRequest = namedtuple("BucketRequest", ["version", "start_offset",
+                           "bytes_per_bucket", "num_buckets",
+                           "filter_generation"])
+
+def _cache_key(start_offset, bytes_per_bucket, num_buckets,
+               filter_generation):
+    return (start_offset, bytes_per_bucket, num_buckets, filter_generation)
+
+class BucketCache():
+    """An LRU cache of bucket data keyed by plot region and filter
+    generation, shared by the Tk and worker threads.
+
+    Attributes:
+      hits(int): The number of requests answered from the cache.
+      misses(int): The number of requests that were calculated.
+    """
+
+    def __init__(self, max_regions=MAX_CACHED_REGIONS):
+        self._max_regions = max_regions
+        self._bucket_data = OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def __repr__(self):
+        return "BucketCache(regions: %d, hits: %d, misses: %d, " \
+               "hit rate: %.2f)" % (len(self._bucket_data), self.hits,
+                                    self.misses, self.hit_rate())
+
+    def hit_rate(self):
+        """Return the fraction of requests answered from the cache."""
+        requests = self.hits + self.misses
+        return float(self.hits) / requests if requests else 0.0
+
+    def get(self, key):
+        """Return cached bucket data for key else None, counting the hit
+        or miss."""
+        with self._lock:
+            try:
+                bucket_data = self._bucket_data.pop(key)
+            except KeyError:
+                self.misses += 1
+                return None
+            self._bucket_data[key] = bucket_data
+            self.hits += 1
+            return bucket_data
+
+    def __contains__(self, key):
+        with self._lock:
+            return key in self._bucket_data
+
+    def put(self, key, bucket_data):
+        with self._lock:
+            self._bucket_data.pop(key, None)
+            if len(self._bucket_data) >= self._max_regions:
+                self._bucket_data.popitem(last=False)
+            self._bucket_data[key] = bucket_data
+
+class HistogramWorker():
+    """Calculates bucket data for HistogramBar in a background thread.
+
+    Requests are versioned.  Only the newest request is calculated: a
+    request not yet started is replaced by a newer one, and a running
+    request is abandoned between its hash counts and bucket data stages
+    once superseded.  Results are polled for with after() and passed to
+    the callback on the Tk thread, dropping any stale results.
+
+    Results are kept in a bucket cache, and requests found there are
+    answered at once.  When no request is outstanding the worker
+    prefetches the plot regions the user is likely to view next into the
+    cache, so repeated zooming back and forth does not recalculate.
+
+    Attributes:
+      completed(int): The number of results passed to the callback.
+      superseded(int): The number of requests replaced or abandoned.
+      prefetched(int): The number of plot regions prefetched.
+      bucket_cache(BucketCache): Calculated bucket data, with hit rate.
+    """
+
+    def __init__(self, widget, data_manager, callback):
+        """Args:
+          widget(a Tk widget): Used to poll for results.
+          data_manager(DataManager): Provides the data and filter snapshot
+            to calculate from.
+          callback(function): Called on the Tk thread with the
+            BucketRequest and its (source_buckets, ignored_source_buckets,
+            highlighted_source_buckets) bucket data.
+        """
+        self._widget = widget
+        self._data_manager = data_manager
+        self._callback = callback
+
+        self._version = 0
+        self._pending = None
+        self._prefetches = list()
+        self._condition = threading.Condition()
+        self._results = queue.Queue()
+        self._after_id = None
+        self.completed = 0
+        self.superseded = 0
+        self.prefetched = 0
+        self.bucket_cache = BucketCache()
+
+        self._thread = threading.Thread(target=self._run)
+        self._thread.daemon = True
+        self._thread.start()
+
+    def __repr__(self):
+        return "HistogramWorker(version: %d, completed: %d, " \
+               "superseded: %d, prefetched: %d, %s)" % (self._version,
+                                    self.completed, self.superseded,
+                                    self.prefetched, self.bucket_cache)
+
+    def request(self, start_offset, bytes_per_bucket, num_buckets):
+        """Request bucket data, superseding any outstanding request.  Bucket
+        data found in the bucket cache is passed to the callback before
+        returning.
+
+        Returns:
+          BucketRequest: The request made.
+        """
+        # snapshot the data and filters here on the Tk thread
+        filter_engine, filter_state, filter_generation = \
+                               self._data_manager.calculation_snapshot()
+        with self._condition:
+            self._version += 1
+            bucket_request = BucketRequest(self._version, start_offset,
+                                           bytes_per_bucket, num_buckets,
+                                           filter_generation)
+            if self._pending is not None:
+                self.superseded += 1
+                self._pending = None
+            del self._prefetches[:]
+
+            # answer from the bucket cache
+            bucket_data = self.bucket_cache.get(
+                                       _cache_key(*bucket_request[1:]))
+            if bucket_data is None:
+                self._pending = (bucket_request, filter_engine, filter_state)
+                self._condition.notify()
+
+        if bucket_data is not None:
+            if self._after_id is not None:
+                self._widget.after_cancel(self._after_id)
+                self._after_id = None
+            self.completed += 1
+            self._callback(bucket_request, bucket_data)
+
+        # poll for the result
+        elif self._after_id is None:
+            self._after_id = self._widget.after(POLL_INTERVAL, self._poll)
+        return bucket_request
+
+    def prefetch(self, plot_regions, num_buckets):
+        """Calculate bucket data for (start_offset, bytes_per_bucket) plot
+        regions into the bucket cache while no request is outstanding."""
+        filter_engine, filter_state, filter_generation = \
+                               self._data_manager.calculation_snapshot()
+        with self._condition:
+            del self._prefetches[:]
+            for start_offset, bytes_per_bucket in plot_regions:
+                key = _cache_key(start_offset, bytes_per_bucket,
+                                 num_buckets, filter_generation)
+                if key not in self.bucket_cache:
+                    self._prefetches.append((key, filter_engine,
+                                             filter_state))
+            self._condition.notify()
+
+    def is_busy(self):
+        """True while the newest request has no result yet."""
+        return self._after_id is not None
+
+    def _is_superseded(self, bucket_request):
+        return bucket_request.version != self._version
+
+    def _run(self):
+        while True:
+            with self._condition:
+                while self._pending is None and not self._prefetches:
+                    self._condition.wait()
+                if self._pending is None:
+                    prefetch = self._prefetches.pop(0)
+                else:
+                    prefetch = None
+                    bucket_request, filter_engine, filter_state = \
+                                                              self._pending
+                    self._pending = None
+
+            if prefetch is not None:
+                self._run_prefetch(*prefetch)
+                continue
+
+            try:
+                t0 = ts0("histogram_worker.calculate %d start" %
+                                                     bucket_request.version)
+                filter_engine.calculate_hash_counts(filter_state)
+                if self._is_superseded(bucket_request):
+                    with self._condition:
+                        self.superseded += 1
+                    ts("histogram_worker.calculate superseded", t0)
+                    continue
+                bucket_data = filter_engine.calculate_bucket_data(
+                                             bucket_request.start_offset,
+                                             bucket_request.bytes_per_bucket,
+                                             bucket_request.num_buckets)
+                ts("histogram_worker.calculate done", t0)
+                self.bucket_cache.put(_cache_key(*bucket_request[1:]),
+                                      bucket_data)
+                self._results.put((bucket_request, bucket_data, None))
+
+            except Exception as e:
+                # data replaced during a superseded calculation can fail,
+                # so errors are reported only for the current request
+                self._results.put((bucket_request, None, e))
+
+    def _run_prefetch(self, key, filter_engine, filter_state):
+        # calculate one prefetch into the bucket cache, so a new request
+        # waits for at most one plot region
+        start_offset, bytes_per_bucket, num_buckets, _ = key
+        try:
+            filter_engine.calculate_hash_counts(filter_state)
+            self.bucket_cache.put(key, filter_engine.calculate_bucket_data(
+                         start_offset, bytes_per_bucket, num_buckets))
+            self.prefetched += 1
+        except Exception as e:
+            # the data may have been replaced, and any request recalculates
+            print("histogram_worker prefetch failed: %s" % e)
+
+    def _poll(self):
+        self._after_id = None
+        while True:
+            try:
+                bucket_request, bucket_data, error = \
+                                                self._results.get_nowait()
+            except queue.Empty:
+                break
+            if self._is_superseded(bucket_request):
+                continue
+            if error is not None:
+                raise error
+            self.completed += 1
+            self._callback(bucket_request, bucket_data)
+            return
+
+        # keep polling until the newest request has its result
+        self._after_id = self._widget.after(POLL_INTERVAL, self._poll)
@@ -6,6 +6,7 @@ import sys
 import command_runner
 from tooltip import Tooltip
 import helpers
+from progress_sink import ProgressSink
 
 try:
     import queue
@@ -38,12 +39,18 @@ class IngestWindow():
         self._step_size = step_size
         self._repository_name = repository_name
 
-        # the queue for ingest text
-        self._queue = queue.Queue()
+        # the queue for ingest text, bounded so that output waits in the
+        # command's pipes when the window falls behind
+        self._queue = queue.Queue(command_runner.QUEUE_BATCHES)
+
+        # the running command and its output sink, set by _handle_start
+        self._command_runner = None
+        self._progress_sink = None
 
         # toplevel
         self._root_window = tkinter.Toplevel(master)
         self._root_window.title("SectorScope Ingest")
+        self._root_window.protocol('WM_DELETE_WINDOW', self._handle_close)
 
         # make the control frame
         control_frame = tkinter.Frame(self._root_window, borderwidth=1,
@@ -278,20 +285,23 @@ class IngestWindow():
     def _handle_consume_queue(self):
         is_done = self._command_runner.is_done()
 
-        # consume the queue
-        while not self._queue.empty():
-            name, line = self._queue.get()
-
-            # show everything
-            self._progress_text.insert(tkinter.END, "%s: %s" %(name, line))
-            self._progress_text.see(tkinter.END)
+        # consume the batches of lines in the queue, showing everything
+        num_batches = self._queue.qsize()
+        for _ in range(num_batches):
+            name, lines = self._queue.get()
+            self._progress_sink.write(name, lines)
+        self._progress_sink.show()
 
         # more or done
-        if not is_done:
-            # keep progress_text consuming queue
-            self._progress_text.after(200, self._handle_consume_queue)
+        if not is_done or not self._queue.empty():
+            # keep progress_text consuming queue, sooner while output
+            # is arriving
+            self._progress_text.after(20 if num_batches else 200,
+                                      self._handle_consume_queue)
         else:
             # done, successful or not, show status
+            self._progress_sink.close()
+            self._progress_sink = None
             if self._command_runner.return_code() == 0:
                 # good
                 self._set_done()
@@ -368,7 +378,10 @@ class IngestWindow():
                "-s", "%s"%step_size, hashdb_dir, source_dir]
 
         # start the import
-        self._command_runner = command_runner.CommandRunner(cmd, self._queue)
+        self._progress_sink = ProgressSink(self._progress_text,
+                                           self._status_label)
+        self._command_runner = command_runner.CommandRunner(cmd, self._queue,
+                                                            batch_lines=True)
 
         # start the consumer
         self._progress_text.after(200, self._handle_consume_queue)
@@ -379,5 +392,10 @@ class IngestWindow():
         self._command_runner.kill()
 
     def _handle_close(self):
+        # stop any running command and abandon its queued output, else it
+        # would block writing to the full queue once nothing consumes it
+        if self._progress_sink is not None:
+            self._command_runner.abandon()
+            self._progress_sink.close()
         self._root_window.destroy()
 
@@ -0,0 +1,125 @@
+from bisect import bisect_left
+
+class IntervalIndex():
+    """Finds the intervals overlapping a range using intervals sorted by
+    start and a centered interval tree.
+
+    The intervals overlapping [start, stop) are those starting in
+    [start, stop), found by bisecting the starts, and those starting
+    before start that reach past it, found by stabbing the tree at start.
+    Each tree node keeps the intervals containing its center sorted by
+    start and by stop, and each child holds at most half the intervals
+    below its parent, so a query costs O(log n + k) for k intervals found,
+    plus sorting the intervals found by the stab.
+    """
+
+    def __init__(self, intervals):
+        """Args:
+          intervals(iterable of (start, stop, value)): The intervals, where
+            an interval with stop <= start is treated as one point at start.
+        """
+        self._intervals = sorted(intervals, key=lambda interval:
+                                                            interval[0])
+        self._starts = [interval[0] for interval in self._intervals]
+
+        # the tree of intervals that are not points, as parallel lists of
+        # node center, (start, index) by start, (stop, index) by stop
+        # descending, and left and right child node, else -1
+        self._centers = list()
+        self._by_start = list()
+        self._by_stop = list()
+        self._lefts = list()
+        self._rights = list()
+        self._build([i for i, (start, stop, _) in enumerate(self._intervals)
+                     if stop > start])
+
+    def _build(self, indexes):
+        # build the subtree of intervals at indexes, return its node else
+        # -1, using a stack rather than recursion
+        if not indexes:
+            return -1
+        root = self._new_node()
+        stack = [(root, indexes)]
+        while stack:
+            node, indexes = stack.pop()
+
+            # the median midpoint is inside at least one interval, and at
+            # most half the intervals lie wholly to either side of it
+            intervals = self._intervals
+            midpoints = sorted((intervals[i][0] + intervals[i][1]) / 2.0
+                               for i in indexes)
+            center = midpoints[len(midpoints) // 2]
+            left = list()
+            right = list()
+            here = list()
+            for i in indexes:
+                start, stop, _ = intervals[i]
+                if stop <= center:
+                    left.append(i)
+                elif start >= center:
+                    right.append(i)
+                else:
+                    here.append(i)
+
+            # indexes stay in start order, so here is sorted by start
+            self._centers[node] = center
+            self._by_start[node] = [(intervals[i][0], i) for i in here]
+            self._by_stop[node] = sorted(((intervals[i][1], i)
+                                          for i in here), reverse=True)
+            if left:
+                self._lefts[node] = self._new_node()
+                stack.append((self._lefts[node], left))
+            if right:
+                self._rights[node] = self._new_node()
+                stack.append((self._rights[node], right))
+        return root
+
+    def _new_node(self):
+        self._centers.append(None)
+        self._by_start.append(None)
+        self._by_stop.append(None)
+        self._lefts.append(-1)
+        self._rights.append(-1)
+        return len(self._centers) - 1
+
+    def __len__(self):
+        return len(self._intervals)
+
+    def _stab(self, point):
+        # return the indexes of the intervals with start < point < stop
+        indexes = list()
+        node = 0 if self._centers else -1
+        while node != -1:
+            center = self._centers[node]
+            if point < center:
+                # every interval here ends after point
+                for start, i in self._by_start[node]:
+                    if start >= point:
+                        break
+                    indexes.append(i)
+                node = self._lefts[node]
+            elif point > center:
+                # every interval here starts before point
+                for stop, i in self._by_stop[node]:
+                    if stop <= point:
+                        break
+                    indexes.append(i)
+                node = self._rights[node]
+            else:
+                # every interval here contains point, none to either side
+                indexes.extend(i for _, i in self._by_start[node])
+                break
+        return indexes
+
+    def overlapping(self, start, stop):
+        """Return the values of intervals overlapping [start, stop), in
+        order of interval start.  Point intervals overlap when their
+        point is in [start, stop)."""
+        if stop <= start:
+            return list()
+        first = bisect_left(self._starts, start)
+        last = bisect_left(self._starts, stop)
+        intervals = self._intervals
+        values = [intervals[i][2] for i in sorted(self._stab(start))]
+        values.extend(intervals[i][2] for i in range(first, last))
+        return values
@@ -0,0 +1,77 @@
+# Show progress while a scan file loads in batches.
+
+from helpers import size_string
+try:
+    import tkinter
+except ImportError:
+    import Tkinter as tkinter
+
+# size of the progress bar
+BAR_WIDTH = 400
+BAR_HEIGHT = 16
+
+class LoadProgressWindow():
+    """Show scan file load progress with a Cancel button.
+    """
+
+    def __init__(self, master, scan_file, cancel_callback):
+        """Args:
+          master(a UI container): Parent.
+          scan_file(str): The scan file being loaded.
+          cancel_callback(function): Called when Cancel is pressed or the
+            window is closed.
+        """
+        self._cancel_callback = cancel_callback
+
+        # toplevel
+        self._root_window = tkinter.Toplevel(master)
+        self._root_window.title("SectorScope Loading Scan File")
+        self._root_window.protocol('WM_DELETE_WINDOW', self._handle_cancel)
+
+        # make the control frame
+        control_frame = tkinter.Frame(self._root_window, borderwidth=1,
+                                      relief=tkinter.RIDGE)
+        control_frame.pack(side=tkinter.TOP, padx=8, pady=8)
+
+        # scan file
+        tkinter.Label(control_frame, text="Scan file: %s" % scan_file) \
+                          .pack(side=tkinter.TOP, anchor="w", padx=8, pady=4)
+
+        # progress bar
+        self._c = tkinter.Canvas(control_frame, width=BAR_WIDTH,
+                                 height=BAR_HEIGHT, bd=1,
+                                 relief=tkinter.SUNKEN, highlightthickness=0)
+        self._c.pack(side=tkinter.TOP, padx=8, pady=4)
+        self._bar_id = self._c.create_rectangle(0, 0, 0, BAR_HEIGHT + 2,
+                                                fill="#0066cc", width=0)
+
+        # status label
+        self._status_label = tkinter.Label(control_frame, text="Starting...")
+        self._status_label.pack(side=tkinter.TOP, anchor="w", padx=8, pady=4)
+
+        # cancel button
+        self._cancel_button = tkinter.Button(self._root_window,
+                                             text="Cancel",
+                                             command=self._handle_cancel)
+        self._cancel_button.pack(side=tkinter.TOP, padx=8, pady=(0,8))
+
+    def set_progress(self, bytes_done, bytes_total, num_matches):
+        """Show bytes of the scan file read and matches loaded so far."""
+        fraction = float(bytes_done) / bytes_total if bytes_total else 1.0
+        self._c.coords(self._bar_id, 0, 0, int(BAR_WIDTH * fraction),
+                       BAR_HEIGHT + 2)
+        self._status_label["text"] = "Read %s of %s (%d%%), %d matches" % (
+                       size_string(bytes_done), size_string(bytes_total),
+                       int(fraction * 100), num_matches)
+
+    def set_status(self, text):
+        """Show a status text in place of progress."""
+        self._status_label["text"] = text
+
+    def close(self):
+        self._root_window.destroy()
+
+    def _handle_cancel(self):
+        self._cancel_button.config(state=tkinter.DISABLED)
+        self.set_status("Cancelling...")
+        self._cancel_callback()
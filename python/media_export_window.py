@@ -5,7 +5,7 @@ import sys
 import command_runner
 from tooltip import Tooltip
 from error_window import ErrorWindow
-import helpers
+import media_reader
 
 try:
     import queue
@@ -159,7 +159,7 @@ class MediaExportWindow():
             open_mode = 'ab' # append binary
 
         # read the media bytes
-        error_message, media_bytes = helpers.read_media_bytes(
+        error_message, media_bytes = media_reader.read_media_bytes(
                        self._media_filename, byte_offset, byte_count)
         if error_message:
             ErrorWindow(self._master, "Export Error", error_message)
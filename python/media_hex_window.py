@@ -1,6 +1,6 @@
 from media_hex_table import MediaHexTable
 import hashlib
-from helpers import read_media_bytes
+from media_reader import read_media_bytes
 from error_window import ErrorWindow
 try:
     import tkinter
@@ -0,0 +1,430 @@
+import heapq
+from itertools import islice
+from array import array
+from bisect import bisect_left
+from binascii import hexlify, unhexlify
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+# array typecode for media offsets.  Python 2.7 does not have 'Q' so
+# use 'L', which is 64 bits on 64-bit Linux and Mac.
+try:
+    array('Q')
+    OFFSET_TYPECODE = 'Q'
+except ValueError:
+    OFFSET_TYPECODE = 'L'
+
+# array typecode for hash indexes into the digest table
+HASH_INDEX_TYPECODE = 'I'
+
+# size in bytes of a binary block hash digest, MD5
+DIGEST_SIZE = 16
+
+# offsets sorted at a time without NumPy, bounding the temporary list made
+_SORT_CHUNK_SIZE = 1 << 16
+
+def _numpy_column(column):
+    # a NumPy view of an array column
+    return numpy.frombuffer(column, dtype="u%d" % column.itemsize)
+
+def _extend(column, values):
+    # extend an array column with an array or read-only buffer of values
+    try:
+        column.frombytes(memoryview(values).cast('B'))
+    except (AttributeError, TypeError):
+        # Python 2.7
+        column.extend(values)
+
+def _column(typecode, values):
+    # an array column copied from an array or buffer of values
+    column = array(typecode)
+    _extend(column, values)
+    return column
+
+def _prefix(column, size):
+    # a view of the first size items of column, which does not copy them
+    try:
+        return memoryview(column)[:size]
+    except TypeError:
+        # Python 2.7 arrays do not export buffers
+        return column[:size]
+
+def _write(column, start, values):
+    # write values into column at start without resizing column
+    try:
+        memoryview(column)[start:start + len(values)] = memoryview(values)
+    except TypeError:
+        # Python 2.7 arrays do not export buffers
+        column[start:start + len(values)] = values
+
+def _reserve(column, size, needed):
+    # column if it has room for needed items, else a larger copy of its
+    # first size items, leaving column unchanged for views of it
+    if len(column) >= needed:
+        return column
+    capacity = max(needed, 2 * len(column))
+    if isinstance(column, bytearray):
+        reserved = bytearray(capacity)
+    else:
+        reserved = array(column.typecode, [0]) * capacity
+    _write(reserved, 0, _prefix(column, size))
+    return reserved
+
+def _from_numpy(typecode, values):
+    # an array column copied from NumPy values
+    column = array(typecode)
+    _extend(column, numpy.ascontiguousarray(values,
+                                            dtype="u%d" % column.itemsize))
+    return column
+
+def _remap(hash_index_map, hash_indexes):
+    # hash_indexes mapped through the hash_index_map array as a new array
+    # column, without making a list of the mapped values
+    if all(hash_index == i for i, hash_index in enumerate(hash_index_map)):
+        # the identity map, as when appending to an empty store
+        return _column(HASH_INDEX_TYPECODE, hash_indexes)
+    if numpy is not None:
+        return _from_numpy(HASH_INDEX_TYPECODE, _numpy_column(
+                        hash_index_map)[_numpy_column(hash_indexes)])
+    return array(HASH_INDEX_TYPECODE,
+                 map(hash_index_map.__getitem__, hash_indexes))
+
+def _run_pairs(offsets, hash_indexes, run, start, stop):
+    # the (offset, run, hash_index) items of one sorted run, where run keeps
+    # a merge of runs stable without comparing hash indexes
+    for i in range(start, stop):
+        yield offsets[i], run, hash_indexes[i]
+
+class MediaOffsets():
+    """Columnar store of media offsets and the block hashes matched at them.
+
+    Offsets are kept in a sorted array of unsigned 64-bit values.  Each
+    offset has a parallel 32-bit index into a deduplicated table of 16-byte
+    binary block hash digests.  Consumers that need the hash hexcode used
+    to key DataReader.hashes may iterate this store to get
+    (media_offset int, hash hexcode str) pairs.
+
+    Columns set by set_columns may be read-only buffers, such as views of
+    a memory mapped cache, which are used in place and copied only if the
+    store is changed.
+
+    Attributes:
+      offsets(array<int>): Sorted media offsets, one per matched block.
+      hash_indexes(array<int>): Index into the digest table for each offset.
+    """
+
+    def __init__(self):
+        self.offsets = array(OFFSET_TYPECODE)
+        self.hash_indexes = array(HASH_INDEX_TYPECODE)
+
+        # the deduplicated digest table and its lookup, else None until
+        # the lookup is first used
+        self._digests = bytearray()
+        self._digest_indexes = dict()
+
+        # whether offsets have been appended in order
+        self._is_sorted = True
+
+    def __len__(self):
+        return len(self.offsets)
+
+    def __iter__(self):
+        """Iterate (media_offset int, hash hexcode str) pairs."""
+        block_hash = self.block_hash
+        for offset, hash_index in zip(self.offsets, self.hash_indexes):
+            yield offset, block_hash(hash_index)
+
+    def __repr__(self):
+        return "MediaOffsets(Number of media offsets: %d, " \
+               "Number of hashes: %d)" % (len(self), self.num_hashes())
+
+    def num_hashes(self):
+        """The number of distinct block hashes in the digest table."""
+        return len(self._digests) // DIGEST_SIZE
+
+    def hash_index(self, block_hash):
+        """Return the digest table index of hexcode block_hash, adding it
+        to the table if it is new."""
+        digest = unhexlify(block_hash)
+        if len(digest) != DIGEST_SIZE:
+            raise ValueError("Invalid block hash '%s'" % block_hash)
+        return self._digest_index(digest)
+
+    def _digest_index(self, digest):
+        # return the index of binary digest, adding it if it is new
+        try:
+            return self._digest_indexes[digest]
+        except KeyError:
+            pass
+        except TypeError:
+            # no lookup yet
+            hash_index = self._lookup().get(digest)
+            if hash_index is not None:
+                return hash_index
+        self._own_columns()
+        hash_index = len(self._digest_indexes)
+        self._digest_indexes[digest] = hash_index
+        self._digests.extend(digest)
+        return hash_index
+
+    def _lookup(self):
+        # the digest to hash index lookup, made when first used
+        digest_indexes = self._digest_indexes
+        if digest_indexes is None:
+            digests = bytes(self._digests)
+            digest_indexes = dict((digests[i:i + DIGEST_SIZE],
+                                   i // DIGEST_SIZE) for i in range(0,
+                                   len(digests), DIGEST_SIZE))
+            self._digest_indexes = digest_indexes
+        return digest_indexes
+
+    def _own_columns(self):
+        # copy columns set from read-only buffers before changing them
+        if not isinstance(self.offsets, array):
+            self.offsets = _column(OFFSET_TYPECODE, self.offsets)
+        if not isinstance(self.hash_indexes, array):
+            self.hash_indexes = _column(HASH_INDEX_TYPECODE,
+                                        self.hash_indexes)
+        if not isinstance(self._digests, bytearray):
+            self._digests = bytearray(self._digests)
+
+            # the lookup may be shared with a MediaOffsetsBuffer
+            self._digest_indexes = None
+        self._lookup()
+
+    def find_hash_index(self, block_hash):
+        """Return the digest table index of hexcode block_hash or -1."""
+        hash_index = self._lookup().get(unhexlify(block_hash), -1)
+
+        # the lookup of a MediaOffsetsBuffer view also has later hashes
+        return hash_index if hash_index < self.num_hashes() else -1
+
+    def block_hash(self, hash_index):
+        """Return the hexcode of the digest at hash_index."""
+        start = hash_index * DIGEST_SIZE
+        return hexlify(self._digests[start:start + DIGEST_SIZE]) \
+                                                       .decode('ascii')
+
+    def block_hashes(self):
+        """Return the list of hexcodes in digest table order."""
+        return [self.block_hash(i) for i in range(self.num_hashes())]
+
+    def copy(self):
+        """Return a copy that can be changed without changing this store."""
+        other = MediaOffsets()
+        other.offsets = _column(OFFSET_TYPECODE, self.offsets)
+        other.hash_indexes = _column(HASH_INDEX_TYPECODE, self.hash_indexes)
+        other._digests = bytearray(self._digests)
+        other._digest_indexes = dict(self._lookup())
+        other._is_sorted = self._is_sorted
+        return other
+
+    def columns(self):
+        """Return the (offsets, hash_indexes, digests) columns, where
+        digests is the bytes of the digest table in hash index order."""
+        return self.offsets, self.hash_indexes, bytes(self._digests)
+
+    def set_columns(self, offsets, hash_indexes, digests):
+        """Replace the store with sorted columns from columns(), which may
+        be read-only buffers.  They are used in place, and the digest
+        lookup is made when first used."""
+        self.offsets = offsets
+        self.hash_indexes = hash_indexes
+        self._digests = digests
+        self._digest_indexes = None
+        self._is_sorted = True
+
+    def index_range(self, start_byte, stop_byte):
+        """Return the (first, stop) index range of offsets within
+        [start_byte, stop_byte) by bisecting the sorted offsets."""
+        offsets = self.offsets
+        return (bisect_left(offsets, start_byte),
+                bisect_left(offsets, stop_byte))
+
+    def append(self, media_offset, block_hash):
+        """Append the media_offset, hexcode block_hash pair."""
+        hash_index = self.hash_index(block_hash)
+        self._own_columns()
+        offsets = self.offsets
+        if self._is_sorted and len(offsets) and media_offset < offsets[-1]:
+            self._is_sorted = False
+        self.hash_indexes.append(hash_index)
+        offsets.append(media_offset)
+
+    def extend_columns(self, offsets, hash_indexes, is_sorted):
+        """Append offset and hash index columns, where the hash indexes
+        come from hash_index and is_sorted tells whether offsets are in
+        order."""
+        self._own_columns()
+        if self._is_sorted and (not is_sorted or len(self.offsets) and
+                                len(offsets) and offsets[0] < self.offsets[-1]):
+            self._is_sorted = False
+        _extend(self.offsets, offsets)
+        _extend(self.hash_indexes, hash_indexes)
+
+    def extend(self, other):
+        """Append the pairs of MediaOffsets other, merging its digest
+        table into this one."""
+        self._own_columns()
+        digests = other._digests
+        hash_index_map = array(HASH_INDEX_TYPECODE,
+                          (self._digest_index(bytes(digests[i:i + DIGEST_SIZE]))
+                          for i in range(0, len(digests), DIGEST_SIZE)))
+        if self._is_sorted and (not other._is_sorted or len(self.offsets)
+                                and len(other.offsets) and
+                                other.offsets[0] < self.offsets[-1]):
+            self._is_sorted = False
+        self.hash_indexes.extend(_remap(hash_index_map, other.hash_indexes))
+        _extend(self.offsets, other.offsets)
+
+    def sort(self):
+        """Sort by media offset, keeping equal offsets in append order.
+        Scan files are usually already in offset order so this is usually
+        a no-op, and offsets found to be in order are not copied.
+
+        With NumPy this is a stable argsort of the offset column, else
+        chunks of the columns are sorted and then merged, so neither makes
+        a Python list or object per offset."""
+        if self._is_sorted:
+            return
+
+        if numpy is not None:
+            offsets = _numpy_column(self.offsets)
+            if len(offsets) < 2 or (offsets[1:] >= offsets[:-1]).all():
+                self._is_sorted = True
+                return
+            order = offsets.argsort(kind="mergesort")
+            self.offsets = _from_numpy(OFFSET_TYPECODE, offsets[order])
+            self.hash_indexes = _from_numpy(HASH_INDEX_TYPECODE,
+                                 _numpy_column(self.hash_indexes)[order])
+            self._is_sorted = True
+            return
+
+        offsets = self.offsets
+        if all(a <= b for a, b in zip(offsets, islice(offsets, 1, None))):
+            self._is_sorted = True
+            return
+
+        # sort chunks of copies of the columns, then merge the chunks
+        offsets = _column(OFFSET_TYPECODE, offsets)
+        hash_indexes = _column(HASH_INDEX_TYPECODE, self.hash_indexes)
+        runs = list()
+        for start in range(0, len(offsets), _SORT_CHUNK_SIZE):
+            stop = min(start + _SORT_CHUNK_SIZE, len(offsets))
+            order = sorted(range(start, stop), key=offsets.__getitem__)
+            offsets[start:stop] = array(OFFSET_TYPECODE,
+                                        (offsets[i] for i in order))
+            hash_indexes[start:stop] = array(HASH_INDEX_TYPECODE,
+                                             (hash_indexes[i] for i in order))
+            runs.append((start, stop))
+        if len(runs) > 1:
+            sorted_offsets = array(OFFSET_TYPECODE)
+            sorted_hash_indexes = array(HASH_INDEX_TYPECODE)
+            for offset, _, hash_index in heapq.merge(*[_run_pairs(offsets,
+                                 hash_indexes, run, start, stop)
+                                 for run, (start, stop) in enumerate(runs)]):
+                sorted_offsets.append(offset)
+                sorted_hash_indexes.append(hash_index)
+            offsets = sorted_offsets
+            hash_indexes = sorted_hash_indexes
+        self.offsets = offsets
+        self.hash_indexes = hash_indexes
+        self._is_sorted = True
+
+class MediaOffsetsBuffer():
+    """Appends batches of MediaOffsets into over-allocated columns, so
+    each batch is copied once rather than the whole store being copied
+    for each batch.
+
+    media_offsets() returns a MediaOffsets that reads the pairs appended
+    so far in place.  It stays valid while more batches are appended,
+    because appending only writes past its end, and a full column is
+    replaced by a larger copy rather than resized.  The first batch is
+    used as is until a second batch is appended.
+    """
+
+    def __init__(self):
+        self._num_batches = 0
+        self._first = None
+
+        # the over-allocated columns, the number of pairs and hashes in
+        # them, and the digest lookup, which views share
+        self._offsets = array(OFFSET_TYPECODE)
+        self._hash_indexes = array(HASH_INDEX_TYPECODE)
+        self._digests = bytearray()
+        self._digest_indexes = dict()
+        self._size = 0
+        self._is_sorted = True
+
+    def __len__(self):
+        if self._first is not None:
+            return len(self._first)
+        return self._size
+
+    def is_sorted(self):
+        """Whether the pairs appended so far are in offset order."""
+        if self._first is not None:
+            return self._first._is_sorted
+        return self._is_sorted
+
+    def append(self, media_offsets):
+        """Append the pairs of MediaOffsets media_offsets, which the
+        buffer may keep and must not be changed afterwards."""
+        self._num_batches += 1
+        if self._num_batches == 1:
+            self._first = media_offsets
+            return
+        if self._first is not None:
+            first = self._first
+            self._first = None
+            self._put(first)
+        self._put(media_offsets)
+
+    def _put(self, other):
+        # copy the pairs of other in after the pairs here, adding its new
+        # digests to the digest table
+        digests = other._digests
+        digest_indexes = self._digest_indexes
+        num_hashes = len(digest_indexes)
+        new_digests = bytearray()
+        hash_index_map = array(HASH_INDEX_TYPECODE)
+        for i in range(0, len(digests), DIGEST_SIZE):
+            digest = bytes(digests[i:i + DIGEST_SIZE])
+            hash_index = digest_indexes.get(digest)
+            if hash_index is None:
+                hash_index = len(digest_indexes)
+                digest_indexes[digest] = hash_index
+                new_digests.extend(digest)
+            hash_index_map.append(hash_index)
+        self._digests = _reserve(self._digests, num_hashes * DIGEST_SIZE,
+                                 len(digest_indexes) * DIGEST_SIZE)
+        _write(self._digests, num_hashes * DIGEST_SIZE, new_digests)
+
+        size = self._size
+        count = len(other)
+        if count and self._is_sorted and (not other._is_sorted or size and
+                          other.offsets[0] < self._offsets[size - 1]):
+            self._is_sorted = False
+        self._offsets = _reserve(self._offsets, size, size + count)
+        _write(self._offsets, size, other.offsets)
+        self._hash_indexes = _reserve(self._hash_indexes, size, size + count)
+        _write(self._hash_indexes, size,
+               _remap(hash_index_map, other.hash_indexes))
+        self._size = size + count
+
+    def media_offsets(self):
+        """Return a MediaOffsets of the pairs appended so far, which reads
+        the buffer in place and must not be changed, though it may be
+        sorted into columns of its own."""
+        if self._first is not None:
+            return self._first
+        media_offsets = MediaOffsets()
+        media_offsets.offsets = _prefix(self._offsets, self._size)
+        media_offsets.hash_indexes = _prefix(self._hash_indexes, self._size)
+        media_offsets._digests = _prefix(self._digests,
+                                 len(self._digest_indexes) * DIGEST_SIZE)
+        media_offsets._digest_indexes = self._digest_indexes
+        media_offsets._is_sorted = self._is_sorted
+        return media_offsets
@@ -0,0 +1,212 @@
+# Read bytes from media images, keeping the image open between reads.
+#
+# Raw images are read directly with os.pread.  EWF (E01) images are read
+# with pyewf when it is installed.  Other formats, and EWF without pyewf,
+# are read with hashdb read_media through a page cache so repeated reads
+# near the same offset do not each start a hashdb process.
+
+import os
+import re
+from collections import OrderedDict
+from helpers import read_media_bytes as hashdb_read_media_bytes
+try:
+    import pyewf
+except ImportError:
+    pyewf = None
+
+# media image filenames that hashdb or pyewf must read: EWF, AFF, and
+# split raw segments such as .001
+_CONTAINER_FORMAT = re.compile(r"\.([ELS]x?01|aff|afd|afm|\d{3})$",
+                               re.IGNORECASE)
+_EWF_FORMAT = re.compile(r"\.[ELS]x?01$", re.IGNORECASE)
+
+# hashdb read_media page size and the number of pages cached
+PAGE_SIZE = 65536
+MAX_CACHED_PAGES = 64
+
+class _RawMedia():
+    # raw image read with positional reads on one open file
+    def __init__(self, media_filename):
+        self._f = open(media_filename, 'rb')
+
+    def size(self):
+        return os.fstat(self._f.fileno()).st_size
+
+    def read(self, offset, count):
+        try:
+            return "", bytearray(os.pread(self._f.fileno(), count, offset))
+        except AttributeError:
+            # no os.pread on Windows or Python 2.7
+            self._f.seek(offset)
+            return "", bytearray(self._f.read(count))
+
+    def close(self):
+        self._f.close()
+
+class _EwfMedia():
+    # EWF image read with one open pyewf handle
+    def __init__(self, media_filename):
+        self._handle = pyewf.handle()
+        self._handle.open(pyewf.glob(media_filename))
+        self._media_size = self._handle.get_media_size()
+
+    def size(self):
+        return self._media_size
+
+    def read(self, offset, count):
+        count = max(0, min(count, self._media_size - offset))
+        self._handle.seek(offset)
+        return "", bytearray(self._handle.read(count))
+
+    def close(self):
+        self._handle.close()
+
+class _HashdbMedia():
+    # image read by hashdb read_media, one page at a time through an LRU
+    # page cache
+    def __init__(self, media_filename):
+        self._media_filename = media_filename
+        self._pages = OrderedDict()
+
+    def size(self):
+        # not known without starting hashdb
+        return None
+
+    def read(self, offset, count):
+        # read large requests directly rather than flushing the cache
+        if count > PAGE_SIZE * MAX_CACHED_PAGES // 2:
+            return hashdb_read_media_bytes(self._media_filename,
+                                           offset, count)
+
+        buf = bytearray()
+        page_offset = offset - offset % PAGE_SIZE
+        while page_offset < offset + count:
+            error_message, page = self._page(page_offset)
+            if error_message:
+                return error_message, buf
+            start = max(offset - page_offset, 0)
+            buf.extend(page[start:offset + count - page_offset])
+            if len(page) < PAGE_SIZE:
+                # end of media
+                break
+            page_offset += PAGE_SIZE
+        return "", buf
+
+    def _page(self, page_offset):
+        try:
+            page = self._pages.pop(page_offset)
+        except KeyError:
+            error_message, page = hashdb_read_media_bytes(
+                           self._media_filename, page_offset, PAGE_SIZE)
+            if error_message:
+                return error_message, page
+            if len(self._pages) >= MAX_CACHED_PAGES:
+                self._pages.popitem(last=False)
+        self._pages[page_offset] = page
+        return "", page
+
+    def close(self):
+        self._pages.clear()
+
+class MediaReader():
+    """Reads bytes from a media image, keeping the image open between
+    reads.
+
+    Attributes:
+      media_filename(str): The media image read from.
+    """
+
+    def __init__(self, media_filename):
+        self.media_filename = media_filename
+        self._media = None
+
+    def __repr__(self):
+        return "MediaReader(media_filename: '%s', reader: %s)" % (
+                      self.media_filename, type(self._media).__name__)
+
+    def read(self, offset, count):
+        """Read count bytes at offset.
+
+        Returns:
+          (error_message, bytearray) where error_message is "" on success,
+          as for helpers.read_media_bytes.
+        """
+        if offset < 0:
+            raise ValueError("Invalid negative offset requested.")
+
+        try:
+            if self._media is None:
+                self._media = self._open()
+            return self._media.read(offset, count)
+        except (IOError, OSError) as e:
+            self.close()
+            return "Error reading media bytes from %s: %s" % (
+                                          self.media_filename, e), bytearray()
+
+    def media_size(self):
+        """Return the size in bytes of the media image, else None if it is
+        not known without reading the media image through hashdb."""
+        try:
+            if self._media is None:
+                self._media = self._open()
+            return self._media.size()
+        except (IOError, OSError):
+            self.close()
+            return None
+
+    def close(self):
+        """Close the media image, which is reopened by the next read."""
+        if self._media is not None:
+            self._media.close()
+            self._media = None
+
+    def _open(self):
+        if _EWF_FORMAT.search(self.media_filename) and pyewf is not None:
+            return _EwfMedia(self.media_filename)
+        if _CONTAINER_FORMAT.search(self.media_filename):
+            return _HashdbMedia(self.media_filename)
+        return _RawMedia(self.media_filename)
+
+# the reader for the most recently read media image
+_media_reader = None
+
+def read_media_bytes(media_filename, offset, count):
+    """Read count bytes at offset from media_filename, reusing the open
+    reader when the media image is the same as for the previous read.
+
+    Returns:
+      (error_message, bytearray) where error_message is "" on success.
+    """
+    global _media_reader
+    if _media_reader is None or \
+                     _media_reader.media_filename != media_filename:
+        if _media_reader is not None:
+            _media_reader.close()
+        _media_reader = MediaReader(media_filename)
+    return _media_reader.read(offset, count)
+
+# main
+if __name__=="__main__":
+    # informal timing of hex view sized reads at hover offsets
+    import sys
+    import time
+    import random
+    import tempfile
+
+    media = tempfile.NamedTemporaryFile(suffix=".raw", delete=False)
+    media.write(os.urandom(64 * 1024 * 1024))
+    media.close()
+
+    random.seed(1)
+    offsets = [random.randrange(0, 64 * 1024 * 1024, 512)
+               for _ in range(10000)]
+    t0 = time.time()
+    for offset in offsets:
+        error_message, buf = read_media_bytes(media.name, offset, 16384)
+        if error_message:
+            sys.exit(error_message)
+    elapsed = time.time() - t0
+    _media_reader.close()
+    os.unlink(media.name)
+    print("%d raw reads of 16 KiB: %.3f ms per read" % (len(offsets),
+                                                 elapsed * 1000 / len(offsets)))
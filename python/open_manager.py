@@ -1,5 +1,9 @@
+import os
+import time
 from error_window import ErrorWindow
 from data_reader import DataReader
+from scan_loader import ScanLoader
+from load_progress_window import LoadProgressWindow
 try:
     import tkinter
     import tkinter.filedialog as fd
@@ -7,6 +11,15 @@ except ImportError:
     import Tkinter as tkinter
     import tkFileDialog as fd
 
+# scan files at least this size load in batches with a progress window
+STREAMING_MIN_SIZE = 256 * 1024 * 1024
+
+# milliseconds between polls of the scan loader
+POLL_INTERVAL = 200
+
+# minimum seconds between histogram repaints while loading in batches
+REPAINT_INTERVAL = 1.0
+
 class OpenManager():
     """Opens a bulk_extractor directory, sets data, and fires events.
 
@@ -34,10 +47,30 @@ class OpenManager():
 
         self._data_reader = DataReader()
 
+        # batch loading state
+        self._scan_loader = None
+        self._load_progress_window = None
+        self._pending_batches = list()
+        self._repaint_interval = REPAINT_INTERVAL
+        self._repaint_time = 0
+
     """Open scan_file and note the media_filename and sector_size."""
     def open_scan_file(self, scan_file, sector_size,
                        alternate_media_filename, alternate_hashdb_dir):
 
+        # stop any batch load in progress
+        self._cancel_load()
+
+        # load large scan files in batches
+        try:
+            is_large = os.path.getsize(scan_file) >= STREAMING_MIN_SIZE
+        except OSError:
+            is_large = False
+        if is_large:
+            self._open_scan_file_in_batches(scan_file, sector_size,
+                       alternate_media_filename, alternate_hashdb_dir)
+            return
+
 #        # diagnostic only: use this to read and not catch
 #        self._data_reader.read(scan_file, sector_size,
 #                       alternate_media_filename, alternate_hashdb_dir)
@@ -70,3 +103,128 @@ class OpenManager():
         # accept the data, firing change
         self._data_manager.set_data(self._data_reader)
 
+
+    def _open_scan_file_in_batches(self, scan_file, sector_size,
+                       alternate_media_filename, alternate_hashdb_dir):
+        # read scan file attributes else show error window
+        try:
+            self._data_reader.read_attributes(scan_file, sector_size,
+                       alternate_media_filename, alternate_hashdb_dir)
+
+        except Exception as e:
+
+            # show error and do not accept
+            ErrorWindow(self._master, "Open Error", e)
+            return
+
+        # clear annotation filter settings
+        self._annotation_filter.set([])
+
+        # reset the histogram control settings
+        self._histogram_control.set_initial_view(self._data_reader.media_size,
+                                                 self._data_reader.sector_size)
+
+        # accept the empty data, firing change
+        self._data_manager.set_data(self._data_reader)
+
+        # start loading scan data in the background
+        self._scan_loader = ScanLoader(scan_file, sector_size,
+                                       self._data_reader.media_filename)
+        self._load_progress_window = LoadProgressWindow(self._master,
+                                       scan_file, self._scan_loader.cancel)
+        self._repaint_interval = REPAINT_INTERVAL
+        self._repaint_time = time.time()
+        self._master.after(POLL_INTERVAL, self._handle_poll_loader)
+
+    def _handle_poll_loader(self):
+        scan_loader = self._scan_loader
+        if scan_loader is None:
+            # a newer open replaced this load
+            return
+
+        # take done state before events so no final event is missed
+        is_done = scan_loader.is_done()
+        for event in scan_loader.get_events():
+            if event[0] == "data":
+                _, media_offsets, hashes, sources, bytes_done, bytes_total = \
+                                                                       event
+                self._pending_batches.append((media_offsets, hashes, sources))
+                self._load_progress_window.set_progress(bytes_done,
+                                   bytes_total, self._data_manager
+                                   .len_media_offsets + sum(len(batch[0])
+                                   for batch in self._pending_batches))
+
+            elif event[0] == "status":
+                self._load_progress_window.set_status(event[1])
+
+            elif event[0] == "done":
+                _, annotation_load_status, annotation_types, \
+                                                       annotations = event
+                self._append_pending_batches()
+                self._data_manager.finish_appending()
+                scan_loader.write_cache(self._data_manager.media_offsets,
+                                        self._data_manager.hashes,
+                                        self._data_manager.sources)
+                self._end_load()
+                self._data_manager.set_annotations(annotation_load_status,
+                                             annotation_types, annotations)
+
+                # report if annotation reader failed
+                if annotation_load_status:
+                    ErrorWindow(self._master, "Annotation Read Error",
+                                "%s" % annotation_load_status)
+                return
+
+            elif event[0] == "cancelled":
+                # keep the partial scan data
+                self._append_pending_batches()
+                self._data_manager.finish_appending()
+                self._end_load()
+                self._data_manager.set_annotations("", list(), list())
+                return
+
+            elif event[0] == "error":
+                # keep the partial scan data and show the error
+                self._append_pending_batches()
+                self._data_manager.finish_appending()
+                self._end_load()
+                self._data_manager.set_annotations("", list(), list())
+                ErrorWindow(self._master, "Open Error", event[1])
+                return
+
+        # repaint the histogram with new data periodically
+        if time.time() - self._repaint_time >= self._repaint_interval:
+            self._append_pending_batches()
+
+        if is_done:
+            # the loader stopped without a final event
+            self._append_pending_batches()
+            self._data_manager.finish_appending()
+            self._end_load()
+        else:
+            self._master.after(POLL_INTERVAL, self._handle_poll_loader)
+
+    def _append_pending_batches(self):
+        # append pending batches to the data manager in one change
+        if self._pending_batches:
+            batches = list(self._pending_batches)
+            del self._pending_batches[:]
+            t0 = time.time()
+            self._data_manager.append_data(batches)
+
+            # space repaints out as they get slower with more data
+            self._repaint_time = time.time()
+            self._repaint_interval = max(REPAINT_INTERVAL,
+                                         4 * (self._repaint_time - t0))
+
+    def _end_load(self):
+        self._scan_loader = None
+        self._load_progress_window.close()
+        self._load_progress_window = None
+
+    def _cancel_load(self):
+        # cancel and abandon any batch load in progress
+        if self._scan_loader is not None:
+            self._scan_loader.cancel()
+            del self._pending_batches[:]
+            self._end_load()
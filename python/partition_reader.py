@@ -0,0 +1,229 @@
+# Read DOS (MBR) and GPT partition tables in-process, listing volumes as
+# TSK mmls does: partitions, partition table metadata, and unallocated
+# gaps, in sector order, with mmls descriptions.  As with mmls, unallocated
+# gaps are the sectors in no partition, so they can overlap metadata such
+# as partition tables and extended partitions.
+
+import struct
+
+# DOS partition type descriptions, as mmls shows them
+_DOS_TYPES = {
+    0x01: "DOS FAT12",
+    0x04: "DOS FAT16",
+    0x05: "DOS Extended",
+    0x06: "DOS FAT16",
+    0x07: "NTFS / exFAT",
+    0x0b: "Win95 FAT32",
+    0x0c: "Win95 FAT32",
+    0x0e: "Win95 FAT16",
+    0x0f: "Win95 Extended",
+    0x11: "Hidden FAT12",
+    0x12: "Hidden FAT12",
+    0x14: "Hidden FAT16",
+    0x16: "Hidden FAT16",
+    0x17: "Hidden NTFS",
+    0x1b: "Hidden Win95 FAT32",
+    0x1c: "Hidden Win95 FAT32",
+    0x1e: "Hidden Win95 FAT16",
+    0x27: "Windows Recovery",
+    0x42: "Windows Dynamic Disk",
+    0x82: "Linux Swap / Solaris x86",
+    0x83: "Linux",
+    0x85: "Linux Extended",
+    0x8e: "Linux Logical Volume Manager",
+    0xa5: "FreeBSD",
+    0xa6: "OpenBSD",
+    0xa8: "Mac OSX",
+    0xa9: "NetBSD",
+    0xab: "Mac OSX Boot",
+    0xaf: "Mac OSX HFS",
+    0xee: "GPT Safety Partition",
+    0xef: "EFI File System",
+    0xfd: "Linux RAID",
+}
+
+# DOS partition types that hold an extended partition table
+_DOS_EXTENDED_TYPES = (0x05, 0x0f, 0x85)
+
+# limit on chained extended partition tables, against loops
+MAX_EXTENDED_TABLES = 256
+
+class PartitionTableError(Exception):
+    """Raised when a partition table is present but cannot be read."""
+
+def _dos_description(partition_type):
+    return "%s (0x%02x)" % (_DOS_TYPES.get(partition_type, "Unknown Type"),
+                            partition_type)
+
+def _dos_entries(sector):
+    # the (type, start, length) of each used entry in a DOS partition table
+    entries = list()
+    for i in range(4):
+        entry = sector[446 + i * 16:446 + (i + 1) * 16]
+        partition_type = entry[4]
+        start, length = struct.unpack("<II", entry[8:16])
+        if partition_type != 0 and length != 0:
+            entries.append((partition_type, start, length))
+    return entries
+
+def _has_dos_signature(sector):
+    return len(sector) >= 512 and sector[510:512] == b"\x55\xaa"
+
+def _is_boot_sector(sector):
+    # a NTFS or FAT volume boot record, whose boot code would read as
+    # partition entries
+    return sector[3:7] == b"NTFS" or sector[54:57] == b"FAT" or \
+           sector[82:87] == b"FAT32"
+
+def _read_dos(read_sector):
+    # return (start sector, number of sectors, description, is_meta)
+    # volumes
+    volumes = [(0, 1, "Primary Table (#0)", True)]
+    extended_base = None
+    tables = list()
+    for partition_type, start, length in _dos_entries(read_sector(0)):
+        if partition_type in _DOS_EXTENDED_TYPES:
+            # the first extended partition holds the chain of extended
+            # tables, each relative to the first extended partition
+            volumes.append((start, length,
+                            _dos_description(partition_type), True))
+            if extended_base is None:
+                extended_base = start
+                tables.append(start)
+        else:
+            volumes.append((start, length,
+                            _dos_description(partition_type), False))
+
+    table_number = 1
+    visited = set()
+    while tables:
+        table_sector = tables.pop(0)
+        if table_sector in visited or len(visited) >= MAX_EXTENDED_TABLES:
+            break
+        visited.add(table_sector)
+        sector = read_sector(table_sector)
+        if not _has_dos_signature(sector):
+            break
+        volumes.append((table_sector, 1,
+                        "Extended Table (#%d)" % table_number, True))
+        table_number += 1
+        for partition_type, start, length in _dos_entries(sector):
+            if partition_type in _DOS_EXTENDED_TYPES:
+                # the next extended table
+                next_table = extended_base + start
+                volumes.append((next_table, length,
+                                _dos_description(partition_type), True))
+                tables.append(next_table)
+            else:
+                # a logical partition, relative to this extended table
+                volumes.append((table_sector + start, length,
+                                _dos_description(partition_type), False))
+    return volumes
+
+def _read_gpt(read_sector, sector_size):
+    # return (start sector, number of sectors, description, is_meta)
+    # volumes, else None if there is no GPT header
+    header = read_sector(1)
+    if header[0:8] != b"EFI PART":
+        return None
+    entries_lba, = struct.unpack("<Q", header[72:80])
+    num_entries, entry_size = struct.unpack("<II", header[80:88])
+    if entry_size < 128 or num_entries > 65536:
+        raise PartitionTableError("invalid GPT header entry size %d or "
+                                  "count %d" % (entry_size, num_entries))
+    table_sectors = -(-num_entries * entry_size // sector_size)
+
+    volumes = [(0, 1, "Safety Table", True), (1, 1, "GPT Header", True),
+               (entries_lba, table_sectors, "Partition Table", True)]
+    table = bytearray()
+    for i in range(table_sectors):
+        table.extend(read_sector(entries_lba + i))
+    for i in range(num_entries):
+        entry = table[i * entry_size:(i + 1) * entry_size]
+        if len(entry) < 128:
+            break
+        if entry[0:16] == b"\0" * 16:
+            # unused entry
+            continue
+        first_lba, last_lba = struct.unpack("<QQ", entry[32:48])
+        name = bytes(entry[56:128]).decode("utf-16-le", "replace")
+        name = name.split("\0", 1)[0]
+        volumes.append((first_lba, last_lba - first_lba + 1, name, False))
+    return volumes
+
+def _add_unallocated(volumes, num_sectors):
+    # add Unallocated volumes for sectors in no partition, up to the end
+    # of the media image, then sort by start sector
+    allocated = sorted((start, start + length)
+                       for start, length, _, is_meta in volumes
+                       if length > 0 and not is_meta)
+    gaps = list()
+    sector = 0
+    for start, stop in allocated:
+        if start > sector:
+            gaps.append((sector, start - sector, "Unallocated", False))
+        sector = max(sector, stop)
+    if num_sectors > sector:
+        gaps.append((sector, num_sectors - sector, "Unallocated", False))
+
+    # stable sort keeps table order for volumes starting together
+    return sorted(volumes + gaps, key=lambda volume: volume[0])
+
+def read_partitions(read, media_size, sector_size):
+    """Read the DOS or GPT partition table of a media image.
+
+    Args:
+      read(function): Called with (offset, count) and returning bytes.
+      media_size(int): Size in bytes of the media image.
+      sector_size(int): The sector size that partition tables count in.
+
+    Returns:
+      list<(offset, length, text)> of volumes in byte offsets, with the
+        volume description that mmls shows as text, else None if there
+        is no partition table.
+
+    Raises:
+      PartitionTableError: if a partition table cannot be read.
+    """
+    def read_sector(sector):
+        return bytearray(read(sector * sector_size, sector_size))
+
+    mbr = read_sector(0)
+    if not _has_dos_signature(mbr) or _is_boot_sector(mbr):
+        return None
+
+    # a protective MBR means a GPT partition table
+    volumes = None
+    if any(partition_type == 0xee
+                      for partition_type, _, _ in _dos_entries(mbr)):
+        volumes = _read_gpt(read_sector, sector_size)
+    if volumes is None:
+        volumes = _read_dos(read_sector)
+        if len(volumes) == 1:
+            # a boot signature but no partitions, such as a volume boot
+            # record
+            return None
+
+    volumes = _add_unallocated(volumes, media_size // sector_size)
+    return [(start * sector_size, length * sector_size, text)
+            for start, length, text, _ in volumes]
+
+# main
+if __name__=="__main__":
+    # informal test harness: print volumes as mmls would
+    import sys
+    import os
+    media_filename = sys.argv[1]
+    sector_size = int(sys.argv[2]) if len(sys.argv) > 2 else 512
+    with open(media_filename, 'rb') as f:
+        def read(offset, count):
+            f.seek(offset)
+            return f.read(count)
+        volumes = read_partitions(read, os.path.getsize(media_filename),
+                                  sector_size)
+    if volumes is None:
+        sys.exit("no partition table")
+    for i, (offset, length, text) in enumerate(volumes):
+        print("%03d:  %010d   %010d   %010d   %s" % (i, offset // sector_size,
+              (offset + length) // sector_size - 1, length // sector_size,
+              text))
@@ -0,0 +1,182 @@
+# Receive the batches of lines that CommandRunner queues for a long running
+# hashdb command, as for scan_media and ingest.
+#
+# Output lines are written straight to the output file through a large
+# write buffer.  The progress text widget only shows a bounded ring of
+# recent lines, so a long command does not grow the widget without bound,
+# and the status line shows the throughput parsed from the output.
+
+import re
+import time
+from collections import deque
+import helpers
+try:
+    import tkinter
+except ImportError:
+    import Tkinter as tkinter
+
+# lines kept in the progress text widget
+MAX_PROGRESS_LINES = 1000
+
+# write buffer size for the output file
+OUTPUT_BUFFER_SIZE = 1024 * 1024
+
+# seconds between status line updates
+STATUS_INTERVAL = 1.0
+
+# the progress comment line of the scan engine and scan orchestrator
+_SCANNED = re.compile(r"# scanned (\d+) of")
+
+def _match_offset(line):
+    # the media offset of a scan match line, else None
+    offset = line.split("\t", 1)[0]
+    dash = offset.find('-')
+    try:
+        return int(offset if dash == -1 else offset[:dash])
+    except ValueError:
+        return None
+
+class ProgressSink():
+    """Show command output lines in a progress text widget and status label,
+    optionally writing them to an output file.
+
+    Attributes:
+      num_lines(int): The number of stdout lines received.
+      num_matches(int): The number of scan match lines received.
+      media_offset(int): The highest media offset of a scan match line
+        or of a "# scanned" progress comment line.
+    """
+
+    def __init__(self, progress_text, status_label, output_file=None,
+                 scan_output=False, media_size=None):
+        """Args:
+          progress_text(Text): The widget to show recent lines in.
+          status_label(Label): The label to show throughput in.
+          output_file(str): The file to write stdout and stderr lines to,
+            else None.
+          scan_output(bool): Whether stdout is scan_media output, whose
+            match lines are counted but only written to the output file.
+          media_size(int): The size of the media image being scanned, to
+            show progress as a percentage, else None.
+        """
+        self._progress_text = progress_text
+        self._status_label = status_label
+        self._scan_output = scan_output
+        self._media_size = media_size
+
+        # the output file, it is closed by close
+        self._outfile = None
+        if output_file:
+            self._outfile = open(output_file, 'w', OUTPUT_BUFFER_SIZE)
+
+        # the ring of recent lines not yet shown
+        self._pending_lines = deque(maxlen=MAX_PROGRESS_LINES)
+
+        self.num_lines = 0
+        self.num_matches = 0
+        self.media_offset = 0
+
+        # throughput since the last status update
+        self._t0 = time.time()
+        self._status_time = self._t0
+        self._status_lines = 0
+        self._status_matches = 0
+        self._status_offset = 0
+
+    def write(self, name, lines):
+        """Take a batch of output lines labeled by name, such as "stdout"
+        or "stderr"."""
+
+        # stderr and stdout lines go to the output file
+        if self._outfile and (name == "stderr" or name == "stdout"):
+            self._outfile.writelines(lines)
+
+        if name == "stdout":
+            self.num_lines += len(lines)
+
+            # report only comment lines from scan output
+            if self._scan_output:
+                comments = [line for line in lines if line[:1] == '#']
+                num_matches = len(lines) - len(comments)
+                if num_matches:
+                    self.num_matches += num_matches
+                    offset = _match_offset(lines[-1]) if \
+                                 lines[-1][:1] != '#' else None
+                    if offset is not None and offset > self.media_offset:
+                        self.media_offset = offset
+
+                # sharded scans only write match lines once done, so
+                # progress comes from their progress comment lines
+                for line in comments:
+                    m = _SCANNED.match(line)
+                    if m and int(m.group(1)) > self.media_offset:
+                        self.media_offset = int(m.group(1))
+                lines = comments
+
+        # the ring only keeps the most recent lines
+        self._pending_lines.extend("%s: %s" % (name, line)
+                               for line in lines[-MAX_PROGRESS_LINES:])
+
+    def show(self):
+        """Show pending lines, keeping the last MAX_PROGRESS_LINES lines in
+        the progress text widget, and update the status line when due."""
+        if self._pending_lines:
+            self._progress_text.insert(tkinter.END,
+                                       "".join(self._pending_lines))
+            self._pending_lines.clear()
+
+            # remove the oldest lines past the limit
+            num_lines = int(self._progress_text.index(
+                                             "end-1c").split(".")[0])
+            if num_lines > MAX_PROGRESS_LINES:
+                self._progress_text.delete("1.0", "%d.0" % (
+                                   num_lines - MAX_PROGRESS_LINES + 1))
+            self._progress_text.see(tkinter.END)
+
+        now = time.time()
+        if now - self._status_time >= STATUS_INTERVAL:
+            self._status_label["text"] = "Running... %s" % \
+                                          self._throughput_text(now)
+            self._status_time = now
+            self._status_lines = self.num_lines
+            self._status_matches = self.num_matches
+            self._status_offset = self.media_offset
+
+    def _throughput_text(self, now):
+        # throughput since the last status update
+        elapsed = max(now - self._status_time, 0.001)
+        if self._scan_output:
+            text = "to %s at %s/s, %d matches at %d/s" % (
+                    helpers.size_string(self.media_offset),
+                    helpers.size_string((self.media_offset -
+                                         self._status_offset) / elapsed),
+                    self.num_matches,
+                    (self.num_matches - self._status_matches) / elapsed)
+            if self._media_size:
+                text = "%d%% %s" % (100 * self.media_offset //
+                                    self._media_size, text)
+            return text
+        return "%d lines at %d lines/s" % (self.num_lines,
+                      (self.num_lines - self._status_lines) / elapsed)
+
+    def close(self):
+        """Show any pending lines and a summary of the totals, and close
+        the output file."""
+        self.show()
+        if self._outfile:
+            self._outfile.close()
+            self._outfile = None
+
+        elapsed = max(time.time() - self._t0, 0.001)
+        if self._scan_output:
+            summary = "Scanned to %s with %d matches in %.1f s, %s/s, " \
+                      "%d matches/s\n" % (
+                      helpers.size_string(self.media_offset),
+                      self.num_matches, elapsed,
+                      helpers.size_string(self.media_offset / elapsed),
+                      self.num_matches / elapsed)
+        else:
+            summary = "%d lines in %.1f s, %d lines/s\n" % (
+                      self.num_lines, elapsed, self.num_lines / elapsed)
+        self._progress_text.insert(tkinter.END, summary)
+        self._progress_text.see(tkinter.END)
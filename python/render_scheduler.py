@@ -0,0 +1,67 @@
+from timestamp import ts0, ts
+
+# change types from strongest to weakest, where drawing a stronger change
+# type also does everything a weaker change type draws
+CHANGE_PRIORITY = ("data_changed", "data_appended", "filter_changed",
+                   "plot_region_changed", "preferences_changed",
+                   "range_changed", "cursor_moved")
+_RANK = dict((change_type, rank)
+             for rank, change_type in enumerate(CHANGE_PRIORITY))
+
+def _rank(change_type):
+    # unknown change types are passed on as strongest
+    return _RANK.get(change_type, -1)
+
+class RenderScheduler():
+    """Coalesces draw requests into one draw per Tk idle cycle.
+
+    Requests made before the scheduled draw runs are merged into it,
+    keeping the strongest pending change type, so a burst of wheel zooms
+    or pan motion events costs one bucket calculation and repaint.
+
+    Attributes:
+      executed(int): The number of draws run.
+      dropped(int): The number of requests merged into another draw.
+    """
+
+    def __init__(self, widget, draw):
+        """Args:
+          widget(a Tk widget): Used to schedule idle callbacks.
+          draw(function): Called with the change type to draw.
+        """
+        self._widget = widget
+        self._draw = draw
+        self._pending_change_type = None
+        self._after_id = None
+        self.executed = 0
+        self.dropped = 0
+
+    def __repr__(self):
+        return "RenderScheduler(pending: %s, executed: %d, dropped: %d)" % (
+                 self._pending_change_type, self.executed, self.dropped)
+
+    def schedule(self, change_type):
+        """Request a draw of change_type on the next idle cycle."""
+        if self._pending_change_type is None:
+            self._pending_change_type = change_type
+            self._after_id = self._widget.after_idle(self._run)
+        else:
+            self.dropped += 1
+            if _rank(change_type) < _rank(self._pending_change_type):
+                self._pending_change_type = change_type
+
+    def flush(self):
+        """Run any pending draw now."""
+        if self._pending_change_type is not None:
+            self._widget.after_cancel(self._after_id)
+            self._run()
+
+    def _run(self):
+        change_type = self._pending_change_type
+        self._pending_change_type = None
+        self._after_id = None
+        self.executed += 1
+        t0 = ts0("render_scheduler.draw %s start" % change_type)
+        self._draw(change_type)
+        ts("render_scheduler.draw done (executed %d, dropped %d)" % (
+                                         self.executed, self.dropped), t0)
@@ -0,0 +1,572 @@
+# Read and write the binary sidecar cache of a parsed scan file.
+#
+# The sidecar is written next to the scan file and is valid while the
+# scan file path, size, and mtime, the sector size, the media filename,
+# size, and mtime, the byte order, and the cache version all match.
+# Layout:
+#   magic, version(uint32), header length(uint32), JSON header,
+#   zero padding to an 8-byte boundary, then sections, each 8-byte
+#   aligned, at the positions the header lists:
+#   offsets, hash_indexes, digests, the columns of the media offsets;
+#   hash records, one fixed-width record per digest: flags, count,
+#     k_entropy, block label position and size, position and size of JSON
+#     of any other fields, first source index and number of source
+#     indexes, and first listed source and number of listed sources;
+#   source indexes, (source table index, sub count) uint32 pairs;
+#   listed sources, the uint32 source table indexes of the sources listed
+#     with each hash;
+#   source table, fixed-width records sorted by digest: file hash digest,
+#     JSON position, and JSON size;
+#   text, block labels and the JSON of hashes and sources;
+#   JSON annotations.
+#
+# The media offsets columns are used in place from the memory mapped
+# sidecar, and hash and source data is read in place, decoding a hash or
+# source the first time it is used, so reopening a scan does not copy or
+# decode the scan data up front.
+
+import os
+import sys
+import json
+import mmap
+import struct
+from array import array
+from binascii import hexlify, unhexlify
+from media_offsets import MediaOffsets, OFFSET_TYPECODE, \
+                          HASH_INDEX_TYPECODE, DIGEST_SIZE
+try:
+    from collections.abc import MutableMapping
+except ImportError:
+    # Python 2.7
+    from collections import MutableMapping
+
+SCAN_CACHE_MAGIC = b"SSCACHE\0"
+# version 2 drops caches that may hold annotations read while an fsstat
+# probe failed, version 3 reads hash and source data in place
+SCAN_CACHE_VERSION = 3
+SCAN_CACHE_SUFFIX = ".sscache"
+
+_PREFIX = struct.Struct("<8sII")
+
+# flags, count, k_entropy, block label position, block label size, JSON
+# position, JSON size, first source index, number of source indexes, first
+# listed source, number of listed sources
+_HASH_RECORD = struct.Struct("<BIIQIQIIIII")
+
+# hash record flags for the hash data present
+_HAS_DATA = 1
+_HAS_COUNT = 2
+_HAS_K_ENTROPY = 4
+_HAS_BLOCK_LABEL = 8
+_HAS_JSON = 16
+_HAS_SOURCES = 32
+
+# largest value of a uint32 record field
+_UINT32_MAX = 0xffffffff
+
+# one (source table index, sub count) pair
+_SOURCE_INDEX = struct.Struct("<II")
+
+# file hash digest, JSON position, JSON size
+_SOURCE_RECORD = struct.Struct("<%dsQI" % DIGEST_SIZE)
+
+# the sections in file order
+_SECTIONS = ("offsets", "hash_indexes", "digests", "hash_records",
+             "source_indexes", "listed_sources", "source_table", "text",
+             "annotations")
+
+def scan_cache_filename(scan_file):
+    """The sidecar cache filename for scan_file."""
+    return scan_file + SCAN_CACHE_SUFFIX
+
+def _cache_key(scan_file, sector_size, media_filename):
+    st = os.stat(scan_file)
+    try:
+        media_st = os.stat(media_filename)
+        media_size = media_st.st_size
+        media_mtime = media_st.st_mtime
+    except (OSError, TypeError):
+        # the media image is not available
+        media_size = None
+        media_mtime = None
+    return {"scan_file": os.path.abspath(scan_file),
+            "scan_file_size": st.st_size,
+            "scan_file_mtime": st.st_mtime,
+            "sector_size": sector_size,
+            "media_filename": media_filename,
+            "media_size": media_size,
+            "media_mtime": media_mtime,
+            "byteorder": sys.byteorder,
+            "offset_itemsize": array(OFFSET_TYPECODE).itemsize,
+            "hash_index_itemsize": array(HASH_INDEX_TYPECODE).itemsize}
+
+def _frombytes(typecode, data):
+    a = array(typecode)
+    try:
+        a.frombytes(data)
+    except AttributeError:
+        # Python 2.7
+        a.fromstring(data)
+    return a
+
+def _is_uint32(value):
+    # whether value fits a uint32 record field
+    return isinstance(value, int) and not isinstance(value, bool) and \
+                                      0 <= value <= _UINT32_MAX
+
+class _CachedTable(MutableMapping):
+    # a mapping read in place from a fixed-width table of the sidecar,
+    # decoding each value the first time it is used.  Decoded and set
+    # values are kept in _values, so they are decoded once and can be
+    # changed.  Subclasses provide _find(key), the table index of key else
+    # -1, _key(index), the key at index else None if the table has no
+    # value there, and _decode(index).
+    def __init__(self, num_entries, num_keys):
+        self._num_entries = num_entries
+        self._num_keys = num_keys
+        self._values = dict()
+        self._deleted = set()
+        self._len = num_keys
+
+    def __contains__(self, key):
+        if key in self._values:
+            return True
+        return key not in self._deleted and self._find(key) != -1
+
+    def __getitem__(self, key):
+        try:
+            return self._values[key]
+        except KeyError:
+            pass
+        index = -1 if key in self._deleted else self._find(key)
+        if index == -1:
+            raise KeyError(key)
+        value = self._decode(index)
+        self._values[key] = value
+        return value
+
+    def __setitem__(self, key, value):
+        self._values[key] = value
+        self._deleted.discard(key)
+        self._len = None
+
+    def __delitem__(self, key):
+        if key not in self:
+            raise KeyError(key)
+        self._values.pop(key, None)
+        if self._find(key) != -1:
+            self._deleted.add(key)
+        self._len = None
+
+    def __iter__(self):
+        for index in range(self._num_entries):
+            key = self._key(index)
+            if key is not None and key not in self._deleted:
+                yield key
+        # a snapshot, another thread may be decoding values
+        for key in list(self._values):
+            if self._find(key) == -1:
+                yield key
+
+    def __len__(self):
+        if self._len is None:
+            # a snapshot, another thread may be decoding values
+            self._len = self._num_keys - len(self._deleted) + sum(
+                    1 for key in list(self._values) if self._find(key) == -1)
+        return self._len
+
+class _CachedSources(_CachedTable):
+    # source data keyed by file hash hexcode, from the sorted source table
+    def __init__(self, mm, table_position, num_entries, num_keys,
+                 text_position):
+        _CachedTable.__init__(self, num_entries, num_keys)
+        self._mm = mm
+        self._table_position = table_position
+        self._text_position = text_position
+
+        # one string per file hash, shared by the hashes that use it
+        self._file_hashes = dict()
+
+    def _record(self, index):
+        return _SOURCE_RECORD.unpack_from(self._mm, self._table_position +
+                                          index * _SOURCE_RECORD.size)
+
+    def file_hash(self, index):
+        # the file hash hexcode at index, which may have no source data
+        try:
+            return self._file_hashes[index]
+        except KeyError:
+            file_hash = hexlify(self._record(index)[0]).decode('ascii')
+            self._file_hashes[index] = file_hash
+            return file_hash
+
+    def _find(self, file_hash):
+        # bisect the table, which is sorted by digest
+        try:
+            digest = unhexlify(file_hash)
+        except (TypeError, ValueError):
+            return -1
+        lo = 0
+        hi = self._num_entries
+        while lo < hi:
+            mid = (lo + hi) // 2
+            if self._record(mid)[0] < digest:
+                lo = mid + 1
+            else:
+                hi = mid
+        if lo < self._num_entries:
+            record = self._record(lo)
+            if record[0] == digest and record[2]:
+                return lo
+        return -1
+
+    def _key(self, index):
+        return self.file_hash(index) if self._record(index)[2] else None
+
+    def _decode(self, index):
+        _, position, size = self._record(index)
+        start = self._text_position + position
+        return json.loads(self._mm[start:start + size].decode('utf-8'))
+
+    def source(self, index):
+        # the source data at index, which must have source data
+        return self[self.file_hash(index)]
+
+class _CachedHashes(_CachedTable):
+    # hash data keyed by block hash hexcode, from the hash records, which
+    # are in the digest table order of media_offsets
+    def __init__(self, mm, records_position, num_entries, num_keys,
+                 source_indexes_position, listed_sources_position,
+                 text_position, media_offsets, sources):
+        _CachedTable.__init__(self, num_entries, num_keys)
+        self._mm = mm
+        self._records_position = records_position
+        self._source_indexes_position = source_indexes_position
+        self._listed_sources_position = listed_sources_position
+        self._text_position = text_position
+        self._media_offsets = media_offsets
+        self._sources = sources
+
+    def _record(self, index):
+        return _HASH_RECORD.unpack_from(self._mm, self._records_position +
+                                        index * _HASH_RECORD.size)
+
+    def _find(self, block_hash):
+        try:
+            index = self._media_offsets.find_hash_index(block_hash)
+        except (TypeError, ValueError):
+            return -1
+        if 0 <= index < self._num_entries and \
+                                 self._record(index)[0] & _HAS_DATA:
+            return index
+        return -1
+
+    def _key(self, index):
+        return self._media_offsets.block_hash(index) \
+                          if self._record(index)[0] & _HAS_DATA else None
+
+    def _decode(self, index):
+        (flags, count, k_entropy, label_position, label_size,
+         json_position, json_size, first_source, num_sources,
+         first_listed, num_listed) = self._record(index)
+        mm = self._mm
+        if flags & _HAS_JSON:
+            start = self._text_position + json_position
+            hash_data = json.loads(mm[start:start + json_size]
+                                                      .decode('utf-8'))
+        else:
+            hash_data = dict()
+        if flags & _HAS_COUNT:
+            hash_data["count"] = count
+        if flags & _HAS_K_ENTROPY:
+            hash_data["k_entropy"] = k_entropy
+        if flags & _HAS_BLOCK_LABEL:
+            start = self._text_position + label_position
+            hash_data["block_label"] = mm[start:start + label_size] \
+                                                         .decode('utf-8')
+
+        # the source sub counts and source_hashes from the source indexes
+        pairs = struct.unpack_from("<%dI" % (num_sources * 2), mm,
+                                   self._source_indexes_position +
+                                   first_source * _SOURCE_INDEX.size)
+        file_hash = self._sources.file_hash
+        source_sub_counts = list()
+        for i in range(0, len(pairs), 2):
+            source_sub_counts.append(file_hash(pairs[i]))
+            source_sub_counts.append(pairs[i + 1])
+        hash_data["source_sub_counts"] = source_sub_counts
+        hash_data["source_hashes"] = set(source_sub_counts[0::2])
+
+        # the sources listed with the hash, shared with the source data
+        if flags & _HAS_SOURCES:
+            source = self._sources.source
+            hash_data["sources"] = [source(i) for i in struct.unpack_from(
+                                   "<%dI" % num_listed, mm,
+                                   self._listed_sources_position +
+                                   first_listed * 4)]
+        return hash_data
+
+def read_scan_cache(scan_file, sector_size, media_filename):
+    """Read the sidecar cache of scan_file if it is valid.
+
+    The returned hashes and sources are mappings that read the memory
+    mapped sidecar in place, decoding each hash or source on first use.
+
+    Returns:
+      None if there is no valid cache, else a tuple of media_offsets,
+      hashes, sources, and annotations, where annotations is None if they
+      were not cached, else a tuple of annotation_types and annotations.
+    """
+    cache_file = scan_cache_filename(scan_file)
+    try:
+        key = _cache_key(scan_file, sector_size, media_filename)
+        with open(cache_file, 'rb') as f:
+            mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+    except (IOError, OSError, ValueError):
+        # no cache
+        return None
+
+    try:
+        magic, version, header_size = _PREFIX.unpack_from(mm, 0)
+        if magic != SCAN_CACHE_MAGIC or version != SCAN_CACHE_VERSION:
+            mm.close()
+            return None
+        position = _PREFIX.size
+        header = json.loads(mm[position:position + header_size]
+                                                      .decode('utf-8'))
+        if header["key"] != key:
+            mm.close()
+            return None
+        position += header_size
+        position += -position % 8
+
+        # absolute section positions
+        sections = dict((name, (position + start, size)) for name,
+                        (start, size) in header["sections"].items())
+        def section(name):
+            start, size = sections[name]
+            return mm[start:start + size]
+
+        # annotations
+        cached_annotations = json.loads(section("annotations")
+                                                       .decode('utf-8'))
+        if cached_annotations is None:
+            annotations = None
+        else:
+            annotation_types, annotation_list = cached_annotations
+            annotations = ([tuple(t) for t in annotation_types],
+                           [tuple(a) for a in annotation_list])
+
+        # the media offsets columns, used in place
+        def column(name, typecode):
+            start, size = sections[name]
+            try:
+                return memoryview(mm)[start:start + size].cast(typecode)
+            except (AttributeError, TypeError):
+                # Python 2.7
+                return _frombytes(typecode, mm[start:start + size])
+        media_offsets = MediaOffsets()
+        media_offsets.set_columns(column("offsets", OFFSET_TYPECODE),
+                                  column("hash_indexes", HASH_INDEX_TYPECODE),
+                                  column("digests", 'B'))
+
+        # hash and source data read in place
+        sources = _CachedSources(mm, sections["source_table"][0],
+                                 header["num_source_entries"],
+                                 header["num_sources"],
+                                 sections["text"][0])
+        hashes = _CachedHashes(mm, sections["hash_records"][0],
+                               media_offsets.num_hashes(),
+                               header["num_hashes"],
+                               sections["source_indexes"][0],
+                               sections["listed_sources"][0],
+                               sections["text"][0], media_offsets, sources)
+
+    except Exception as e:
+        print("scan cache: ignoring unreadable cache %s: %s" %
+                                                  (cache_file, e))
+        try:
+            mm.close()
+        except BufferError:
+            # column views still refer to it, it closes when they are freed
+            pass
+        return None
+
+    return (media_offsets, hashes, sources, annotations)
+
+def write_scan_cache(scan_file, sector_size, media_filename,
+                     media_offsets, hashes, sources, annotations):
+    """Write the sidecar cache of scan_file.  Failure to write is not an
+    error, the scan file is just parsed again next time.
+
+    Args:
+      annotations: None to not cache annotations, else a tuple of
+        annotation_types and annotations.
+    """
+    cache_file = scan_cache_filename(scan_file)
+    temp_file = cache_file + ".tmp"
+    try:
+        offsets, hash_indexes, digests = media_offsets.columns()
+
+        # the source table has every source and every file hash a hash
+        # refers to, sorted by digest
+        file_hashes = set(sources)
+        for hash_data in hashes.values():
+            file_hashes.update(hash_data["source_sub_counts"][0::2])
+        file_hashes = sorted(file_hashes, key=unhexlify)
+        source_table_indexes = dict((file_hash, i) for i, file_hash
+                                    in enumerate(file_hashes))
+
+        # block labels and JSON of hashes and sources, addressed by the
+        # fixed-width records
+        text_parts = list()
+        text_size = [0]
+        def add_text(data):
+            position = text_size[0]
+            text_parts.append(data)
+            text_size[0] += len(data)
+            return position
+
+        hash_records = bytearray(media_offsets.num_hashes() *
+                                 _HASH_RECORD.size)
+        source_indexes = list()
+        listed_sources = list()
+        for block_hash, hash_data in hashes.items():
+            hash_index = media_offsets.find_hash_index(block_hash)
+            if hash_index == -1:
+                raise ValueError("hash %s is not in the media offsets" %
+                                                              block_hash)
+            flags = _HAS_DATA
+            other = dict(hash_data)
+            del other["source_hashes"]
+
+            # the source sub counts as source indexes
+            source_sub_counts = other.pop("source_sub_counts")
+            first_source = len(source_indexes) // 2
+            for file_hash, sub_count in zip(source_sub_counts[0::2],
+                                            source_sub_counts[1::2]):
+                source_indexes.append(source_table_indexes[file_hash])
+                source_indexes.append(sub_count)
+
+            # fields with fixed-width values, else they stay in the JSON
+            count = other.get("count")
+            if _is_uint32(count):
+                flags |= _HAS_COUNT
+                del other["count"]
+            k_entropy = other.get("k_entropy")
+            if _is_uint32(k_entropy):
+                flags |= _HAS_K_ENTROPY
+                del other["k_entropy"]
+            label_position = label_size = 0
+            block_label = other.get("block_label")
+            if isinstance(block_label, type(u"")):
+                flags |= _HAS_BLOCK_LABEL
+                del other["block_label"]
+                label = block_label.encode('utf-8')
+                label_position = add_text(label)
+                label_size = len(label)
+
+            # the listed sources as source indexes when they are the
+            # source data of the sources table
+            first_listed = len(listed_sources)
+            listed = other.get("sources")
+            if isinstance(listed, list) and all(isinstance(source, dict)
+                        and sources.get(source.get("file_hash")) == source
+                        for source in listed):
+                flags |= _HAS_SOURCES
+                del other["sources"]
+                listed_sources.extend(source_table_indexes[
+                                 source["file_hash"]] for source in listed)
+
+            json_position = json_size = 0
+            if other:
+                flags |= _HAS_JSON
+                json_bytes = json.dumps(other).encode('utf-8')
+                json_position = add_text(json_bytes)
+                json_size = len(json_bytes)
+
+            _HASH_RECORD.pack_into(hash_records,
+                     hash_index * _HASH_RECORD.size, flags,
+                     count if flags & _HAS_COUNT else 0,
+                     k_entropy if flags & _HAS_K_ENTROPY else 0,
+                     label_position, label_size, json_position, json_size,
+                     first_source, len(source_sub_counts) // 2,
+                     first_listed, len(listed_sources) - first_listed)
+
+        source_table = bytearray(len(file_hashes) * _SOURCE_RECORD.size)
+        for i, file_hash in enumerate(file_hashes):
+            digest = unhexlify(file_hash)
+            if len(digest) != DIGEST_SIZE:
+                raise ValueError("Invalid file hash '%s'" % file_hash)
+            if file_hash in sources:
+                json_bytes = json.dumps(sources[file_hash]).encode('utf-8')
+                _SOURCE_RECORD.pack_into(source_table,
+                                 i * _SOURCE_RECORD.size, digest,
+                                 add_text(json_bytes), len(json_bytes))
+            else:
+                _SOURCE_RECORD.pack_into(source_table,
+                                 i * _SOURCE_RECORD.size, digest, 0, 0)
+
+        source_indexes = struct.pack("<%dI" % len(source_indexes),
+                                     *source_indexes)
+        listed_sources = struct.pack("<%dI" % len(listed_sources),
+                                     *listed_sources)
+        annotations_bytes = json.dumps(annotations).encode('utf-8')
+
+        # section positions after the header, 8-byte aligned
+        sizes = {"offsets": len(offsets) * offsets.itemsize,
+                 "hash_indexes": len(hash_indexes) * hash_indexes.itemsize,
+                 "digests": len(digests),
+                 "hash_records": len(hash_records),
+                 "source_indexes": len(source_indexes),
+                 "listed_sources": len(listed_sources),
+                 "source_table": len(source_table),
+                 "text": text_size[0],
+                 "annotations": len(annotations_bytes)}
+        sections = dict()
+        position = 0
+        for name in _SECTIONS:
+            sections[name] = (position, sizes[name])
+            position += sizes[name]
+            position += -position % 8
+
+        header = json.dumps({
+                "key": _cache_key(scan_file, sector_size, media_filename),
+                "num_hashes": len(hashes),
+                "num_sources": len(sources),
+                "num_source_entries": len(file_hashes),
+                "sections": sections}).encode('utf-8')
+
+        with open(temp_file, 'wb') as f:
+            f.write(_PREFIX.pack(SCAN_CACHE_MAGIC, SCAN_CACHE_VERSION,
+                                 len(header)))
+            f.write(header)
+            f.write(b"\0" * (-(_PREFIX.size + len(header)) % 8))
+            for name in _SECTIONS:
+                if name == "offsets":
+                    f.write(offsets)
+                elif name == "hash_indexes":
+                    f.write(hash_indexes)
+                elif name == "text":
+                    for text in text_parts:
+                        f.write(text)
+                else:
+                    f.write({"digests": digests,
+                             "hash_records": hash_records,
+                             "source_indexes": source_indexes,
+                             "listed_sources": listed_sources,
+                             "source_table": source_table,
+                             "annotations": annotations_bytes}[name])
+                f.write(b"\0" * (-sizes[name] % 8))
+
+        # replace any previous cache
+        if os.path.exists(cache_file):
+            os.remove(cache_file)
+        os.rename(temp_file, cache_file)
+
+    except Exception as e:
+        print("scan cache: unable to write cache %s: %s" % (cache_file, e))
+        try:
+            os.remove(temp_file)
+        except OSError:
+            pass
@@ -0,0 +1,497 @@
+#!/usr/bin/env python3
+# Scan a media image for block hashes in a hash database without hashdb
+# scan_media, hashing blocks in parallel processes.
+#
+# The hash database is read from hashdb export output into a local hash
+# set.  The media image is split into large step-aligned byte ranges, and
+# worker processes read each range with one large read, MD5 each block at
+# the step size, and return the blocks whose hashes are in the hash set.
+# Matches are written in media offset order in the scan file format that
+# DataReader reads: the full hash and source JSON the first time a hash is
+# seen and {} after that.
+
+import os
+import sys
+import json
+import time
+import hashlib
+import shutil
+import binascii
+from collections import deque
+import helpers
+from media_reader import MediaReader
+from scan_file_parser import num_workers
+try:
+    from concurrent.futures import ProcessPoolExecutor
+except ImportError:
+    # Python 2.7 without the futures backport
+    ProcessPoolExecutor = None
+try:
+    import multiprocessing
+    _FORK_CONTEXT = multiprocessing.get_context("fork")
+except (AttributeError, ValueError):
+    # Python 2.7, or no fork on Windows
+    _FORK_CONTEXT = None
+
+# the version shown in the scan file header
+SCAN_ENGINE_VERSION = "sectorscope scan_engine 1.0"
+
+# bytes of media image read and hashed by one task
+RANGE_SIZE = 16 * 1024 * 1024
+
+# tasks queued per worker process, so workers stay busy while the main
+# process writes matches
+TASKS_PER_WORKER = 4
+
+# seconds between progress comment lines
+PROGRESS_INTERVAL = 5.0
+
+# exported hash sets, reused until the hash database changes
+HASH_SET_DIR = os.path.join(os.path.expanduser("~"), ".sectorscope",
+                            "hash_sets")
+
+class HashSet():
+    """The block hashes of a hash database, read from hashdb export
+    output, with the hash and source JSON to write for a match.
+
+    JSON lines are kept as text and only decoded for hashes that match.
+
+    Attributes:
+      export_file(str): The export file the hash set was read from.
+    """
+
+    def __init__(self, export_file):
+        """Args:
+          export_file(str): The output of hashdb export, else a file of
+            block hash and source JSON lines in the same format.
+        """
+        self.export_file = export_file
+        self._blocks = dict()
+        self._sources = dict()
+        self._digests = None
+        with open(export_file, 'r') as f:
+            for line in f:
+                line = line.strip()
+                if not line or line[0] == '#':
+                    continue
+                json_data = json.loads(line)
+                if "block_hash" in json_data:
+                    self._blocks[json_data["block_hash"]] = line
+                elif "file_hash" in json_data:
+                    self._sources[json_data["file_hash"]] = line
+
+    def __len__(self):
+        return len(self._blocks)
+
+    def digests(self):
+        """Return the set of binary MD5 digests of the block hashes."""
+        if self._digests is None:
+            self._digests = frozenset(binascii.unhexlify(block_hash)
+                                      for block_hash in self._blocks)
+        return self._digests
+
+    def payload(self, block_hash):
+        """Return the JSON text describing block_hash and its sources, as
+        hashdb scan_media writes the first time a hash is seen."""
+        json_data = json.loads(self._blocks[block_hash])
+        source_sub_counts = json_data.get("source_sub_counts", [])
+        if "count" not in json_data:
+            json_data["count"] = sum(source_sub_counts[1::2])
+        json_data["sources"] = [json.loads(self._sources[file_hash])
+                                for file_hash in source_sub_counts[0::2]
+                                if file_hash in self._sources]
+        return json.dumps(json_data, separators=(',', ':'))
+
+def _export_filename(hashdb_dir):
+    # the cached export file of hashdb_dir
+    return os.path.join(HASH_SET_DIR, hashlib.sha1(os.path.abspath(
+                    hashdb_dir).encode('utf-8')).hexdigest() + ".json")
+
+def cached_hash_set(hashdb_dir):
+    """Return the path to the cached export of hashdb_dir if it is newer
+    than every file in the hash database, else None."""
+    export_file = _export_filename(hashdb_dir)
+    if not os.path.exists(export_file):
+        return None
+    newest = 0
+    for dirpath, _, filenames in os.walk(hashdb_dir):
+        for filename in filenames:
+            newest = max(newest, os.path.getmtime(os.path.join(dirpath,
+                                                               filename)))
+    if os.path.getmtime(export_file) < newest:
+        return None
+    return export_file
+
+def has_hashdb():
+    """Return whether the hashdb program is on the PATH."""
+    try:
+        return shutil.which("hashdb") is not None
+    except AttributeError:
+        # Python 2.7, assume hashdb is installed
+        return True
+
+def can_scan(hashdb_dir):
+    """Return whether the scan engine can get the hash set of hashdb_dir
+    without being given an export file, which needs hashdb unless a
+    current export is cached."""
+    return has_hashdb() or cached_hash_set(hashdb_dir) is not None
+
+def export_hash_set(hashdb_dir):
+    """Export hashdb_dir with hashdb export, reusing a previous export that
+    is newer than every file in the hash database.
+
+    Returns:
+      The path to the export file.
+
+    Raises:
+      RuntimeError: if hashdb export fails.
+    """
+    hashdb_dir = os.path.abspath(hashdb_dir)
+    export_file = cached_hash_set(hashdb_dir)
+    if export_file:
+        return export_file
+    export_file = _export_filename(hashdb_dir)
+
+    if not os.path.isdir(HASH_SET_DIR):
+        os.makedirs(HASH_SET_DIR)
+    temp_file = export_file + ".tmp"
+    if os.path.exists(temp_file):
+        os.remove(temp_file)
+    cmd = ["hashdb", "export", hashdb_dir, temp_file]
+    try:
+        error_message, _ = helpers.run_short_command(cmd)
+    except (IOError, OSError):
+        raise RuntimeError("hashdb not found.  Please check that it is "
+                           "installed or provide an exported hash set.")
+    if error_message:
+        raise RuntimeError(error_message)
+
+    # replace any previous export
+    if os.path.exists(export_file):
+        os.remove(export_file)
+    os.rename(temp_file, export_file)
+    return export_file
+
+# the hash set digests of a worker process, inherited from the parent
+# process where processes fork, else loaded by _init_worker
+_digests = None
+
+def _init_worker(export_file):
+    # load the hash set digests once per worker process unless they were
+    # inherited
+    global _digests
+    if _digests is None:
+        _digests = HashSet(export_file).digests()
+
+def _scan_range(media_filename, start, stop, step_size, block_size,
+                digests=None):
+    """Hash the blocks of media_filename starting in byte range
+    [start, stop) at step_size.  A block running past the end of the
+    media image is zero padded and all-zero blocks are skipped, as in
+    hashdb.
+
+    Returns:
+      list<(offset, block_hash)> of blocks whose MD5 is in digests, else
+      in the worker's hash set.
+    """
+    if digests is None:
+        digests = _digests
+
+    # read the range and the tail of its last block in one read
+    last = start + (stop - start - 1) // step_size * step_size
+    count = last + block_size - start
+    media_reader = MediaReader(media_filename)
+    try:
+        error_message, buf = media_reader.read(start, count)
+    finally:
+        media_reader.close()
+    if error_message:
+        raise IOError(error_message)
+    if len(buf) < count:
+        buf.extend(bytearray(count - len(buf)))
+
+    zero_block = bytes(bytearray(block_size))
+    md5 = hashlib.md5
+    view = memoryview(buf)
+    matches = list()
+    for offset in range(start, stop, step_size):
+        block = view[offset - start:offset - start + block_size]
+        if block == zero_block:
+            continue
+        digest = md5(block).digest()
+        if digest in digests:
+            matches.append((offset, binascii.hexlify(digest)
+                                                   .decode('ascii')))
+    return matches
+
+def _iter_ranges(media_filename, ranges, step_size, block_size, digests,
+                 export_file, workers):
+    # yield the matches of each range in range order, hashing ranges in
+    # parallel processes when workers is more than one.  Forked workers
+    # share the parent's digests copy-on-write rather than each getting a
+    # pickled copy, other workers load them from export_file.
+    global _digests
+    executor = None
+    if ProcessPoolExecutor is not None and workers > 1 and len(ranges) > 1:
+        try:
+            _digests = digests
+            executor = ProcessPoolExecutor(workers,
+                          mp_context=_FORK_CONTEXT,
+                          initializer=_init_worker, initargs=(export_file,))
+        except (OSError, RuntimeError, TypeError) as e:
+            # no process support, or no initializer before Python 3.7
+            print("# scan engine: scanning serially: %s" % e)
+            executor = None
+
+    try:
+        pending = deque()
+        next_range = 0
+        for start, stop in ranges:
+            # keep the workers busy
+            while executor is not None and next_range < len(ranges) and \
+                            len(pending) < workers * TASKS_PER_WORKER:
+                range_start, range_stop = ranges[next_range]
+                pending.append(executor.submit(_scan_range, media_filename,
+                            range_start, range_stop, step_size, block_size))
+                next_range += 1
+
+            matches = None
+            if executor is not None:
+                try:
+                    matches = pending.popleft().result()
+                except (OSError, RuntimeError) as e:
+                    # a worker died, scan the remaining ranges here
+                    print("# scan engine: scanning serially: %s" % e)
+                    executor.shutdown(wait=False)
+                    executor = None
+            if matches is None:
+                matches = _scan_range(media_filename, start, stop,
+                                      step_size, block_size, digests)
+            yield stop, matches
+
+    finally:
+        if executor is not None:
+            for future in pending:
+                future.cancel()
+            executor.shutdown(wait=False)
+
+def write_scan_header(out, command, media_size):
+    """Write the three header lines of a scan file, which
+    helpers.get_scan_file_attributes reads.
+
+    Args:
+      out(file): The scan file.
+      command(list): The scan command, ending with the hash database
+        directory and the media image.
+      media_size(int): The size in bytes of the media image.
+    """
+    out.write("# command: %s\n" % " ".join(command))
+    out.write("# hashdb-Version: %s\n" % SCAN_ENGINE_VERSION)
+    out.write("# Scanning media image of size %d\n" % media_size)
+
+def scan_media(media_filename, hash_set, step_size, block_size, out,
+               workers=None, start_offset=0, stop_offset=None):
+    """Scan media_filename for blocks in hash_set, writing matches to out
+    in scan file format in media offset order, with progress comment
+    lines.  The scan file header is not written.
+
+    Args:
+      media_filename(str): The media image to scan.
+      hash_set(HashSet): The block hashes to match.
+      step_size(int): The step between hashed blocks.
+      block_size(int): The size of hashed blocks.
+      out(file): The file to write matches to.
+      workers(int): The number of worker processes, default one per
+        available CPU.
+      start_offset(int): The offset to start scanning at, a multiple of
+        step_size.
+      stop_offset(int): The offset to stop scanning blocks at, default
+        the end of the media image.
+
+    Returns:
+      The number of matches.
+
+    Raises IOError if the media image cannot be read.
+    """
+    if workers is None:
+        workers = num_workers()
+    media_reader = MediaReader(media_filename)
+    media_size = media_reader.media_size()
+    media_reader.close()
+    if media_size is None:
+        raise IOError("unable to read the size of media image %s" %
+                                                          media_filename)
+
+    # step-aligned ranges
+    if stop_offset is None or stop_offset > media_size:
+        stop_offset = media_size
+    range_size = max(step_size, RANGE_SIZE // step_size * step_size)
+    ranges = [(start, min(start + range_size, stop_offset))
+              for start in range(start_offset, stop_offset, range_size)]
+
+    t0 = time.time()
+    progress_time = t0
+    seen = set()
+    num_matches = 0
+    for stop, matches in _iter_ranges(media_filename, ranges, step_size,
+                                      block_size, hash_set.digests(),
+                                      hash_set.export_file, workers):
+        lines = list()
+        for offset, block_hash in matches:
+            if block_hash in seen:
+                lines.append("%d\t%s\t{}\n" % (offset, block_hash))
+            else:
+                seen.add(block_hash)
+                lines.append("%d\t%s\t%s\n" % (offset, block_hash,
+                                               hash_set.payload(block_hash)))
+        out.write("".join(lines))
+        num_matches += len(matches)
+
+        now = time.time()
+        if now - progress_time >= PROGRESS_INTERVAL:
+            out.write("# scanned %d of %d bytes, %d matches\n" % (
+                                           stop, media_size, num_matches))
+            out.flush()
+            progress_time = now
+
+    out.write("# scan completed in %.1f s, %d matches\n" % (
+                                           time.time() - t0, num_matches))
+    out.flush()
+    return num_matches
+
+def make_synthetic_test_data(temp_dir, size_mib, block_size=512):
+    """Write a synthetic media image and a synthetic hashdb export for
+    informal testing.
+
+    Returns:
+      (media, export_file, expected) where expected maps the offset of
+      each block in the hash set to its block hash.
+    """
+    import random
+    random.seed(1)
+    # media image of random blocks, with known blocks at known offsets
+    media = os.path.join(temp_dir, "media.raw")
+    known = [bytes(bytearray(random.getrandbits(8)
+             for _ in range(block_size))) for _ in range(20)]
+    num_blocks = size_mib * 1024 * 1024 // block_size
+    expected = dict()
+    with open(media, 'wb') as f:
+        for i in range(num_blocks):
+            if i % 997 == 3:
+                block = known[i % len(known)]
+                expected[i * block_size] = hashlib.md5(block).hexdigest()
+            elif i % 5 == 0:
+                block = bytes(bytearray(block_size))
+            else:
+                block = os.urandom(block_size)
+            f.write(block)
+
+    # hash set of half the known blocks plus unrelated hashes
+    export_file = os.path.join(temp_dir, "export.json")
+    in_set = set(hashlib.md5(block).hexdigest() for block in known[:10])
+    with open(export_file, 'w') as f:
+        f.write("# synthetic hash set\n")
+        f.write('{"file_hash":"%s","filesize":4096,"file_type":"",'
+                '"zero_count":0,"nonprobative_count":0,'
+                '"name_pairs":["repo","file"]}\n' % ("f" * 32))
+        for block_hash in list(in_set) + [hashlib.md5(str(i).encode())
+                                   .hexdigest() for i in range(10000)]:
+            f.write('{"block_hash":"%s","k_entropy":8000,'
+                    '"block_label":"","count":1,'
+                    '"source_sub_counts":["%s",1]}\n' % (
+                    block_hash, "f" * 32))
+    expected = dict((offset, block_hash) for offset, block_hash
+                    in expected.items() if block_hash in in_set)
+    return media, export_file, expected
+
+def _synthetic_test(size_mib, workers):
+    # scan a synthetic media image against a synthetic hash set and check
+    # the scan file that DataReader reads
+    import shutil
+    import tempfile
+    from scan_file_parser import read_scan_file
+
+    block_size = 512
+    temp_dir = tempfile.mkdtemp()
+    try:
+        media, export_file, expected = make_synthetic_test_data(temp_dir,
+                                                   size_mib, block_size)
+
+        # scan
+        scan_file = os.path.join(temp_dir, "scan.json")
+        hash_set = HashSet(export_file)
+        t0 = time.time()
+        with open(scan_file, 'w') as out:
+            write_scan_header(out, ["scan_engine", temp_dir, media],
+                              os.path.getsize(media))
+            scan_media(media, hash_set, block_size, block_size, out, workers)
+        elapsed = time.time() - t0
+
+        # read it back as DataReader does
+        media_filename, media_size, _ = helpers.get_scan_file_attributes(
+                                                                 scan_file)
+        media_offsets, hashes, sources = read_scan_file(scan_file)
+        found = dict(media_offsets)
+        print("%d MiB scanned in %.2f s, %s/s with %d workers" % (
+              size_mib, elapsed, helpers.size_string(
+              size_mib * 1024 * 1024 / elapsed), workers))
+        print("%d matches, %d hashes, %d sources" % (len(found),
+                                                 len(hashes), len(sources)))
+        if found != expected or media_filename != media or \
+                      media_size != os.path.getsize(media) or \
+                      set(hashes) != set(expected.values()):
+            sys.exit("scan mismatch")
+        print("scan matches expected offsets")
+    finally:
+        shutil.rmtree(temp_dir)
+
+# main
+if __name__=="__main__":
+    from argparse import ArgumentParser
+    parser = ArgumentParser(prog='scan_engine.py',
+               description="Scan a media image for block hashes in a hash "
+                           "database, writing a scan file to stdout.")
+    parser.add_argument('-s', '--step_size', type=int,
+                        help= 'step size to hash blocks at', default=512)
+    parser.add_argument('-j', '--workers', type=int,
+                        help= 'number of worker processes',
+                        default=num_workers())
+    parser.add_argument('-x', '--hash_set',
+                        help= 'hashdb export output to use instead of '
+                              'exporting the hash database', default='')
+    parser.add_argument('--start', type=int,
+                        help= 'offset to start scanning at, a multiple of '
+                              'the step size', default=0)
+    parser.add_argument('--stop', type=int,
+                        help= 'offset to stop scanning blocks at',
+                        default=None)
+    parser.add_argument('--synthetic_test', type=int, metavar='MIB',
+                        help= 'scan a synthetic media image of MIB MiB '
+                              'and check the result', default=0)
+    parser.add_argument('hashdb_dir', nargs='?', default='')
+    parser.add_argument('media', nargs='?', default='')
+    args = parser.parse_args()
+
+    if args.synthetic_test:
+        _synthetic_test(args.synthetic_test, args.workers)
+        sys.exit(0)
+    if not args.hashdb_dir or not args.media:
+        parser.error("hashdb_dir and media are required")
+
+    try:
+        block_size = helpers.get_hash_block_size(args.hashdb_dir)
+        hash_set = HashSet(args.hash_set or export_hash_set(args.hashdb_dir))
+        media_reader = MediaReader(args.media)
+        media_size = media_reader.media_size()
+        media_reader.close()
+        if media_size is None:
+            raise IOError("unable to read the size of media image %s" %
+                                                            args.media)
+        write_scan_header(sys.stdout, ["scan_engine.py", "-s",
+                          "%d" % args.step_size, args.hashdb_dir,
+                          args.media], media_size)
+        scan_media(args.media, hash_set, args.step_size, block_size,
+                   sys.stdout, args.workers, args.start, args.stop)
+    except Exception as e:
+        sys.stderr.write("scan_engine: %s\n" % e)
+        sys.exit(1)
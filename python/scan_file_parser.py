@@ -0,0 +1,318 @@
+# Parse hash scan files, in parallel processes for large files.
+#
+# A large scan file is split into newline-aligned byte ranges which are
+# parsed in a ProcessPoolExecutor.  Each range yields its own
+# MediaOffsets, hashes, and sources, which are merged in file order so
+# the result is the same as parsing the file serially.
+
+import os
+import json
+from array import array
+from media_offsets import MediaOffsets, OFFSET_TYPECODE, HASH_INDEX_TYPECODE
+try:
+    from sys import intern
+except ImportError:
+    # Python 2.7 JSON strings are unicode, which intern does not take
+    def intern(string):
+        return string
+try:
+    from concurrent.futures import ProcessPoolExecutor
+except ImportError:
+    # Python 2.7 without the futures backport
+    ProcessPoolExecutor = None
+
+# scan files smaller than this are parsed serially
+PARALLEL_MIN_SIZE = 64 * 1024 * 1024
+
+# byte ranges per worker process, so workers stay busy while the main
+# process merges completed ranges
+CHUNKS_PER_WORKER = 4
+
+def _error_text(scan_file, line_number, line, e):
+    return "Error reading file '%s' line %d:'%s':%s\nPlease check that " \
+           "this file was made using the hashdb scan_media command." % (
+           scan_file, line_number, line, e)
+
+def _parse_range(scan_file, start, stop):
+    """Parse the lines of scan_file that start in byte range [start, stop).
+
+    Returns:
+      (num_lines, media_offsets, hashes, sources, error) where error is
+      None else (line number within the range, line, error text).
+    """
+    media_offsets = MediaOffsets()
+    hashes = dict()
+    sources = dict()
+    i = 0
+
+    # optimization: collect columns locally and add them when done, and
+    # look up repeated hashes by their hexcode bytes
+    hash_index = media_offsets.hash_index
+    hash_index_cache = dict()
+    offsets = array(OFFSET_TYPECODE)
+    hash_indexes = array(HASH_INDEX_TYPECODE)
+    append_offset = offsets.append
+    append_hash_index = hash_indexes.append
+    previous_offset = 0
+    is_sorted = True
+
+    with open(scan_file, 'rb') as f:
+        f.seek(start)
+        position = start
+        for line in f:
+            if position >= stop:
+                break
+            position += len(line)
+            line = line.strip()
+            try:
+                i+=1
+                if not line or line[0:1] == b'#':
+                    continue
+
+                # get line parts, leaving the JSON payload undecoded
+                (offset, block_hash, json_bytes) = line.split(b"\t")
+
+                # get media offset, stripping any recursion path
+                dash = offset.find(b'-')
+                media_offset = int(offset if dash == -1 else offset[:dash])
+
+                # store media_offset, hash pair
+                index = hash_index_cache.get(block_hash)
+                if index is None:
+                    index = hash_index(block_hash)
+                    hash_index_cache[block_hash] = index
+                append_hash_index(index)
+                append_offset(media_offset)
+                if media_offset < previous_offset:
+                    is_sorted = False
+                previous_offset = media_offset
+
+                # hashdb writes hash information only the first time a hash
+                # is seen, so skip decoding the empty payload of the rest
+                if json_bytes == b"{}":
+                    continue
+
+                # store hash information if present
+                json_data = json.loads(json_bytes.decode('utf-8'))
+                if "source_sub_counts" in json_data:
+                    # share one string per source hash across hashes
+                    source_sub_counts = json_data["source_sub_counts"]
+                    source_sub_counts[0::2] = [intern(file_hash) for
+                                   file_hash in source_sub_counts[0::2]]
+
+                    # add additional source_hashes field
+                    json_data["source_hashes"] = set(
+                                                 source_sub_counts[0::2])
+                    hashes[block_hash.decode('ascii')] = json_data
+
+                    # sources
+                    for source in json_data["sources"]:
+                        file_hash = intern(source["file_hash"])
+                        source["file_hash"] = file_hash
+                        sources[file_hash] = source
+
+            except Exception as e:
+                return (i, media_offsets, hashes, sources,
+                        (i, line.decode('utf-8', 'replace'), str(e)))
+
+    media_offsets.extend_columns(offsets, hash_indexes, is_sorted)
+    return (i, media_offsets, hashes, sources, None)
+
+def line_aligned_ranges(scan_file, num_ranges):
+    """Split scan_file into up to num_ranges (start, stop) byte ranges
+    that each start at the beginning of a line."""
+    size = os.path.getsize(scan_file)
+    boundaries = [0]
+    with open(scan_file, 'rb') as f:
+        for k in range(1, num_ranges):
+            position = size * k // num_ranges
+            if position <= boundaries[-1]:
+                continue
+            # advance to the start of the next line
+            f.seek(position - 1)
+            f.readline()
+            position = f.tell()
+            if position >= size:
+                break
+            if position > boundaries[-1]:
+                boundaries.append(position)
+    boundaries.append(size)
+    return list(zip(boundaries[:-1], boundaries[1:]))
+
+def num_workers():
+    """The number of CPUs available to this process."""
+    try:
+        return len(os.sched_getaffinity(0))
+    except AttributeError:
+        return os.cpu_count() or 1
+
+def _shutdown(executor):
+    # stop the executor without waiting for ranges nobody will consume
+    try:
+        executor.shutdown(wait=False, cancel_futures=True)
+    except TypeError:
+        # before Python 3.9
+        executor.shutdown(wait=False)
+
+def iter_scan_file(scan_file, ranges, workers=1):
+    """Parse byte ranges of scan_file, in parallel processes when workers
+    is more than one, yielding results in file order.  Closing the
+    generator stops any remaining work.
+
+    Args:
+      scan_file(str): The block hash scan file.
+      ranges(list<(start, stop)>): Line-aligned byte ranges covering
+        scan_file, from line_aligned_ranges.
+      workers(int): The number of worker processes.
+
+    Yields:
+      (stop, media_offsets, hashes, sources) for each range, where stop
+      is the byte offset parsed through.
+
+    Raises ValueError with the file and line number of the first bad line.
+    """
+    executor = None
+    if ProcessPoolExecutor is not None and workers > 1 and len(ranges) > 1:
+        try:
+            executor = ProcessPoolExecutor(workers)
+            results = executor.map(_parse_range, [scan_file] * len(ranges),
+                                   *zip(*ranges))
+        except (OSError, RuntimeError) as e:
+            # no process support, for example in a restricted sandbox
+            print("scan file parser: parsing serially: %s" % e)
+            if executor is not None:
+                _shutdown(executor)
+            executor = None
+
+    try:
+        lines_before = 0
+        for start, stop in ranges:
+            result = None
+            if executor is not None:
+                try:
+                    result = next(results)
+                except (OSError, RuntimeError) as e:
+                    # a worker died, parse the remaining ranges here
+                    print("scan file parser: parsing serially: %s" % e)
+                    _shutdown(executor)
+                    executor = None
+            if result is None:
+                result = _parse_range(scan_file, start, stop)
+
+            num_lines, media_offsets, hashes, sources, error = result
+            if error:
+                line_number, line, e = error
+                raise ValueError(_error_text(scan_file,
+                                 lines_before + line_number, line, e))
+            lines_before += num_lines
+            yield stop, media_offsets, hashes, sources
+
+    finally:
+        if executor is not None:
+            _shutdown(executor)
+
+def read_scan_file(scan_file, workers=None):
+    """Read hash scan file into media_offsets, hashes, and sources data
+    structures, parsing byte ranges in parallel processes when the file
+    is large and more than one CPU is available.
+
+    Args:
+      scan_file(str): The block hash scan file.
+      workers(int): The number of worker processes, default one per
+        available CPU.
+
+    Returns:
+      (media_offsets, hashes, sources) where hashes also has a
+      source_hashes set added to each hash's json data.
+
+    Raises ValueError with the file and line number of the first bad line.
+    """
+    if workers is None:
+        workers = num_workers()
+
+    size = os.path.getsize(scan_file)
+    if ProcessPoolExecutor is None or workers < 2 or \
+                                      size < PARALLEL_MIN_SIZE:
+        ranges = [(0, size)]
+    else:
+        ranges = line_aligned_ranges(scan_file, workers * CHUNKS_PER_WORKER)
+
+    # merge ranges in file order so later lines replace earlier ones just
+    # as in a serial parse
+    media_offsets = None
+    hashes = dict()
+    sources = dict()
+    for _, range_media_offsets, range_hashes, range_sources in \
+                                 iter_scan_file(scan_file, ranges, workers):
+        if media_offsets is None:
+            media_offsets = range_media_offsets
+        else:
+            media_offsets.extend(range_media_offsets)
+        hashes.update(range_hashes)
+        sources.update(range_sources)
+
+    # offsets under a recursion path may arrive out of order
+    media_offsets.sort()
+
+    return (media_offsets, hashes, sources)
+
+# main
+if __name__=="__main__":
+    # informal parse throughput benchmark comparing decoding the JSON
+    # payload of every line with the byte-level fast path, for a synthetic
+    # scan file where each hash is seen ten times
+    import sys
+    import time
+    import hashlib
+    import tempfile
+    from helpers import size_string
+
+    num_lines = int(sys.argv[1]) if len(sys.argv) > 1 else 1000000
+    num_hashes = num_lines // 10 + 1
+    num_sources = num_hashes // 100 + 1
+    scan_file = tempfile.NamedTemporaryFile(mode='w', suffix=".json",
+                                            delete=False)
+    for i in range(num_lines):
+        block_hash = hashlib.md5(str(i % num_hashes).encode()).hexdigest()
+        if i < num_hashes:
+            file_hash = hashlib.md5(str(i % num_sources).encode()) \
+                                                           .hexdigest()
+            json_string = '{"count":1,"k_entropy":8000,"block_label":"",' \
+                          '"source_sub_counts":["%s",1],"sources":[' \
+                          '{"file_hash":"%s","filesize":4096,' \
+                          '"name_pairs":["repo","file"]}]}' % (
+                          file_hash, file_hash)
+        else:
+            json_string = "{}"
+        scan_file.write("%d\t%s\t%s\n" % (i * 512, block_hash,
+                                           json_string))
+    scan_file.close()
+    size = os.path.getsize(scan_file.name)
+
+    # previous parse, decoding every line
+    t0 = time.time()
+    media_offsets = MediaOffsets()
+    hashes = dict()
+    with open(scan_file.name, 'r') as f:
+        for line in f:
+            offset, block_hash, json_string = line.strip().split("\t")
+            media_offsets.append(int(offset), block_hash)
+            json_data = json.loads(json_string)
+            if "source_sub_counts" in json_data:
+                json_data["source_hashes"] = set(
+                                    json_data["source_sub_counts"][0::2])
+                hashes[block_hash] = json_data
+    decode_all_time = time.time() - t0
+
+    # fast path
+    t0 = time.time()
+    _parse_range(scan_file.name, 0, size)
+    fast_path_time = time.time() - t0
+
+    os.unlink(scan_file.name)
+    print("%d lines, %d hashes, %s" % (num_lines, num_hashes,
+                                       size_string(size)))
+    print("decode every line: %.2fs, %s/s" % (decode_all_time,
+                                     size_string(size / decode_all_time)))
+    print("fast path:         %.2fs, %s/s" % (fast_path_time,
+                                     size_string(size / fast_path_time)))
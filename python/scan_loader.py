@@ -0,0 +1,145 @@
+# Load a scan file in a background thread, in batches, so the GUI can
+# show a partial histogram while the rest of the scan file is parsed.
+
+import os
+import threading
+from annotation_reader import read_annotations
+from scan_cache import read_scan_cache, write_scan_cache
+from scan_file_parser import iter_scan_file, line_aligned_ranges, num_workers
+try:
+    import queue
+except ImportError:
+    import Queue as queue
+
+# bytes of scan file parsed per batch
+BATCH_SIZE = 16 * 1024 * 1024
+
+class ScanLoader():
+    """Read scan data and media image annotations in a background thread.
+
+    The consumer polls get_events from the Tk thread and receives, in
+    order:
+      ("data", media_offsets, hashes, sources, bytes_done, bytes_total)
+        for each batch of parsed scan data,
+      ("status", text) when the loader starts a slow step, such as
+        reading annotations, after the last batch,
+      ("done", annotation_load_status, annotation_types, annotations)
+        when loading completes, after which the consumer passes the scan
+        data it assembled to write_cache for the scan file's sidecar
+        cache,
+      ("cancelled",) if cancel was called, or
+      ("error", exception) if the scan file could not be read.
+    """
+
+    def __init__(self, scan_file, sector_size, media_filename):
+        """Args:
+          scan_file(str): The block hash scan file.
+          sector_size(int): The sector size, for reading annotations.
+          media_filename(str): The media image, for reading annotations.
+        """
+        self._scan_file = scan_file
+        self._sector_size = sector_size
+        self._media_filename = media_filename
+
+        # whether the sidecar cache needs writing, and any annotations to
+        # cache, set before the "done" event
+        self._needs_cache_write = False
+        self._cache_annotations = None
+
+        self._queue = queue.Queue()
+        self._cancel = threading.Event()
+        self._thread = threading.Thread(target=self._run)
+        self._thread.daemon = True
+        self._thread.start()
+
+    def cancel(self):
+        """Stop loading after the current batch."""
+        self._cancel.set()
+
+    def is_done(self):
+        """True when the loader has queued its last event."""
+        return not self._thread.is_alive()
+
+    def get_events(self):
+        """Return the list of events queued since the last call."""
+        events = list()
+        while True:
+            try:
+                events.append(self._queue.get_nowait())
+            except queue.Empty:
+                return events
+
+    def write_cache(self, media_offsets, hashes, sources):
+        """Write the scan file's sidecar cache from the loaded scan data
+        in a background thread, if it needs writing, after the "done"
+        event.
+
+        Args:
+          media_offsets(MediaOffsets): The scan data, in offset order.
+          hashes(dict): The hash data, with source_hashes.
+          sources(dict): The source data.
+        """
+        if not self._needs_cache_write:
+            return
+        self._needs_cache_write = False
+
+        # not a daemon thread, so exiting waits for the cache to be whole
+        thread = threading.Thread(target=write_scan_cache,
+                                  args=(self._scan_file, self._sector_size,
+                                  self._media_filename, media_offsets,
+                                  hashes, sources, self._cache_annotations))
+        thread.start()
+
+    def _run(self):
+        try:
+            # use the sidecar cache if it is valid
+            cached = read_scan_cache(self._scan_file, self._sector_size,
+                                     self._media_filename)
+            if cached:
+                media_offsets, hashes, sources, cached_annotations = cached
+                size = os.path.getsize(self._scan_file)
+                self._queue.put(("data", media_offsets, hashes, sources,
+                                 size, size))
+            else:
+                cached_annotations = None
+                if not self._read_batches():
+                    self._queue.put(("cancelled",))
+                    return
+
+            # media image annotations
+            if cached_annotations is not None:
+                self._queue.put(("done", "") + tuple(cached_annotations))
+            else:
+                self._queue.put(("status", "Reading annotations..."))
+                annotation_load_status, annotation_types, annotations = \
+                                read_annotations(self._media_filename,
+                                                 self._sector_size)
+
+                # cache the scan data and any successfully read annotations
+                # once the consumer has the scan data in offset order
+                self._needs_cache_write = not cached or \
+                                          not annotation_load_status
+                if not annotation_load_status:
+                    self._cache_annotations = (annotation_types,
+                                               annotations)
+                self._queue.put(("done", annotation_load_status,
+                                 annotation_types, annotations))
+
+        except Exception as e:
+            self._queue.put(("error", e))
+
+    def _read_batches(self):
+        # queue parsed batches in file order, returning False if cancelled
+        size = os.path.getsize(self._scan_file)
+        ranges = line_aligned_ranges(self._scan_file,
+                                     max(1, -(-size // BATCH_SIZE)))
+        batches = iter_scan_file(self._scan_file, ranges, num_workers())
+        try:
+            for stop, media_offsets, hashes, sources in batches:
+                if self._cancel.is_set():
+                    return False
+                self._queue.put(("data", media_offsets, hashes, sources,
+                                 stop, size))
+        finally:
+            batches.close()
+        return not self._cancel.is_set()
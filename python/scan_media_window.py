@@ -5,6 +5,9 @@ import os
 import sys
 import command_runner
 import helpers
+import scan_engine
+from progress_sink import ProgressSink
+from media_reader import MediaReader
 try:
     import queue
 except ImportError:
@@ -35,12 +38,18 @@ class ScanMediaWindow():
         self._output_file = output_file
         self._step_size = step_size
 
-        # the queue for import text
-        self._queue = queue.Queue()
+        # the queue for scan text, bounded so that output waits in the
+        # command's pipes when the window falls behind
+        self._queue = queue.Queue(command_runner.QUEUE_BATCHES)
+
+        # the running command and its output sink, set by _handle_start
+        self._command_runner = None
+        self._progress_sink = None
 
         # toplevel
         self._root_window = tkinter.Toplevel(master)
         self._root_window.title("SectorScope Scan Media Image")
+        self._root_window.protocol('WM_DELETE_WINDOW', self._handle_close)
 
         # make the control frame
         control_frame = tkinter.Frame(self._root_window, borderwidth=1,
@@ -132,6 +141,33 @@ class ScanMediaWindow():
         self._step_size_entry.grid(row=0, column=1, sticky=tkinter.W, padx=8)
         self._step_size_entry.insert(0, self._step_size)
 
+        # parallel scan engine checkbutton, default on when hashdb is not
+        # installed but the scan engine has a current export of the hash
+        # database to scan with
+        self._scan_engine_int_var = tkinter.IntVar()
+        self._scan_engine_int_var.set(not scan_engine.has_hashdb() and
+                      bool(self._hashdb_dir) and
+                      scan_engine.cached_hash_set(self._hashdb_dir) is not None)
+        tkinter.Checkbutton(optional_frame,
+                    text="Use Parallel Scan Engine",
+                    variable = self._scan_engine_int_var,
+                    bd=0, pady=4, highlightthickness=0).grid(row=1,
+                    column=0, columnspan=3, sticky=tkinter.W)
+
+        # exported hash set label, for the scan engine without hashdb
+        tkinter.Label(optional_frame, text="Exported Hash Set") \
+                          .grid(row=2, column=0, sticky=tkinter.W)
+
+        # exported hash set entry
+        self._hash_set_entry = tkinter.Entry(optional_frame, width=40)
+        self._hash_set_entry.grid(row=2, column=1, sticky=tkinter.W, padx=8)
+
+        # exported hash set chooser button
+        hash_set_entry_button = tkinter.Button(optional_frame,
+                                text="...",
+                                command=self._handle_hash_set_chooser)
+        hash_set_entry_button.grid(row=2, column=2, sticky=tkinter.W)
+
         return optional_frame
 
     def _make_progress_frame(self, master):
@@ -252,30 +288,34 @@ class ScanMediaWindow():
             self._output_file_entry.delete(0, tkinter.END)
             self._output_file_entry.insert(0, output_file)
 
+    def _handle_hash_set_chooser(self, *args):
+        hash_set_file = fd.askopenfilename(
+                               title="Open hashdb Export File")
+        if hash_set_file:
+            self._hash_set_entry.delete(0, tkinter.END)
+            self._hash_set_entry.insert(0, hash_set_file)
+
     def _handle_consume_queue(self):
         is_done = self._command_runner.is_done()
 
-        # consume the queue
-        while not self._queue.empty():
-            name, line = self._queue.get()
-
-            # stderr and stdout lines go to output_file
-            if name == "stderr" or name == "stdout":
-                self._outfile.write(line)
-
-            # report all but non-comment lines from stdout
-            if name != "stdout" or len(line) > 0 and line[0] == '#':
-                self._progress_text.insert(tkinter.END, "%s: %s" %(name, line))
-                self._progress_text.see(tkinter.END)
+        # consume the batches of lines in the queue
+        num_batches = self._queue.qsize()
+        for _ in range(num_batches):
+            name, lines = self._queue.get()
+            self._progress_sink.write(name, lines)
+        self._progress_sink.show()
 
         # more or done
-        if not is_done:
-            # keep progress_text consuming queue
-            self._progress_text.after(200, self._handle_consume_queue)
+        if not is_done or not self._queue.empty():
+            # keep progress_text consuming queue, sooner while output
+            # is arriving
+            self._progress_text.after(20 if num_batches else 200,
+                                      self._handle_consume_queue)
         else:
             # done, successful or not
             # close outfile
-            self._outfile.close()
+            self._progress_sink.close()
+            self._progress_sink = None
 
             # show status
             if self._command_runner.return_code() == 0:
@@ -318,18 +358,52 @@ class ScanMediaWindow():
                                   self._step_size_entry.get())
             return
 
-        # compose the scan_media command
-        cmd = ["hashdb", "scan_media", "-s", "%d"%step_size, hashdb_dir, media]
+        # compose the scan_media command, else the command scanning shards
+        # with the scan engine
+        if self._scan_engine_int_var.get():
+            cmd = [sys.executable, os.path.join(os.path.dirname(
+                   os.path.abspath(__file__)), "scan_orchestrator.py"),
+                   "-s", "%d"%step_size]
+
+            # the scan engine exports the hash database with hashdb unless
+            # given an export file or a current export is cached
+            hash_set = self._hash_set_entry.get()
+            if hash_set:
+                hash_set = os.path.abspath(hash_set)
+                if not os.path.exists(hash_set):
+                    self._set_status_text("Error: exported hash set '%s' "
+                                          "does not exist." % hash_set)
+                    return
+                cmd.extend(["-x", hash_set])
+            elif not scan_engine.can_scan(hashdb_dir):
+                self._set_status_text("Error: the parallel scan engine "
+                              "needs hashdb to export the hash database, "
+                              "or an exported hash set.")
+                return
+            cmd.extend([hashdb_dir, media])
+        else:
+            cmd = ["hashdb", "scan_media", "-s", "%d"%step_size, hashdb_dir,
+                   media]
+
+        # the media image size, as the scanner reads it, for showing
+        # progress, else None for percent not shown
+        media_reader = MediaReader(media)
+        media_size = media_reader.media_size()
+        media_reader.close()
 
         # open the output file, it is closed when _handle_consume_queue stops
         try:
-            self._outfile = open(output_file, 'w')
+            self._progress_sink = ProgressSink(self._progress_text,
+                                  self._status_label, output_file=output_file,
+                                  scan_output=True, media_size=media_size)
         except Exception as e:
-            self._queue.put(("Error", "Unable to open %s.  Aborting." % self._outfilename))
+            self._progress_text.insert(tkinter.END,
+                       "Error: Unable to open %s.  Aborting.\n" % output_file)
             return
 
         # start the scan
-        self._command_runner = command_runner.CommandRunner(cmd, self._queue)
+        self._command_runner = command_runner.CommandRunner(cmd, self._queue,
+                                                            batch_lines=True)
 
         # start the consumer
         self._progress_text.after(200, self._handle_consume_queue)
@@ -340,5 +414,10 @@ class ScanMediaWindow():
         self._command_runner.kill()
 
     def _handle_close(self):
+        # stop any running command and abandon its queued output, else it
+        # would block writing to the full queue once nothing consumes it
+        if self._progress_sink is not None:
+            self._command_runner.abandon()
+            self._progress_sink.close()
         self._root_window.destroy()
 
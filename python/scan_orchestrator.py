@@ -0,0 +1,400 @@
+#!/usr/bin/env python3
+# Scan a media image in shards, running a scan command on each shard
+# concurrently, and merge the shard scans into one scan file.
+#
+# The media image is split into step-aligned byte ranges.  Each shard runs
+# the scan engine, or a stand-in scan command, on its range with its scan
+# written to stdout, which is saved to a shard file while its progress is
+# tracked.  By default each shard runs the scan engine in its own process
+# on a hash set exported once for all shards.  Failed shards are retried.  The shard files are then merged in media offset order under the
+# standard scan file header, keeping the full hash JSON only on the first
+# match of each hash, as one scan would.
+
+import os
+import re
+import sys
+import time
+import heapq
+import shlex
+import shutil
+import tempfile
+import subprocess
+from media_reader import MediaReader
+from scan_file_parser import num_workers
+from scan_engine import export_hash_set, write_scan_header
+try:
+    from concurrent.futures import ThreadPoolExecutor, wait
+except ImportError:
+    # Python 2.7 without the futures backport
+    ThreadPoolExecutor = None
+
+# attempts at scanning a shard before the scan fails
+SHARD_ATTEMPTS = 3
+
+# seconds between progress reports
+PROGRESS_INTERVAL = 5.0
+
+# the scan engine progress comment line
+_SCANNED = re.compile(r"# scanned (\d+) of")
+
+def shard_ranges(media_size, step_size, num_shards):
+    """Split [0, media_size) into up to num_shards (start, stop) byte
+    ranges whose starts are multiples of step_size."""
+    shard_size = -(-media_size // max(num_shards, 1))
+    shard_size = max(step_size, -(-shard_size // step_size) * step_size)
+    return [(start, min(start + shard_size, media_size))
+            for start in range(0, media_size, shard_size)]
+
+def _match_offset(line):
+    # the media offset of a scan match line, stripping any recursion path
+    offset = line.split("\t", 1)[0]
+    dash = offset.find('-')
+    return int(offset if dash == -1 else offset[:dash])
+
+class _Shard():
+    # one shard of the scan, with its progress
+    def __init__(self, index, start, stop, cmd, shard_file):
+        self.index = index
+        self.start = start
+        self.stop = stop
+        self.cmd = cmd
+        self.shard_file = shard_file
+        self.attempts = 0
+        self.scanned = 0
+        self.num_matches = 0
+        self.is_cancelled = False
+        self._process = None
+
+    def run(self):
+        # scan the shard, retrying up to SHARD_ATTEMPTS times
+        error_text = ""
+        while self.attempts < SHARD_ATTEMPTS and not self.is_cancelled:
+            self.attempts += 1
+            self.scanned = 0
+            self.num_matches = 0
+            error_text = self._run_once()
+            if not error_text:
+                self.scanned = self.stop - self.start
+                return
+            print("# shard %d attempt %d failed: %s" % (self.index,
+                                    self.attempts, error_text.strip()))
+        raise RuntimeError("shard %d at offsets %d to %d failed: %s" % (
+                           self.index, self.start, self.stop,
+                           error_text.strip()))
+
+    def _start(self, error_file):
+        # start the shard command, return its process
+        try:
+            return subprocess.Popen(self.cmd, stdout=subprocess.PIPE,
+                                    stderr=error_file,
+                                    universal_newlines=True)
+        except (IOError, OSError) as e:
+            raise RuntimeError("%s not found: %s" % (self.cmd[0], e))
+
+    def _run_once(self):
+        # run the shard command, return "" else error text
+        error_file = tempfile.TemporaryFile()
+        try:
+            with open(self.shard_file, 'w') as f:
+                try:
+                    self._process = self._start(error_file)
+                except RuntimeError as e:
+                    return "%s" % e
+
+                # save match lines, tracking progress
+                for line in self._process.stdout:
+                    if line[:1] == '#':
+                        m = _SCANNED.match(line)
+                        if m:
+                            self.scanned = max(self.scanned,
+                                           int(m.group(1)) - self.start)
+                    elif line.strip():
+                        f.write(line)
+                        self.num_matches += 1
+                        self.scanned = max(self.scanned,
+                                       _match_offset(line) - self.start)
+                self._process.stdout.close()
+                returncode = self._process.wait()
+
+            if returncode != 0:
+                error_file.seek(0)
+                return "exit code %d: %s" % (returncode,
+                          error_file.read().decode('utf-8', 'replace'))
+            return ""
+        finally:
+            error_file.close()
+
+    def kill(self):
+        # stop the shard without retrying
+        self.is_cancelled = True
+        try:
+            self._process.kill()
+        except (AttributeError, OSError):
+            pass
+
+def _shard_lines(index, shard_file):
+    # yield (offset, shard index, line) for the lines of a shard file
+    with open(shard_file, 'r') as f:
+        for line in f:
+            yield (_match_offset(line), index, line)
+
+def merge_shards(shard_files, out):
+    """Merge shard scan files in media offset order into out, writing the
+    full hash JSON only on the first match of each hash.
+
+    Args:
+      shard_files(list<str>): Scan files of match lines, each in media
+        offset order.
+      out(file): The file to write match lines to.
+
+    Returns:
+      The number of match lines written.
+    """
+    seen = set()
+    num_matches = 0
+    for _, _, line in heapq.merge(*[_shard_lines(i, shard_file)
+                          for i, shard_file in enumerate(shard_files)]):
+        offset, block_hash, payload = line.split("\t", 2)
+        if block_hash in seen:
+            if payload.strip() != "{}":
+                line = "%s\t%s\t{}\n" % (offset, block_hash)
+        else:
+            seen.add(block_hash)
+        out.write(line)
+        num_matches += 1
+    return num_matches
+
+def engine_command(step_size, hash_set, hashdb_dir, media_filename):
+    """Return the scan command template that runs the scan engine on one
+    shard in one process, for scan_sharded."""
+    return [sys.executable, os.path.join(os.path.dirname(
+            os.path.abspath(__file__)), "scan_engine.py"),
+            "-s", "%d" % step_size, "-j", "1", "-x", hash_set,
+            "--start", "{start}", "--stop", "{stop}",
+            hashdb_dir, media_filename]
+
+def scan_sharded(media_filename, hashdb_dir, step_size, out, workers=None,
+                 num_shards=None, command=None, progress=None,
+                 temp_dir=None, hash_set=None):
+    """Scan media_filename in concurrent shards and write one scan file,
+    with its header, to out.
+
+    Args:
+      media_filename(str): The media image to scan.
+      hashdb_dir(str): The hash database to scan against.
+      step_size(int): The step between hashed blocks.
+      out(file): The file to write the scan file to.
+      workers(int): The number of shards scanned at once, default one
+        per available CPU.
+      num_shards(int): The number of shards, default workers.
+      command(list): The shard scan command, with {start}, {stop},
+        {step_size}, {hashdb_dir}, and {media} replaced in each argument,
+        else None to run the scan engine on an export of hashdb_dir.
+      progress(function): Called with (bytes scanned, media size,
+        matches) every PROGRESS_INTERVAL seconds as shards progress, else
+        None.
+      temp_dir(str): The directory for shard files, default the system
+        temporary directory.
+      hash_set(str): The hashdb export file of hashdb_dir for the scan
+        engine, else None to export hashdb_dir.
+
+    Returns:
+      The number of matches.
+
+    Raises:
+      IOError: if the size of the media image cannot be read.
+      RuntimeError: if a shard fails after SHARD_ATTEMPTS attempts.
+    """
+    if workers is None:
+        workers = num_workers()
+    if num_shards is None:
+        num_shards = workers
+    media_reader = MediaReader(media_filename)
+    media_size = media_reader.media_size()
+    media_reader.close()
+    if media_size is None:
+        raise IOError("unable to read the size of media image %s" %
+                                                          media_filename)
+
+    write_scan_header(out, ["scan_orchestrator.py", "-s", "%d" % step_size,
+                            hashdb_dir, media_filename], media_size)
+    out.flush()
+
+    # export the hash database once for all scan engine shards
+    if command is None:
+        export_file = hash_set or export_hash_set(hashdb_dir)
+        command = engine_command(step_size, export_file, hashdb_dir,
+                                 media_filename)
+
+    t0 = time.time()
+    shard_dir = tempfile.mkdtemp(prefix="scan_shards_", dir=temp_dir)
+    try:
+        shards = list()
+        for i, (start, stop) in enumerate(shard_ranges(media_size,
+                                                 step_size, num_shards)):
+            shard_file = os.path.join(shard_dir, "shard_%05d.json" % i)
+            cmd = [arg.format(start=start, stop=stop, step_size=step_size,
+                              hashdb_dir=hashdb_dir, media=media_filename)
+                   for arg in command]
+            shards.append(_Shard(i, start, stop, cmd, shard_file))
+
+        def report():
+            if progress is not None:
+                progress(sum(shard.scanned for shard in shards), media_size,
+                         sum(shard.num_matches for shard in shards))
+
+        # scan the shards, workers at a time, reporting progress while
+        # they run
+        if ThreadPoolExecutor is not None:
+            executor = ThreadPoolExecutor(max_workers=max(workers, 1))
+            try:
+                futures = [executor.submit(shard.run) for shard in shards]
+                not_done = futures
+                while not_done:
+                    _, not_done = wait(not_done, timeout=PROGRESS_INTERVAL)
+                    report()
+                    for future in futures:
+                        if future.done() and future.exception():
+                            raise future.exception()
+            finally:
+                for shard in shards:
+                    shard.kill()
+                executor.shutdown(wait=True)
+        else:
+            for shard in shards:
+                shard.run()
+                report()
+
+        # merge the shards
+        num_matches = merge_shards([shard.shard_file for shard in shards],
+                                   out)
+        out.write("# scan completed in %.1f s with %d shards, %d matches\n"
+                  % (time.time() - t0, len(shards), num_matches))
+        out.flush()
+        return num_matches
+
+    finally:
+        shutil.rmtree(shard_dir, ignore_errors=True)
+
+def _synthetic_test(size_mib, workers, num_shards):
+    # scan a synthetic media image in shards, once with a shard that fails
+    # on its first attempt, and check the result against one scan
+    import io
+    from scan_engine import make_synthetic_test_data, HashSet, scan_media
+
+    temp_dir = tempfile.mkdtemp()
+    try:
+        media, export_file, expected = make_synthetic_test_data(temp_dir,
+                                                                size_mib)
+        hashdb_dir = os.path.join(temp_dir, "hashdb")
+        os.mkdir(hashdb_dir)
+        with open(os.path.join(hashdb_dir, "settings.json"), 'w') as f:
+            f.write('{"block_size":512}\n')
+
+        # one scan
+        t0 = time.time()
+        single = io.StringIO()
+        scan_media(media, HashSet(export_file), 512, 512, single, 1)
+        single_time = time.time() - t0
+        single_lines = [line for line in single.getvalue().splitlines(True)
+                        if line[:1] != '#']
+
+        # sharded scan, where shard 1 fails once
+        fail_file = os.path.join(temp_dir, "fail_once")
+        open(fail_file, 'w').close()
+        engine = engine_command(512, export_file, hashdb_dir, media)
+        command = [sys.executable, "-c",
+                   "import os, sys, subprocess\n"
+                   "if sys.argv[1] == '%d' and os.path.exists(%r):\n"
+                   "    os.remove(%r)\n"
+                   "    sys.exit('simulated shard failure')\n"
+                   "sys.exit(subprocess.call(sys.argv[2:]))\n" % (
+                   shard_ranges(os.path.getsize(media), 512,
+                                num_shards)[1][0], fail_file, fail_file),
+                   "{start}"] + engine
+        def progress(scanned, media_size, num_matches):
+            print("progress: %d of %d bytes, %d matches" % (scanned,
+                                                  media_size, num_matches))
+        t0 = time.time()
+        sharded = io.StringIO()
+        scan_sharded(media, hashdb_dir, 512, sharded, workers, num_shards,
+                     command, progress)
+        sharded_time = time.time() - t0
+        lines = sharded.getvalue().splitlines(True)
+        sharded_lines = [line for line in lines if line[:1] != '#']
+
+        print("one scan: %.2f s, %d shards on %d workers: %.2f s" % (
+              single_time, num_shards, workers, sharded_time))
+        if lines[0].split(' ')[-1].strip() != media or \
+                    int(lines[2].split(' ')[-1]) != os.path.getsize(media):
+            sys.exit("header mismatch")
+        if sharded_lines != single_lines or len(single_lines) != \
+                                                         len(expected):
+            sys.exit("scan mismatch")
+        print("sharded scan matches one scan, %d matches" %
+                                                     len(sharded_lines))
+
+        # sharded scan by the scan engine
+        t0 = time.time()
+        sharded = io.StringIO()
+        scan_sharded(media, hashdb_dir, 512, sharded, workers, num_shards,
+                     progress=progress, hash_set=export_file)
+        print("%d scan engine shards on %d workers: %.2f s" % (
+              num_shards, workers, time.time() - t0))
+        if [line for line in sharded.getvalue().splitlines(True)
+                               if line[:1] != '#'] != single_lines:
+            sys.exit("scan engine shard mismatch")
+        print("scan engine shards match one scan")
+    finally:
+        shutil.rmtree(temp_dir)
+
+# main
+if __name__=="__main__":
+    from argparse import ArgumentParser
+    parser = ArgumentParser(prog='scan_orchestrator.py',
+               description="Scan a media image in concurrent shards, "
+                           "writing one scan file to stdout.")
+    parser.add_argument('-s', '--step_size', type=int,
+                        help= 'step size to hash blocks at', default=512)
+    parser.add_argument('-j', '--workers', type=int,
+                        help= 'number of shards scanned at once',
+                        default=num_workers())
+    parser.add_argument('-n', '--num_shards', type=int,
+                        help= 'number of shards, default workers',
+                        default=None)
+    parser.add_argument('-c', '--command',
+                        help= 'shard scan command, with {start}, {stop}, '
+                              '{step_size}, {hashdb_dir}, and {media} '
+                              'replaced, default the scan engine',
+                        default='')
+    parser.add_argument('-x', '--hash_set',
+                        help= 'hashdb export file of hashdb_dir for the '
+                              'scan engine, default export hashdb_dir',
+                        default='')
+    parser.add_argument('--synthetic_test', type=int, metavar='MIB',
+                        help= 'scan a synthetic media image of MIB MiB '
+                              'and check the result', default=0)
+    parser.add_argument('hashdb_dir', nargs='?', default='')
+    parser.add_argument('media', nargs='?', default='')
+    args = parser.parse_args()
+
+    if args.synthetic_test:
+        _synthetic_test(args.synthetic_test, max(args.workers, 2),
+                        args.num_shards or 4)
+        sys.exit(0)
+    if not args.hashdb_dir or not args.media:
+        parser.error("hashdb_dir and media are required")
+
+    def progress(scanned, media_size, num_matches):
+        sys.stdout.write("# scanned %d of %d bytes, %d matches\n" % (
+                                        scanned, media_size, num_matches))
+        sys.stdout.flush()
+
+    try:
+        scan_sharded(args.media, args.hashdb_dir, args.step_size,
+                     sys.stdout, args.workers, args.num_shards,
+                     shlex.split(args.command) if args.command else None,
+                     progress, hash_set=args.hash_set or None)
+    except Exception as e:
+        sys.stderr.write("scan_orchestrator: %s\n" % e)
+        sys.exit(1)
@@ -0,0 +1,6 @@
+# The modules under test are flat modules in the directory above.
+import os
+import sys
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                                ".."))
@@ -0,0 +1,62 @@
+# Synthetic scan data for the tests.
+
+import json
+import random
+import hashlib
+
+def block_hash(i):
+    """The hexcode of the i'th synthetic block hash."""
+    return hashlib.md5(("block %d" % i).encode()).hexdigest()
+
+def file_hash(i):
+    """The hexcode of the i'th synthetic source file hash."""
+    return hashlib.md5(("file %d" % i).encode()).hexdigest()
+
+def hash_data(i, rng, num_sources):
+    """Random JSON hash data of block hash i, as hashdb scan_media writes
+    it."""
+    source_indexes = rng.sample(range(num_sources), rng.randint(1, 3))
+    return {"count": rng.randint(1, 9),
+            "k_entropy": rng.randrange(8000),
+            "block_label": rng.choice(["", "", "W", "H"]),
+            "source_sub_counts": [value for j in source_indexes
+                                  for value in (file_hash(j),
+                                                rng.randint(1, 4))],
+            "sources": [{"file_hash": file_hash(j),
+                         "filesize": 512 * (j + 1),
+                         "name_pairs": ["repo", "file %d" % j]}
+                        for j in source_indexes]}
+
+def write_scan_file(scan_file, num_lines, num_hashes, seed, in_order=True):
+    """Write a scan file of num_lines random matches of num_hashes hashes.
+
+    Returns:
+      (pairs, hashes) where pairs is the list of (offset, block_hash)
+      matches in file order and hashes is the hash data by block hash.
+    """
+    rng = random.Random(seed)
+    offsets = sorted(rng.sample(range(1 << 16), num_lines))
+    if not in_order:
+        rng.shuffle(offsets)
+    pairs = list()
+    hashes = dict()
+    with open(scan_file, "w") as f:
+        f.write("# command: hashdb scan_media db media.raw\n")
+        f.write("# hashdb-Version: 3.0.0\n")
+        for offset in offsets:
+            i = rng.randrange(num_hashes)
+            hexcode = block_hash(i)
+            if hexcode in hashes:
+                data = dict()
+            else:
+                data = hash_data(i, rng, 20)
+                hashes[hexcode] = data
+
+            # some matches are under a recursion path
+            path = "%d" % (offset * 512)
+            if rng.random() < 0.1:
+                path += "-GZIP-%d" % rng.randrange(4096)
+            f.write("%s\t%s\t%s\n" % (path, hexcode, json.dumps(data)))
+            pairs.append((offset * 512, hexcode))
+        f.write("# scan_media completed\n")
+    return pairs, hashes
@@ -0,0 +1,174 @@
+import random
+import unittest
+import filter_engine
+import histogram_engine
+import histogram_pyramid
+from filter_engine import FilterEngine, FilterState
+from media_offsets import MediaOffsets, MediaOffsetsBuffer
+from scan_files import block_hash, file_hash, hash_data
+
+MEDIA_SIZE = 8 * 1024 * 1024
+
+def _brute_force_flags(hexcode, data, filter_state):
+    # (count, is_ignored, is_highlighted) of one hash by hand
+    entropy = data["k_entropy"] / 1000.0
+    is_ignored = False
+    if filter_state.ignore_entropy_below and \
+                            entropy < filter_state.ignore_entropy_below:
+        is_ignored = True
+    if filter_state.ignore_entropy_above and \
+                            entropy > filter_state.ignore_entropy_above:
+        is_ignored = True
+    if filter_state.ignore_max_hashes and \
+                            data["count"] > filter_state.ignore_max_hashes:
+        is_ignored = True
+    if filter_state.ignore_flagged_blocks and data["block_label"]:
+        is_ignored = True
+    if hexcode in filter_state.ignored_hashes:
+        is_ignored = True
+    is_highlighted = hexcode in filter_state.highlighted_hashes
+    for source_hash in data["source_hashes"]:
+        if source_hash in filter_state.ignored_sources:
+            is_ignored = True
+        if source_hash in filter_state.highlighted_sources:
+            is_highlighted = True
+    return data["count"], is_ignored, is_highlighted
+
+def _brute_force_bucket_data(pairs, hashes, filter_state, start_offset,
+                             bytes_per_bucket, num_buckets):
+    bucket_data = ([0] * num_buckets, [0] * num_buckets, [0] * num_buckets)
+    for offset, hexcode in pairs:
+        bucket = (offset - start_offset) // bytes_per_bucket
+        if 0 <= bucket < num_buckets:
+            count, is_ignored, is_highlighted = _brute_force_flags(hexcode,
+                                      hashes[hexcode], filter_state)
+            bucket_data[0][bucket] += count
+            if is_ignored:
+                bucket_data[1][bucket] += count
+            if is_highlighted:
+                bucket_data[2][bucket] += count
+    return bucket_data
+
+def _random_scan_data(rng, num_pairs, num_hashes):
+    # random (offset, block_hash) pairs and hash data with source_hashes
+    hashes = dict()
+    for i in range(num_hashes):
+        data = hash_data(i, rng, 20)
+        data["source_hashes"] = set(data["source_sub_counts"][0::2])
+        hashes[block_hash(i)] = data
+    pairs = sorted((rng.randrange(MEDIA_SIZE // 512) * 512,
+                    block_hash(rng.randrange(num_hashes)))
+                   for _ in range(num_pairs))
+    return pairs, hashes
+
+def _store(pairs):
+    store = MediaOffsets()
+    for offset, hexcode in pairs:
+        store.append(offset, hexcode)
+    store.sort()
+    return store
+
+def _filter_states(rng, num_hashes):
+    # a run of filter changes, mostly to the ignored and highlighted sets
+    state = FilterState(0, 0, 0, True, frozenset(), frozenset(),
+                        frozenset(), frozenset())
+    yield state
+    for step in range(12):
+        if step % 4 == 3:
+            state = state._replace(
+                        ignore_entropy_below=rng.choice([0, 2.5]),
+                        ignore_entropy_above=rng.choice([0, 6.0]),
+                        ignore_max_hashes=rng.choice([0, 4]),
+                        ignore_flagged_blocks=rng.random() < 0.5)
+        else:
+            field = rng.choice(["ignored_sources", "ignored_hashes",
+                                "highlighted_sources",
+                                "highlighted_hashes"])
+            if field.endswith("sources"):
+                values = set(file_hash(rng.randrange(20))
+                             for _ in range(rng.randint(0, 3)))
+            else:
+                values = set(block_hash(rng.randrange(num_hashes))
+                             for _ in range(rng.randint(0, 20)))
+            state = state._replace(**{field: frozenset(values)})
+        yield state
+
+class FilterEngineTest(unittest.TestCase):
+
+    def setUp(self):
+        # each test runs with and without NumPy where it is available
+        self._numpy = filter_engine.numpy
+
+    def tearDown(self):
+        for module in (filter_engine, histogram_engine, histogram_pyramid):
+            module.numpy = self._numpy
+
+    def _engines(self):
+        for module in (filter_engine, histogram_engine, histogram_pyramid):
+            module.numpy = None
+        yield "python"
+        if self._numpy is not None:
+            for module in (filter_engine, histogram_engine,
+                           histogram_pyramid):
+                module.numpy = self._numpy
+            yield "numpy"
+
+    def _assert_exact(self, engine, store, pairs, hashes, filter_state,
+                      message):
+        hash_counts = engine.calculate_hash_counts(filter_state)
+        self.assertEqual([hash_counts[i] for i in range(len(hash_counts))],
+                         [_brute_force_flags(hexcode, hashes[hexcode],
+                          filter_state) for hexcode in store.block_hashes()],
+                         message)
+        for region in ((0, MEDIA_SIZE // 50, 50), (0, 4096, 100),
+                       (1000, 333, 60), (-4096, 1 << 18, 40)):
+            self.assertEqual(tuple(engine.calculate_bucket_data(*region)),
+                             _brute_force_bucket_data(pairs, hashes,
+                             filter_state, *region), (message, region))
+
+    def test_filter_changes_are_exact(self):
+        for engine_name in self._engines():
+            rng = random.Random(1)
+            pairs, hashes = _random_scan_data(rng, 5000, 300)
+            store = _store(pairs)
+            engine = FilterEngine(store, hashes, 512, MEDIA_SIZE)
+            for step, filter_state in enumerate(_filter_states(rng, 300)):
+                self._assert_exact(engine, store, pairs, hashes,
+                                   filter_state, (engine_name, step))
+
+    def test_extended_engines_are_exact(self):
+        for engine_name in self._engines():
+            rng = random.Random(3)
+            pairs, hashes = _random_scan_data(rng, 6000, 400)
+            filter_states = list(_filter_states(rng, 400))
+
+            # append batches in offset order, changing filters between them
+            buffer = MediaOffsetsBuffer()
+            engine = FilterEngine(MediaOffsets(), hashes, 512, MEDIA_SIZE)
+            for batch in range(6):
+                batch_pairs = pairs[batch * 1000:(batch + 1) * 1000]
+                buffer.append(_store(batch_pairs))
+                self.assertTrue(buffer.is_sorted())
+                store = buffer.media_offsets()
+                engine = engine.extended(store, hashes)
+                self._assert_exact(engine, store,
+                                   pairs[:(batch + 1) * 1000], hashes,
+                                   filter_states[batch * 2],
+                                   (engine_name, batch))
+
+    def test_generation_changes_with_counts(self):
+        rng = random.Random(2)
+        pairs, hashes = _random_scan_data(rng, 100, 10)
+        engine = FilterEngine(_store(pairs), hashes, 512, MEDIA_SIZE)
+        state = FilterState(0, 0, 0, True, frozenset(), frozenset(),
+                            frozenset(), frozenset())
+        generation = engine.calculate_hash_counts(state).generation
+        self.assertEqual(engine.calculate_hash_counts(state).generation,
+                         generation)
+        state = state._replace(highlighted_hashes=frozenset(
+                                                      [block_hash(0)]))
+        self.assertGreater(engine.calculate_hash_counts(state).generation,
+                           generation)
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,137 @@
+import random
+import unittest
+import histogram_engine
+import histogram_pyramid
+from histogram_engine import HashCounts
+from histogram_pyramid import HistogramPyramid
+from media_offsets import MediaOffsets
+
+def _brute_force_bucket_data(pairs, flags, start_offset, bytes_per_bucket,
+                             num_buckets):
+    # bin each match by hand
+    bucket_data = ([0] * num_buckets, [0] * num_buckets, [0] * num_buckets)
+    for offset, hash_index in pairs:
+        bucket = (offset - start_offset) // bytes_per_bucket
+        if 0 <= bucket < num_buckets:
+            count, is_ignored, is_highlighted = flags[hash_index]
+            bucket_data[0][bucket] += count
+            if is_ignored:
+                bucket_data[1][bucket] += count
+            if is_highlighted:
+                bucket_data[2][bucket] += count
+    return bucket_data
+
+def _random_data(rng, num_pairs, num_hashes, media_size):
+    # a sorted store of random matches and random hash counts
+    store = MediaOffsets()
+    for _ in range(num_pairs):
+        store.append(rng.randrange(media_size),
+                     "%032x" % rng.randrange(num_hashes))
+    store.sort()
+    flags = [(rng.randint(1, 9), rng.random() < 0.3, rng.random() < 0.2)
+             for _ in range(store.num_hashes())]
+    hash_counts = HashCounts(*[list(column) for column in zip(*flags)])
+    return store, flags, hash_counts
+
+class HistogramPyramidTest(unittest.TestCase):
+
+    def setUp(self):
+        # each test runs with and without NumPy where it is available
+        self._numpy = histogram_pyramid.numpy
+        self._max_tiles = histogram_pyramid.MAX_TILES
+
+        # few tiles, so the finest tiles span several sectors
+        histogram_pyramid.MAX_TILES = 512
+
+    def tearDown(self):
+        histogram_pyramid.numpy = self._numpy
+        histogram_engine.numpy = self._numpy
+        histogram_pyramid.MAX_TILES = self._max_tiles
+
+    def _engines(self):
+        histogram_pyramid.numpy = None
+        histogram_engine.numpy = None
+        yield "python"
+        if self._numpy is not None:
+            histogram_pyramid.numpy = self._numpy
+            histogram_engine.numpy = self._numpy
+            yield "numpy"
+
+    def _regions(self, rng, media_size):
+        # aligned, unaligned, off the media, and very narrow plot regions
+        yield 0, media_size // 100 + 1, 100
+        yield 0, 512, 64
+        yield -5000, 4096, 300
+        yield media_size - 1000, 77, 50
+        for _ in range(200):
+            bytes_per_bucket = rng.choice([1, 3, 512, 4096]) * \
+                               rng.randint(1, 2000)
+            yield (rng.randrange(-media_size // 4, media_size),
+                   bytes_per_bucket, rng.randint(1, 200))
+
+    def test_bucket_data_is_exact(self):
+        for engine in self._engines():
+            rng = random.Random(1)
+            media_size = 10 * 1024 * 1024
+            store, flags, hash_counts = _random_data(rng, 20000, 500,
+                                                     media_size)
+            pyramid = HistogramPyramid(store, hash_counts, 512, media_size)
+            self.assertGreater(len(pyramid.levels), 1)
+            self.assertGreater(pyramid.levels[0][0], 512)
+            pairs = list(zip(store.offsets, store.hash_indexes))
+            answered = 0
+            for region in self._regions(rng, media_size):
+                bucket_data = pyramid.bucket_data(*region)
+                if bucket_data is None:
+                    continue
+                answered += 1
+                self.assertEqual(tuple(bucket_data),
+                                 _brute_force_bucket_data(pairs, flags,
+                                 *region), (engine, region))
+            self.assertGreater(answered, 40, engine)
+
+    def test_unanswered_regions_are_binned_directly(self):
+        for engine in self._engines():
+            rng = random.Random(2)
+            media_size = 1024 * 1024
+            store, flags, hash_counts = _random_data(rng, 2000, 50,
+                                                     media_size)
+            pyramid = HistogramPyramid(store, hash_counts, 512, media_size)
+            pairs = list(zip(store.offsets, store.hash_indexes))
+
+            # buckets narrower than the finest tiles, and fractional ones
+            self.assertIsNone(pyramid.bucket_data(3, 100, 40))
+            self.assertIsNone(pyramid.bucket_data(0, 1000.5, 40))
+            self.assertEqual(tuple(histogram_engine.calculate_bucket_data(
+                             store, hash_counts, 3, 100, 40)),
+                             _brute_force_bucket_data(pairs, flags, 3, 100,
+                                                      40), engine)
+
+    def test_extend_adds_appended_matches(self):
+        for engine in self._engines():
+            rng = random.Random(3)
+            media_size = 4 * 1024 * 1024
+            store, flags, hash_counts = _random_data(rng, 6000, 200,
+                                                     media_size)
+
+            # tile the first part, then append the rest
+            first = MediaOffsets()
+            first.set_columns(store.offsets[:3000],
+                              store.hash_indexes[:3000],
+                              store.columns()[2])
+            pyramid = HistogramPyramid(first, hash_counts, 512, media_size)
+            self.assertTrue(pyramid.extend(store, hash_counts, 3000))
+            rebuilt = HistogramPyramid(store, hash_counts, 512, media_size)
+            for level, rebuilt_level in zip(pyramid.levels,
+                                            rebuilt.levels):
+                self.assertEqual([list(column) for column in level[1:]],
+                                 [list(column) for column in
+                                  rebuilt_level[1:]], engine)
+
+            # matches past the tiles need a new pyramid
+            store.append(media_size * 4, "%032x" % 1)
+            hash_counts.extend([1], [False], [False])
+            self.assertFalse(pyramid.extend(store, hash_counts, 6000))
+
+if __name__ == "__main__":
+    unittest.main()
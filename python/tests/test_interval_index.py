@@ -0,0 +1,70 @@
+import random
+import unittest
+from interval_index import IntervalIndex
+
+def _brute_force_overlapping(intervals, start, stop):
+    # the values of the overlapping intervals in order of interval start,
+    # points treated as intervals of one point
+    if stop <= start:
+        return list()
+    found = [interval for interval in sorted(intervals,
+             key=lambda interval: interval[0])
+             if (interval[0] < stop and interval[1] > start
+                 if interval[1] > interval[0]
+                 else start <= interval[0] < stop)]
+    return [interval[2] for interval in found]
+
+def _random_intervals(rng, num_intervals, extent):
+    intervals = list()
+    for i in range(num_intervals):
+        start = rng.randrange(extent)
+        kind = rng.random()
+        if kind < 0.1:
+            # a point
+            stop = start
+        elif kind < 0.2:
+            # a wide interval, as a partition holding file system items
+            stop = start + rng.randrange(extent // 2)
+        else:
+            stop = start + rng.randrange(1, 200)
+        intervals.append((start, stop, i))
+    return intervals
+
+class IntervalIndexTest(unittest.TestCase):
+
+    def _assert_queries(self, intervals, queries):
+        index = IntervalIndex(intervals)
+        self.assertEqual(len(index), len(intervals))
+        for start, stop in queries:
+            self.assertEqual(index.overlapping(start, stop),
+                             _brute_force_overlapping(intervals, start,
+                                                      stop), (start, stop))
+
+    def test_random_queries(self):
+        rng = random.Random(1)
+        extent = 100000
+        intervals = _random_intervals(rng, 2000, extent)
+        queries = list()
+        for _ in range(500):
+            start = rng.randrange(-100, extent)
+            queries.append((start, start + rng.choice([0, 1, 50, 5000,
+                                                       extent])))
+        self._assert_queries(intervals, queries)
+
+    def test_nested_and_touching_intervals(self):
+        # nested intervals sharing a start, intervals that touch, and
+        # points at interval ends
+        intervals = [(0, 1000, "disk"), (0, 500, "partition 1"),
+                     (0, 10, "table"), (500, 1000, "partition 2"),
+                     (500, 500, "point"), (1000, 1000, "end point"),
+                     (10, 20, "a"), (20, 30, "b")]
+        queries = [(0, 1), (9, 10), (10, 11), (19, 21), (499, 500),
+                   (500, 501), (999, 1001), (1000, 2000), (-5, 0),
+                   (30, 30), (40, 20)]
+        self._assert_queries(intervals, queries)
+
+    def test_empty_index(self):
+        self._assert_queries([], [(0, 10)])
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,173 @@
+import random
+import hashlib
+import tracemalloc
+import unittest
+from array import array
+import media_offsets
+from media_offsets import MediaOffsets, MediaOffsetsBuffer, \
+                          OFFSET_TYPECODE, HASH_INDEX_TYPECODE, DIGEST_SIZE
+
+def _block_hash(i):
+    return hashlib.md5(str(i).encode()).hexdigest()
+
+def _random_pairs(num_pairs, num_hashes, seed):
+    rng = random.Random(seed)
+    return [(rng.randrange(1 << 20) * 512, _block_hash(rng.randrange(
+                                 num_hashes))) for _ in range(num_pairs)]
+
+def _unsorted(num_pairs, num_hashes, seed):
+    # a store of random unsorted columns, made without a list of pairs
+    rng = random.Random(seed)
+    store = MediaOffsets()
+    store.offsets = array(OFFSET_TYPECODE, (rng.randrange(1 << 40)
+                                       for _ in range(num_pairs)))
+    store.hash_indexes = array(HASH_INDEX_TYPECODE, (rng.randrange(
+                                 num_hashes) for _ in range(num_pairs)))
+    store._is_sorted = False
+    return store
+
+class MediaOffsetsTest(unittest.TestCase):
+
+    def setUp(self):
+        # each test runs with and without NumPy where it is available
+        self._numpy = media_offsets.numpy
+        self._chunk_size = media_offsets._SORT_CHUNK_SIZE
+
+    def tearDown(self):
+        media_offsets.numpy = self._numpy
+        media_offsets._SORT_CHUNK_SIZE = self._chunk_size
+
+    def _engines(self):
+        media_offsets.numpy = None
+        yield "python"
+        if self._numpy is not None:
+            media_offsets.numpy = self._numpy
+            yield "numpy"
+
+    def test_columnar_layout(self):
+        pairs = _random_pairs(5000, 300, 1)
+        store = MediaOffsets()
+        for offset, block_hash in pairs:
+            store.append(offset, block_hash)
+        store.sort()
+
+        # one 64-bit offset and one 32-bit hash index per match, and one
+        # 16-byte digest per distinct hash
+        self.assertIsInstance(store.offsets, array)
+        self.assertEqual(store.offsets.itemsize, 8)
+        self.assertIsInstance(store.hash_indexes, array)
+        self.assertEqual(store.hash_indexes.typecode, HASH_INDEX_TYPECODE)
+        self.assertEqual(store.hash_indexes.itemsize, 4)
+        self.assertEqual(len(store), len(pairs))
+        self.assertEqual(store.num_hashes(),
+                         len(set(block_hash for _, block_hash in pairs)))
+        self.assertEqual(len(store.columns()[2]),
+                         store.num_hashes() * DIGEST_SIZE)
+
+        # stably sorted pairs
+        self.assertEqual(list(store),
+                         sorted(pairs, key=lambda pair: pair[0]))
+
+    def test_memory_per_match(self):
+        # the columns take far less than a list of (offset, hexcode)
+        pairs = _random_pairs(100000, 1000, 2)
+        tracemalloc.start()
+        store = MediaOffsets()
+        for offset, block_hash in pairs:
+            store.append(offset, block_hash)
+        store_bytes = tracemalloc.get_traced_memory()[0]
+        tracemalloc.stop()
+        self.assertLess(store_bytes, len(pairs) * 16 + 1000 * 200)
+
+    def test_sort(self):
+        for engine in self._engines():
+            # small chunks so the Python sort merges several chunks
+            media_offsets._SORT_CHUNK_SIZE = 1000
+            pairs = _random_pairs(5000, 50, 3)
+
+            # equal offsets keep append order
+            pairs.extend((pairs[0][0], _block_hash(i)) for i in range(5))
+            store = MediaOffsets()
+            for offset, block_hash in pairs:
+                store.append(offset, block_hash)
+            store.sort()
+            self.assertEqual(list(store),
+                             sorted(pairs, key=lambda pair: pair[0]), engine)
+
+    def test_sort_skips_sorted_columns(self):
+        for engine in self._engines():
+            store = MediaOffsets()
+            for i in range(100):
+                store.append(i * 512, _block_hash(i))
+            store.extend_columns(array(OFFSET_TYPECODE, [99 * 512]),
+                                 array(HASH_INDEX_TYPECODE, [0]), False)
+            offsets = store.offsets
+            store.sort()
+            self.assertIs(store.offsets, offsets, engine)
+
+    def test_sort_memory(self):
+        # sorting makes no Python object per match, which would take
+        # more than twice this
+        num_pairs = 400000
+        for engine in self._engines():
+            store = _unsorted(num_pairs, 1000, 4)
+            expected = sorted(zip(store.offsets, store.hash_indexes),
+                              key=lambda pair: pair[0])
+            tracemalloc.start()
+            store.sort()
+            peak_bytes = tracemalloc.get_traced_memory()[1]
+            tracemalloc.stop()
+            self.assertLess(peak_bytes, num_pairs * 40, engine)
+            self.assertEqual(list(zip(store.offsets, store.hash_indexes)),
+                             expected, engine)
+
+    def test_extend(self):
+        for engine in self._engines():
+            pairs = _random_pairs(6000, 100, 5)
+            store = MediaOffsets()
+            for offset, block_hash in pairs[:3000]:
+                store.append(offset, block_hash)
+            other = MediaOffsets()
+            for offset, block_hash in pairs[3000:]:
+                other.append(offset, block_hash)
+            store.extend(other)
+            self.assertEqual(list(store), pairs, engine)
+            store.sort()
+            self.assertEqual(list(store),
+                             sorted(pairs, key=lambda pair: pair[0]), engine)
+            self.assertEqual(store.num_hashes(),
+                             len(set(block_hash for _, block_hash in pairs)))
+
+    def test_buffer(self):
+        for engine in self._engines():
+            for in_order in (True, False):
+                pairs = _random_pairs(6000, 500, 5)
+                if in_order:
+                    pairs.sort(key=lambda pair: pair[0])
+                buffer = MediaOffsetsBuffer()
+                views = list()
+                for batch in range(0, len(pairs), 1000):
+                    store = MediaOffsets()
+                    for offset, block_hash in pairs[batch:batch + 1000]:
+                        store.append(offset, block_hash)
+                    buffer.append(store)
+                    views.append(buffer.media_offsets())
+                self.assertEqual(buffer.is_sorted(), in_order, engine)
+
+                # views taken along the way still read their own pairs
+                for num_batches, view in enumerate(views, 1):
+                    self.assertEqual(list(view),
+                                     pairs[:num_batches * 1000], engine)
+                    self.assertEqual(view.num_hashes(), len(set(
+                                     block_hash for _, block_hash in
+                                     pairs[:num_batches * 1000])))
+
+                # sorting a view copies it
+                view = buffer.media_offsets()
+                view.sort()
+                self.assertEqual(list(view), sorted(pairs,
+                                 key=lambda pair: pair[0]), engine)
+                self.assertEqual(list(buffer.media_offsets()), pairs)
+
+if __name__ == "__main__":
+    unittest.main()
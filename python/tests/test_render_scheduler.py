@@ -0,0 +1,83 @@
+import unittest
+from render_scheduler import RenderScheduler
+
+class _IdleWidget():
+    # runs after_idle callbacks when run_idle is called, as Tk does when
+    # it next goes idle
+    def __init__(self):
+        self._callbacks = dict()
+        self._next_id = 0
+
+    def after_idle(self, callback):
+        self._next_id += 1
+        self._callbacks[self._next_id] = callback
+        return self._next_id
+
+    def after_cancel(self, after_id):
+        del self._callbacks[after_id]
+
+    def run_idle(self):
+        callbacks = list(self._callbacks.values())
+        self._callbacks.clear()
+        for callback in callbacks:
+            callback()
+
+class RenderSchedulerTest(unittest.TestCase):
+
+    def setUp(self):
+        self._widget = _IdleWidget()
+        self._draws = list()
+        self._scheduler = RenderScheduler(self._widget, self._draws.append)
+
+    def test_burst_draws_once(self):
+        for _ in range(20):
+            self._scheduler.schedule("plot_region_changed")
+        self.assertEqual(self._draws, [])
+        self._widget.run_idle()
+        self.assertEqual(self._draws, ["plot_region_changed"])
+        self.assertEqual(self._scheduler.executed, 1)
+        self.assertEqual(self._scheduler.dropped, 19)
+
+        # nothing more is drawn until the next request
+        self._widget.run_idle()
+        self.assertEqual(len(self._draws), 1)
+
+    def test_strongest_change_type_is_drawn(self):
+        for change_type in ("cursor_moved", "data_appended",
+                            "range_changed", "filter_changed"):
+            self._scheduler.schedule(change_type)
+        self._widget.run_idle()
+        self.assertEqual(self._draws, ["data_appended"])
+
+        # unknown change types are drawn as strongest
+        self._scheduler.schedule("data_changed")
+        self._scheduler.schedule("new_change")
+        self._widget.run_idle()
+        self.assertEqual(self._draws, ["data_appended", "new_change"])
+
+    def test_flush_draws_now(self):
+        self._scheduler.schedule("range_changed")
+        self._scheduler.schedule("cursor_moved")
+        self._scheduler.flush()
+        self.assertEqual(self._draws, ["range_changed"])
+
+        # the cancelled idle callback does not draw again
+        self._widget.run_idle()
+        self._scheduler.flush()
+        self.assertEqual(self._draws, ["range_changed"])
+
+    def test_requests_during_a_draw_are_drawn_next_cycle(self):
+        def draw(change_type):
+            self._draws.append(change_type)
+            if len(self._draws) == 1:
+                self._scheduler.schedule("cursor_moved")
+        scheduler = RenderScheduler(self._widget, draw)
+        self._scheduler = scheduler
+        scheduler.schedule("filter_changed")
+        self._widget.run_idle()
+        self.assertEqual(self._draws, ["filter_changed"])
+        self._widget.run_idle()
+        self.assertEqual(self._draws, ["filter_changed", "cursor_moved"])
+
+if __name__ == "__main__":
+    unittest.main()
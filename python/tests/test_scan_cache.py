@@ -0,0 +1,86 @@
+import os
+import shutil
+import tempfile
+import unittest
+from scan_cache import read_scan_cache, write_scan_cache, \
+                       scan_cache_filename
+from scan_file_parser import read_scan_file
+from scan_files import write_scan_file
+
+ANNOTATIONS = ([("mmls", "Partitions", True)],
+               [("mmls", 0, 32256, "Unallocated")])
+
+class ScanCacheTest(unittest.TestCase):
+
+    def setUp(self):
+        self._temp_dir = tempfile.mkdtemp()
+        self._scan_file = os.path.join(self._temp_dir, "scan.json")
+        self._media = os.path.join(self._temp_dir, "media.raw")
+        with open(self._media, "wb") as f:
+            f.write(bytearray(1 << 16))
+        write_scan_file(self._scan_file, 3000, 400, 1, in_order=False)
+        self._scan_data = read_scan_file(self._scan_file, 1)
+
+    def tearDown(self):
+        shutil.rmtree(self._temp_dir)
+
+    def _write(self, scan_data, annotations):
+        write_scan_cache(self._scan_file, 512, self._media,
+                         *(tuple(scan_data) + (annotations,)))
+
+    def _assert_same_scan_data(self, cached):
+        media_offsets, hashes, sources = self._scan_data
+        self.assertEqual(list(cached[0]), list(media_offsets))
+        self.assertTrue(cached[0]._is_sorted)
+        self.assertEqual(len(cached[1]), len(hashes))
+        self.assertEqual(dict(cached[1]), hashes)
+        self.assertEqual(dict(cached[2]), sources)
+
+    def test_round_trip(self):
+        self._write(self._scan_data, ANNOTATIONS)
+        cached = read_scan_cache(self._scan_file, 512, self._media)
+        self._assert_same_scan_data(cached)
+        self.assertEqual(cached[3], ANNOTATIONS)
+
+        # the media offsets are read in place
+        self.assertIsInstance(cached[0].offsets, memoryview)
+
+        # lookups of hashes that are not in the cache
+        self.assertNotIn("00" * 16, cached[1])
+        self.assertNotIn("00" * 16, cached[2])
+
+    def test_round_trip_from_cached_data(self):
+        # rewriting the cache from data read in place from it
+        self._write(self._scan_data, None)
+        cached = read_scan_cache(self._scan_file, 512, self._media)
+        self.assertIsNone(cached[3])
+        self._write(cached[:3], ANNOTATIONS)
+        cached = read_scan_cache(self._scan_file, 512, self._media)
+        self._assert_same_scan_data(cached)
+        self.assertEqual(cached[3], ANNOTATIONS)
+
+    def test_cached_tables_can_change(self):
+        self._write(self._scan_data, None)
+        hashes = read_scan_cache(self._scan_file, 512, self._media)[1]
+        hexcode = next(iter(hashes))
+        hashes["ab" * 16] = {"count": 1}
+        del hashes[hexcode]
+        self.assertEqual(len(hashes), len(self._scan_data[1]))
+        self.assertIn("ab" * 16, hashes)
+        self.assertNotIn(hexcode, hashes)
+        self.assertNotIn(hexcode, list(hashes))
+
+    def test_stale_cache_is_not_used(self):
+        self._write(self._scan_data, ANNOTATIONS)
+        self.assertTrue(os.path.exists(scan_cache_filename(
+                                                       self._scan_file)))
+
+        # a different sector size, then a changed media image
+        self.assertIsNone(read_scan_cache(self._scan_file, 4096,
+                                          self._media))
+        os.utime(self._media, (1, 1))
+        self.assertIsNone(read_scan_cache(self._scan_file, 512,
+                                          self._media))
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,76 @@
+import os
+import shutil
+import tempfile
+import unittest
+import scan_file_parser
+from scan_file_parser import read_scan_file, iter_scan_file, \
+                             line_aligned_ranges
+from scan_files import write_scan_file
+
+class ScanFileParserTest(unittest.TestCase):
+
+    def setUp(self):
+        self._temp_dir = tempfile.mkdtemp()
+        self._scan_file = os.path.join(self._temp_dir, "scan.json")
+
+        # parse even small files in parallel
+        self._parallel_min_size = scan_file_parser.PARALLEL_MIN_SIZE
+        scan_file_parser.PARALLEL_MIN_SIZE = 0
+
+    def tearDown(self):
+        scan_file_parser.PARALLEL_MIN_SIZE = self._parallel_min_size
+        shutil.rmtree(self._temp_dir)
+
+    def _assert_same(self, parsed, expected):
+        self.assertEqual(list(parsed[0]), list(expected[0]))
+        self.assertEqual(parsed[0].num_hashes(), expected[0].num_hashes())
+        self.assertEqual(parsed[1], expected[1])
+        self.assertEqual(parsed[2], expected[2])
+
+    def test_serial_and_parallel_parses_match(self):
+        for in_order in (True, False):
+            pairs, hashes = write_scan_file(self._scan_file, 4000, 500, 1,
+                                            in_order)
+            serial = read_scan_file(self._scan_file, 1)
+            self.assertEqual(list(serial[0]),
+                             sorted(pairs, key=lambda pair: pair[0]))
+            self.assertEqual(set(serial[1]), set(hashes))
+            self._assert_same(read_scan_file(self._scan_file, 4), serial)
+
+    def test_ranges_cover_every_line(self):
+        write_scan_file(self._scan_file, 1000, 100, 2)
+        serial = read_scan_file(self._scan_file, 1)
+        for num_ranges in (1, 2, 7, 50):
+            ranges = line_aligned_ranges(self._scan_file, num_ranges)
+            self.assertEqual(ranges[0][0], 0)
+            self.assertEqual(ranges[-1][1],
+                             os.path.getsize(self._scan_file))
+            for workers in (1, 3):
+                media_offsets = None
+                hashes = dict()
+                sources = dict()
+                for _, range_media_offsets, range_hashes, range_sources \
+                        in iter_scan_file(self._scan_file, ranges, workers):
+                    if media_offsets is None:
+                        media_offsets = range_media_offsets
+                    else:
+                        media_offsets.extend(range_media_offsets)
+                    hashes.update(range_hashes)
+                    sources.update(range_sources)
+                media_offsets.sort()
+                self._assert_same((media_offsets, hashes, sources), serial)
+
+    def test_bad_line_is_reported_by_file_line_number(self):
+        write_scan_file(self._scan_file, 1000, 100, 3)
+        with open(self._scan_file) as f:
+            lines = f.readlines()
+        lines[700] = "not a scan line\n"
+        with open(self._scan_file, "w") as f:
+            f.writelines(lines)
+        for workers in (1, 4):
+            with self.assertRaises(ValueError) as context:
+                read_scan_file(self._scan_file, workers)
+            self.assertIn("line 701:", str(context.exception))
+
+if __name__ == "__main__":
+    unittest.main()